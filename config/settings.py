@@ -58,6 +58,7 @@ INSTALLED_APPS = (
     'raven.contrib.django.raven_compat',
     'django_jinja',
     'channels',
+    'channels.delay',
     'versatileimagefield',
 )
 
@@ -207,6 +208,14 @@ CHANNEL_LAYERS = {
 
 CHANNELS_WS_PROTOCOLS = ['karrot.token']
 
+# Realtime updates about the same object within this time are merged and only the latest state is sent
+# Needs a running delay server (python manage.py rundelay), set to 0 to disable
+REALTIME_COALESCE_MILLISECONDS = 1000
+
+# After a push notification about a conversation, further messages within this time are sent as one summary
+# Needs a running delay server as well, set to 0 to disable
+PUSH_COALESCE_SECONDS = 60
+
 # Verification codes:
 # Time until a verification code expires
 EMAIL_VERIFICATION_TIME_LIMIT_HOURS = 7 * 24
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from foodsaving.conversations.models import Conversation, ConversationMessage
+from foodsaving.conversations.models import Conversation, ConversationMessage, ConversationMessageArchive
 
 
 @admin.register(Conversation)
@@ -11,3 +11,8 @@ class ConversationAdmin(admin.ModelAdmin):
 @admin.register(ConversationMessage)
 class ConversationMessageAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(ConversationMessageArchive)
+class ConversationMessageArchiveAdmin(admin.ModelAdmin):
+    pass
@@ -1,27 +1,50 @@
 from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import mixins
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated, BasePermission
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
+from foodsaving.conversations.filters import ConversationMessageFilter, ConversationMessageArchiveFilter
 from foodsaving.conversations.models import (
     Conversation,
-    ConversationMessage
+    ConversationMessage,
+    ConversationMessageArchive
 )
 from foodsaving.conversations.serializers import (
     ConversationSerializer,
     ConversationMessageSerializer,
-    ConversationMarkSerializer
+    ConversationMarkSerializer,
+    ConversationBulkMarkSerializer
 )
 
 
 class MessagePagination(CursorPagination):
-    # TODO: create an index on 'created_at' for increased speed
+    """
+    Newest messages first, or oldest first when catching up with `?after=<id>`
+
+    Uses the index on (conversation, id) of ConversationMessage
+    """
+    page_size = 10
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        if 'after' in request.query_params:
+            return ('id',)
+        return super().get_ordering(request, queryset, view)
+
+
+# how many of the newest matching messages a search ranks at most
+MESSAGE_SEARCH_LIMIT = 1000
+
+
+class MessageSearchPagination(CursorPagination):
+    """Best matches first"""
     page_size = 10
-    ordering = '-created_at'
+    ordering = ('-rank', '-id')
 
 
 class IsConversationParticipant(BasePermission):
@@ -55,7 +78,7 @@ class ConversationViewSet(
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
-        return self.queryset.filter(participants=self.request.user)
+        return self.queryset.for_participant(self.request.user).prefetch_related('participants')
 
     @detail_route(
         methods=['POST'],
@@ -69,6 +92,19 @@ class ConversationViewSet(
         serializer.save()
         return Response(serializer.data)
 
+    @list_route(
+        methods=['POST'],
+        url_path='mark',
+        serializer_class=ConversationBulkMarkSerializer
+    )
+    def mark_many(self, request):
+        """Mark many conversations as seen at once, returns them"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        conversations = self.get_queryset().filter(id__in=serializer.validated_data['conversations'].keys())
+        return Response(ConversationSerializer(conversations, many=True, context=self.get_serializer_context()).data)
+
 
 class ConversationMessageViewSet(
     mixins.CreateModelMixin,
@@ -83,18 +119,64 @@ class ConversationMessageViewSet(
     serializer_class = ConversationMessageSerializer
     permission_classes = (IsAuthenticated, IsConversationParticipant)
     filter_backends = (DjangoFilterBackend,)
-    filter_fields = ('conversation',)
+    filter_class = ConversationMessageFilter
     pagination_class = MessagePagination
 
     def get_queryset(self):
+        if self.action in ('archive', 'search_archive'):
+            return ConversationMessageArchive.objects.filter(conversation__participants=self.request.user)
         return self.queryset.filter(conversation__participants=self.request.user)
 
+    @list_route(
+        methods=['GET'],
+        pagination_class=MessageSearchPagination
+    )
+    def search(self, request):
+        """
+        Search the messages of your conversations with `?q=<search terms>`
+
+        Can be restricted to one conversation with `?conversation=<id>`. The search terms get interpreted in your
+        language, messages in the language of their author.
+        """
+        return self.search_messages(request)
+
+    @list_route(
+        methods=['GET'],
+        filter_class=ConversationMessageArchiveFilter
+    )
+    def archive(self, request):
+        """
+        Archived messages, filtered and paginated like the list
+
+        They are older than all the other messages, clients continue here once the list has no next page.
+        """
+        return self.list(request)
+
+    @list_route(
+        methods=['GET'],
+        url_path='archive/search',
+        filter_class=ConversationMessageArchiveFilter,
+        pagination_class=MessageSearchPagination
+    )
+    def search_archive(self, request):
+        """Search the archived messages, like the messages"""
+        return self.search_messages(request)
+
+    def search_messages(self, request):
+        terms = request.query_params.get('q', '').strip()
+        if not terms:
+            raise ValidationError({'q': _('This field is required.')})
+        queryset = self.filter_queryset(self.get_queryset()).search(terms, request.user.language, MESSAGE_SEARCH_LIMIT)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
 
 class RetrieveConversationMixin(object):
     """Retrieve a conversation instance."""
 
     def retrieve_conversation(self, request, *args, **kwargs):
         target = self.get_object()
-        conversation = Conversation.objects.get_or_create_for_target(target)
+        conversation = target.conversation
         serializer = ConversationSerializer(conversation, context={'request': request})
         return Response(serializer.data)
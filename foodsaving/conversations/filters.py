@@ -0,0 +1,18 @@
+from django_filters.rest_framework import FilterSet, NumberFilter
+
+from foodsaving.conversations.models import ConversationMessage, ConversationMessageArchive
+
+
+class ConversationMessageFilter(FilterSet):
+    # for catching up, e.g. after reconnecting: ?conversation=<id>&after=<id of the latest message the client has>
+    after = NumberFilter(field_name='id', lookup_expr='gt')
+    before = NumberFilter(field_name='id', lookup_expr='lt')
+
+    class Meta:
+        model = ConversationMessage
+        fields = ['conversation', 'after', 'before']
+
+
+class ConversationMessageArchiveFilter(ConversationMessageFilter):
+    class Meta(ConversationMessageFilter.Meta):
+        model = ConversationMessageArchive
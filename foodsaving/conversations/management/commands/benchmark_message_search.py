@@ -0,0 +1,81 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from foodsaving.conversations.api import MESSAGE_SEARCH_LIMIT
+from foodsaving.conversations.factories import ConversationFactory
+from foodsaving.conversations.models import ConversationMessage
+from foodsaving.users.factories import UserFactory
+
+
+class Command(BaseCommand):
+    """
+    Measures message search on a synthetic dataset, compared to filtering with ILIKE.
+    The messages consist of made up words with a skewed frequency, so there are frequent and rare ones.
+    All data gets created in a transaction that is rolled back afterwards.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000000)
+        parser.add_argument('--conversations', type=int, default=100)
+        parser.add_argument('--rounds', type=int, default=10)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options['messages'], options['conversations'], options['rounds'])
+            transaction.set_rollback(True)
+
+    def run(self, n_messages, n_conversations, rounds):
+        user = UserFactory()
+        conversations = [ConversationFactory() for _ in range(n_conversations)]
+        # the user is in every tenth conversation
+        for conversation in conversations[::10]:
+            conversation.join(user)
+        first_conversation_id = conversations[0].id
+
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO conversations_conversationmessage
+                  (created_at, author_id, conversation_id, content, search_vector)
+                SELECT now(), %(author)s, content.conversation_id, content.text, to_tsvector('english', content.text)
+                FROM (
+                  SELECT
+                    %(first_conversation)s + i %% %(conversations)s AS conversation_id,
+                    (SELECT string_agg('w' || floor(power(random(), 4) * 100000)::int, ' ') || i
+                     FROM generate_series(1, 12)) AS text
+                  FROM generate_series(1, %(messages)s) AS i
+                ) AS content
+            """, {
+                'author': user.id,
+                'first_conversation': first_conversation_id,
+                'conversations': n_conversations,
+                'messages': n_messages,
+            })
+            for table in ('conversations_conversation', 'conversations_conversationparticipant',
+                          'conversations_conversationmessage'):
+                cursor.execute('ANALYZE {}'.format(table))
+        self.stdout.write('{} messages in {} conversations, created in {:.0f} s, {} rounds'.format(
+            n_messages, n_conversations, time.perf_counter() - start, rounds
+        ))
+
+        messages = ConversationMessage.objects.filter(conversation__participants=user)
+
+        def search(terms):
+            list(messages.search(terms, user.language, MESSAGE_SEARCH_LIMIT)[:10])
+
+        def ilike(terms):
+            list(messages.filter(content__icontains=terms).order_by('-id')[:10])
+
+        def measure(name, f, terms):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                f(terms)
+            per_query = (time.perf_counter() - start) / rounds * 1000
+            self.stdout.write('{:<35} {:10.1f} ms per query'.format(name, per_query))
+
+        # w0 is in most messages, the others get rarer
+        for terms in ('w0', 'w30', 'w5000', 'w99999'):
+            measure('search {}'.format(terms), search, terms)
+            measure('ilike {}'.format(terms), ilike, terms)
@@ -0,0 +1,36 @@
+# Generated by Django 2.0.1 on 2026-10-18 20:31
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Count, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+
+
+def count_unread_messages(apps, schema_editor):
+    participant_model = apps.get_model('conversations', 'ConversationParticipant')
+    message_model = apps.get_model('conversations', 'ConversationMessage')
+
+    def count(messages):
+        messages = messages.order_by().values('conversation').annotate(count=Count('id')).values('count')
+        return Coalesce(Subquery(messages, output_field=IntegerField()), 0)
+
+    messages = message_model.objects.filter(conversation=OuterRef('conversation'))
+    participant_model.objects.filter(seen_up_to=None).update(unread_message_count=count(messages))
+    participant_model.objects.exclude(seen_up_to=None).update(
+        unread_message_count=count(messages.filter(id__gt=OuterRef('seen_up_to')))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0008_auto_20180126_1643'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationparticipant',
+            name='unread_message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_messages, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.1 on 2026-10-18 20:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0009_conversationparticipant_unread_message_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationmessage',
+            index=models.Index(fields=['conversation', 'id'], name='conversatio_convers_4e2613_idx'),
+        ),
+    ]
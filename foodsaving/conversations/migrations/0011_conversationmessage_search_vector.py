@@ -0,0 +1,52 @@
+# Generated by Django 2.0.1 on 2026-10-18 20:57
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+# the text search configurations of the languages at the time of this migration
+SEARCH_CONFIGS = {
+    'da': 'danish',
+    'de': 'german',
+    'en': 'english',
+    'es': 'spanish',
+    'fr': 'french',
+    'it': 'italian',
+    'nl': 'dutch',
+    'pt': 'portuguese',
+    'pt-br': 'portuguese',
+    'ru': 'russian',
+    'sv': 'swedish',
+}
+
+
+def fill_search_vector(apps, schema_editor):
+    message_model = apps.get_model('conversations', 'ConversationMessage')
+    user_model = apps.get_model('users', 'User')
+    for language in user_model.objects.order_by().values_list('language', flat=True).distinct():
+        message_model.objects.filter(author__language=language).update(
+            search_vector=SearchVector('content', config=SEARCH_CONFIGS.get(language.lower(), 'simple'))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0010_conversationmessage_conversation_id_index'),
+        ('users', '0020_user_mobile_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmessage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        # before creating the index, that's faster
+        migrations.RunPython(fill_search_vector, migrations.RunPython.noop, elidable=True),
+        migrations.AddIndex(
+            model_name='conversationmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='conversatio_search__45b2bc_gin'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.0.1 on 2026-10-18 21:18
+
+from django.conf import settings
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('conversations', '0011_conversationmessage_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMessageArchive',
+            fields=[
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(editable=False, null=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='conversations.Conversation')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversationmessagearchive',
+            index=models.Index(fields=['conversation', 'id'], name='conversatio_convers_ca0a50_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationmessagearchive',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='conversatio_search__3b1797_gin'),
+        ),
+    ]
@@ -1,13 +1,42 @@
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models import ForeignKey, TextField, ManyToManyField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField, SearchVector, SearchQuery, SearchRank
+from django.db import models, transaction
+from django.db.models import ForeignKey, TextField, ManyToManyField, Count, F, OuterRef, Subquery, IntegerField, \
+    PositiveIntegerField, Case, When, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 from foodsaving.base.base_models import BaseModel, UpdatedAtMixin
 
+# sent by Conversation.sync_users, add_users and remove_users, with the set of user_ids,
+# instead of signals for each ConversationParticipant
+participants_added = Signal()
+participants_removed = Signal()
 
-class ConversationManager(models.Manager):
+# sent by ConversationParticipant.objects.mark_seen_up_to, with the user and the set of conversation_ids
+participants_marked = Signal()
+
+
+class ConversationQuerySet(models.QuerySet):
+    def for_participant(self, user):
+        """
+        Conversations of the user, with the fields of their participation annotated
+
+        Saves looking up the participant for each conversation in ConversationSerializer
+        """
+        return self.filter(conversationparticipant__user=user).annotate(
+            participant_seen_up_to=F('conversationparticipant__seen_up_to'),
+            participant_unread_message_count=F('conversationparticipant__unread_message_count'),
+            participant_updated_at=Greatest('updated_at', 'conversationparticipant__updated_at'),
+        )
+
+
+class ConversationManager(models.Manager.from_queryset(ConversationQuerySet)):
     @classmethod
     def get_for_target(self, target):
         return Conversation.objects.filter(target_id=target.id,
@@ -17,6 +46,28 @@ class ConversationManager(models.Manager):
     def get_or_create_for_target(self, target):
         return Conversation.objects.get_for_target(target) or Conversation.objects.create(target=target)
 
+    def prefetch_for_targets(self, targets):
+        """
+        Look up the conversations of many targets of the same model in one query
+
+        Sets `target.conversation` of the targets which have a conversation already, see ConversationMixin
+        """
+        targets = list(targets)
+        if len(targets) == 0:
+            return
+        conversations = {
+            conversation.target_id: conversation
+            for conversation in self.filter(
+                target_type=ContentType.objects.get_for_model(targets[0]),
+                target_id__in=[target.id for target in targets],
+            )
+        }
+        for target in targets:
+            if target.id in conversations:
+                conversation = conversations[target.id]
+                conversation.target = target
+                target.conversation = conversation
+
 
 class Conversation(BaseModel, UpdatedAtMixin):
     """A conversation between one or more users."""
@@ -34,40 +85,240 @@ class Conversation(BaseModel, UpdatedAtMixin):
 
     def join(self, user):
         if not self.conversationparticipant_set.filter(user=user).exists():
-            ConversationParticipant.objects.create(user=user, conversation=self)
+            ConversationParticipant.objects.create(user=user, conversation=self,
+                                                   unread_message_count=self.messages.count())
 
     def leave(self, user):
         self.conversationparticipant_set.filter(user=user).delete()
 
     def sync_users(self, desired_users):
-        """Pass in a set of users and we ensure the Conversation will end up with the right participants."""
-        existing_users = self.participants.all()
-        for user in desired_users:
-            if user not in existing_users:
-                self.join(user)
-        for user in existing_users:
-            if user not in desired_users:
-                self.leave(user)
+        """
+        Pass in a set of users and we ensure the Conversation will end up with the right participants.
+
+        Adds participants in bulk, without signals for each of them, participants_added gets sent once instead.
+        Removed participants get deleted with their signals, followed by participants_removed.
+        """
+        desired_user_ids = {user.id for user in desired_users}
+        existing_user_ids = set(self.conversationparticipant_set.values_list('user_id', flat=True))
+        self._add_participants(desired_user_ids - existing_user_ids)
+        self._remove_participants(existing_user_ids - desired_user_ids)
+
+    def add_users(self, user_ids):
+        """Like sync_users, but only adds the users who aren't participants yet"""
+        existing_user_ids = set(self.conversationparticipant_set.filter(user__in=user_ids)
+                                .values_list('user_id', flat=True))
+        self._add_participants(set(user_ids) - existing_user_ids)
+
+    def remove_users(self, user_ids):
+        """Like sync_users, but only removes the users"""
+        self._remove_participants(set(self.conversationparticipant_set.filter(user__in=user_ids)
+                                      .values_list('user_id', flat=True)))
+
+    def _add_participants(self, user_ids):
+        if user_ids:
+            unread_message_count = self.messages.count()
+            ConversationParticipant.objects.bulk_create(
+                ConversationParticipant(conversation=self, user_id=user_id, unread_message_count=unread_message_count)
+                for user_id in user_ids
+            )
+            participants_added.send(sender=Conversation, instance=self, user_ids=user_ids)
+
+    def _remove_participants(self, user_ids):
+        if user_ids:
+            self.conversationparticipant_set.filter(user__in=user_ids).delete()
+            participants_removed.send(sender=Conversation, instance=self, user_ids=user_ids)
+
+
+def count_messages_after(message_id):
+    """The number of messages in the conversation of the participant after the message, for an UPDATE"""
+    messages = ConversationMessage.objects.filter(conversation=OuterRef('conversation'), id__gt=message_id)
+    return Coalesce(Subquery(
+        messages.order_by().values('conversation').annotate(count=Count('id')).values('count'),
+        output_field=IntegerField()
+    ), 0)
+
+
+class ConversationParticipantQuerySet(models.QuerySet):
+    def annotate_actual_unread_message_count(self):
+        """Count the unread messages from scratch, to check the stored unread_message_count"""
+        def count(messages):
+            messages = messages.order_by().values('conversation').annotate(count=Count('id')).values('count')
+            return Coalesce(Subquery(messages, output_field=IntegerField()), 0)
+
+        messages = ConversationMessage.objects.filter(conversation=OuterRef('conversation'))
+        return self.annotate(actual_unread_message_count=Case(
+            When(seen_up_to=None, then=count(messages)),
+            default=count(messages.filter(id__gt=OuterRef('seen_up_to'))),
+        ))
+
+    def mark_seen_up_to(self, user, seen_up_to):
+        """
+        Update seen_up_to and unread_message_count of many participations of the user in one statement
+
+        Skips the signals for each participant, sends participants_marked once instead.
+
+        :param seen_up_to: dict of conversation id -> message id
+        """
+        if not seen_up_to:
+            return
+        self.filter(user=user, conversation__in=seen_up_to.keys()).update(
+            seen_up_to=Case(*[
+                When(conversation=conversation_id, then=Value(message_id))
+                for conversation_id, message_id in seen_up_to.items()
+            ], output_field=IntegerField()),
+            unread_message_count=Case(*[
+                When(conversation=conversation_id, then=count_messages_after(message_id))
+                for conversation_id, message_id in seen_up_to.items()
+            ], output_field=IntegerField()),
+            updated_at=timezone.now(),
+        )
+        participants_marked.send(sender=ConversationParticipant, user=user, conversation_ids=set(seen_up_to.keys()))
+
+    def repair_unread_message_count(self):
+        """Fix unread_message_count where it went wrong, returns how many participants got fixed"""
+        actual = self.annotate_actual_unread_message_count()
+        broken = list(actual.exclude(unread_message_count=F('actual_unread_message_count')))
+        for participant in broken:
+            self.filter(id=participant.id).update(unread_message_count=participant.actual_unread_message_count)
+        return len(broken)
 
 
 class ConversationParticipant(BaseModel, UpdatedAtMixin):
     """The join table between Conversation and User."""
+    objects = ConversationParticipantQuerySet.as_manager()
+
     user = ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     conversation = ForeignKey(Conversation, on_delete=models.CASCADE)
+    # cleared when the message gets archived, see ConversationMessageQuerySet.move_to_archive
     seen_up_to = ForeignKey('ConversationMessage', null=True, on_delete=models.SET_NULL)
+    # messages after seen_up_to, kept up to date when messages get added and when seen_up_to changes
+    unread_message_count = PositiveIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # messages might have been added since this instance got loaded, don't overwrite their count
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'unread_message_count'
+            ]
+        super().save(*args, **kwargs)
+
+    def set_seen_up_to(self, message):
+        """Mark the messages up to the message as seen and count the ones after it again, then save"""
+        ConversationParticipant.objects.filter(id=self.id).update(
+            seen_up_to=message,
+            unread_message_count=count_messages_after(message.id),
+        )
+        self.seen_up_to = message
+        self.save()
+
+
+# postgres text search configurations for our languages, the others get no stemming and stop words
+SEARCH_CONFIGS = {
+    'da': 'danish',
+    'de': 'german',
+    'en': 'english',
+    'es': 'spanish',
+    'fr': 'french',
+    'it': 'italian',
+    'nl': 'dutch',
+    'pt': 'portuguese',
+    'pt-br': 'portuguese',
+    'ru': 'russian',
+    'sv': 'swedish',
+}
+
+
+def get_search_config(language):
+    return SEARCH_CONFIGS.get(language.lower(), 'simple')
+
+
+class MessageSearchQuerySet(models.QuerySet):
+    def search(self, terms, language, limit=None):
+        """
+        Messages which match the search terms, annotated with their `rank` and best matches first
+
+        With a limit, only the newest matching messages get ranked, a frequent term might match a lot of them.
+        """
+        search_query = SearchQuery(terms, config=get_search_config(language))
+        matches = self.filter(search_vector=search_query)
+        if limit is not None:
+            matches = self.model.objects.filter(id__in=matches.order_by('-id').values('id')[:limit])
+        return matches.annotate(rank=SearchRank(F('search_vector'), search_query)).order_by('-rank', '-id')
+
+
+class ConversationMessageQuerySet(MessageSearchQuerySet):
+    @transaction.atomic
+    def move_to_archive(self):
+        """
+        Move the messages to ConversationMessageArchive, returns how many got moved
+
+        Participants who have seen up to one of the messages get seen_up_to cleared, all the messages they haven't
+        seen are newer. The unread counts of the conversations get counted again.
+        """
+        messages = list(self.values('id', 'created_at', 'author_id', 'conversation_id', 'content', 'search_vector'))
+        ConversationMessageArchive.objects.bulk_create(ConversationMessageArchive(**message) for message in messages)
+        ConversationMessage.objects.filter(id__in=[message['id'] for message in messages]).delete()
+        ConversationParticipant.objects.filter(
+            conversation__in={message['conversation_id'] for message in messages}
+        ).repair_unread_message_count()
+        return len(messages)
 
 
 class ConversationMessage(BaseModel):
     """A message in the conversation by a particular user."""
+    objects = ConversationMessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # for the messages of a conversation in order and paginated by id
+            models.Index(fields=['conversation', 'id']),
+            GinIndex(fields=['search_vector']),
+        ]
+
     author = ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     conversation = ForeignKey(Conversation, related_name='messages', on_delete=models.CASCADE)
 
     content = TextField()
+    # the content as search terms, in the language of the author
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        if self.author_id is not None:
+            # goes into the same INSERT or UPDATE, it can't refer to columns though
+            self.search_vector = SearchVector(Value(self.content), config=get_search_config(self.author.language))
+        with transaction.atomic():
+            if self.pk is None:
+                # before saving, so that the post_save receivers see the new counts already
+                participants = ConversationParticipant.objects.filter(conversation=self.conversation_id)
+                participants.exclude(user=self.author_id).update(unread_message_count=F('unread_message_count') + 1)
+            super().save(*args, **kwargs)
+
+
+class ConversationMessageArchive(BaseModel):
+    """Old messages, moved out of ConversationMessage to keep it small. See manage.py archive_old_rows"""
+    objects = MessageSearchQuerySet.as_manager()
+
+    class Meta:
+        # read like ConversationMessage, once the API reaches past the oldest message of it
+        indexes = [
+            models.Index(fields=['conversation', 'id']),
+            GinIndex(fields=['search_vector']),
+        ]
+
+    id = models.IntegerField(primary_key=True)
+    author = ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    conversation = ForeignKey(Conversation, related_name='archived_messages', on_delete=models.CASCADE)
+
+    content = TextField()
+    search_vector = SearchVectorField(null=True, editable=False)
 
 
 class ConversationMixin(object):
     # TODO: including this should automatically wireup a signal to create/destroy with target
 
-    @property
+    @cached_property
     def conversation(self):
-        return Conversation.objects.get_or_create_for_target(self)
+        conversation = Conversation.objects.get_or_create_for_target(self)
+        conversation.target = self
+        return conversation
@@ -1,7 +1,7 @@
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 
-from foodsaving.conversations.models import ConversationParticipant, ConversationMessage
+from foodsaving.conversations.models import ConversationParticipant, ConversationMessage, participants_added
 
 
 @receiver(post_save, sender=ConversationMessage)
@@ -14,8 +14,7 @@ def mark_as_read(sender, instance, **kwargs):
         conversation=message.conversation
     )
 
-    participant.seen_up_to = message
-    participant.save()
+    participant.set_seen_up_to(message)
 
 
 @receiver(post_save, sender=ConversationParticipant)
@@ -29,3 +28,9 @@ def set_conversation_updated_at_on_create(sender, instance, **kwargs):
 def set_conversation_updated_at_on_delete(sender, instance, **kwargs):
     participant = instance
     participant.conversation.save()
+
+
+@receiver(participants_added)
+def set_conversation_updated_at_on_sync(sender, instance, **kwargs):
+    conversation = instance
+    conversation.save()
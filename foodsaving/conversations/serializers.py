@@ -22,28 +22,27 @@ class ConversationSerializer(serializers.ModelSerializer):
     unread_message_count = serializers.SerializerMethodField()
     updated_at = serializers.SerializerMethodField()
 
-    def get_seen_up_to(self, conversation):
+    # the viewset annotates the fields of the participant, see ConversationQuerySet.for_participant
+
+    def get_participant(self, conversation):
         user = self.context['request'].user
-        participant = conversation.conversationparticipant_set.get(user=user)
-        if not participant.seen_up_to:
-            return None
-        return participant.seen_up_to.id
+        return conversation.conversationparticipant_set.get(user=user)
+
+    def get_seen_up_to(self, conversation):
+        if hasattr(conversation, 'participant_seen_up_to'):
+            return conversation.participant_seen_up_to
+        return self.get_participant(conversation).seen_up_to_id
 
     def get_unread_message_count(self, conversation):
-        user = self.context['request'].user
-        participant = conversation.conversationparticipant_set.get(user=user)
-        messages = conversation.messages
-        if participant.seen_up_to:
-            messages = messages.filter(id__gt=participant.seen_up_to.id)
-        return messages.count()
+        if hasattr(conversation, 'participant_unread_message_count'):
+            return conversation.participant_unread_message_count
+        return self.get_participant(conversation).unread_message_count
 
     def get_updated_at(self, conversation):
-        user = self.context['request'].user
-        participant = conversation.conversationparticipant_set.get(user=user)
-        if participant.updated_at > conversation.updated_at:
-            date = participant.updated_at
+        if hasattr(conversation, 'participant_updated_at'):
+            date = conversation.participant_updated_at
         else:
-            date = conversation.updated_at
+            date = max(self.get_participant(conversation).updated_at, conversation.updated_at)
         return DateTimeField().to_representation(date)
 
 
@@ -58,11 +57,35 @@ class ConversationMarkSerializer(serializers.ModelSerializer):
         return message
 
     def update(self, participant, validated_data):
-        participant.seen_up_to = validated_data['seen_up_to']
-        participant.save()
+        participant.set_seen_up_to(validated_data['seen_up_to'])
         return participant
 
 
+class ConversationBulkMarkItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    seen_up_to = serializers.IntegerField()
+
+
+class ConversationBulkMarkSerializer(serializers.Serializer):
+    """Marks many conversations of the user in one go, e.g. {"conversations": [{"id": 1, "seen_up_to": 5}]}"""
+    conversations = ConversationBulkMarkItemSerializer(many=True)
+
+    def validate_conversations(self, items):
+        seen_up_to = {item['id']: item['seen_up_to'] for item in items}
+        user = self.context['request'].user
+        messages = ConversationMessage.objects.filter(
+            id__in=seen_up_to.values(),
+            conversation__conversationparticipant__user=user,
+        ).values_list('id', 'conversation_id')
+        if set(messages) != set((message_id, conversation_id) for conversation_id, message_id in seen_up_to.items()):
+            raise serializers.ValidationError('Must refer to messages in your conversations')
+        return seen_up_to
+
+    def save(self):
+        user = self.context['request'].user
+        ConversationParticipant.objects.mark_seen_up_to(user, self.validated_data['conversations'])
+
+
 class ConversationMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ConversationMessage
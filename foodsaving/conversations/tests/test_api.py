@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 from dateutil.parser import parse
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -27,6 +29,16 @@ class TestConversationsAPI(APITestCase):
         self.conversation2.messages.create(author=self.participant1, content='hello2')
         self.conversation3 = ConversationFactory()  # conversation noone is in
 
+    def test_list_conversations_with_few_queries(self):
+        for _ in range(5):
+            ConversationFactory().join(self.participant1)
+        self.client.force_login(user=self.participant1)
+        # user, conversations with the participant fields, participants
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/conversations/', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 7)
+
     def test_get_messages(self):
         self.client.force_login(user=self.participant1)
         response = self.client.get('/api/messages/?conversation={}'.format(self.conversation1.id), format='json')
@@ -42,6 +54,28 @@ class TestConversationsAPI(APITestCase):
         self.assertEqual(response.data['results'][0]['content'], 'hello2')
         self.assertEqual(response.data['results'][1]['content'], 'hello')
 
+    def test_get_messages_after(self):
+        messages = [self.conversation1.messages.create(author=self.participant2, content=str(n)) for n in range(12)]
+        self.client.force_login(user=self.participant1)
+        response = self.client.get(
+            '/api/messages/?conversation={}&after={}'.format(self.conversation1.id, messages[0].id), format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['results']], [str(n) for n in range(1, 11)])
+
+        response = self.client.get(response.data['next'], format='json')
+        self.assertEqual([m['content'] for m in response.data['results']], ['11'])
+        self.assertIsNone(response.data['next'])
+
+    def test_get_messages_before(self):
+        messages = [self.conversation1.messages.create(author=self.participant2, content=str(n)) for n in range(3)]
+        self.client.force_login(user=self.participant1)
+        response = self.client.get(
+            '/api/messages/?conversation={}&before={}'.format(self.conversation1.id, messages[2].id), format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['results']], ['1', '0', 'hello'])
+
     def test_cannot_get_messages_if_not_in_conversation(self):
         self.client.force_login(user=self.participant1)
         response = self.client.get('/api/messages/?conversation={}'.format(self.conversation3.id), format='json')
@@ -105,8 +139,7 @@ class TestConversationsSeenUpToAPI(APITestCase):
         self.assertEqual(response.data['seen_up_to'], None)
         self.assertEqual(response.data['unread_message_count'], 1)
 
-        self.participant.seen_up_to = message
-        self.participant.save()
+        self.participant.set_seen_up_to(message)
 
         response = self.client.get('/api/conversations/{}/'.format(self.conversation.id), format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -117,8 +150,7 @@ class TestConversationsSeenUpToAPI(APITestCase):
         message = self.conversation.messages.create(author=self.user, content='yay')
         self.client.force_login(user=self.user)
 
-        self.participant.seen_up_to = message
-        self.participant.save()
+        self.participant.set_seen_up_to(message)
 
         response = self.client.get('/api/conversations/'.format(self.conversation.id), format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -158,3 +190,112 @@ class TestConversationsSeenUpToAPI(APITestCase):
         response = self.client.post('/api/conversations/{}/mark/'.format(self.conversation.id), data, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data['seen_up_to'][0], 'Must refer to a message in the conversation')
+
+    def test_mark_many(self):
+        conversation = ConversationFactory()
+        conversation.sync_users([self.user, self.user2])
+        messages = [c.messages.create(author=self.user2, content='yay') for c in (self.conversation, conversation)]
+        conversation.messages.create(author=self.user2, content='unread')
+        self.client.force_login(user=self.user)
+
+        data = {'conversations': [{'id': m.conversation_id, 'seen_up_to': m.id} for m in messages]}
+        response = self.client.post('/api/conversations/mark/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = {c['id']: c for c in response.data}
+        self.assertEqual(results[self.conversation.id]['seen_up_to'], messages[0].id)
+        self.assertEqual(results[self.conversation.id]['unread_message_count'], 0)
+        self.assertEqual(results[conversation.id]['seen_up_to'], messages[1].id)
+        self.assertEqual(results[conversation.id]['unread_message_count'], 1)
+
+        self.participant.refresh_from_db()
+        self.assertEqual(self.participant.seen_up_to, messages[0])
+
+    def test_mark_many_fails_for_message_in_other_conversation(self):
+        conversation = ConversationFactory()
+        conversation.join(self.user)
+        message = conversation.messages.create(author=self.user, content='yay')
+        self.client.force_login(user=self.user)
+
+        data = {'conversations': [{'id': self.conversation.id, 'seen_up_to': message.id}]}
+        response = self.client.post('/api/conversations/mark/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['conversations'][0], 'Must refer to messages in your conversations')
+
+    def test_mark_many_fails_for_conversation_of_others(self):
+        conversation = ConversationFactory()
+        conversation.join(self.user2)
+        message = conversation.messages.create(author=self.user2, content='yay')
+        self.client.force_login(user=self.user)
+
+        data = {'conversations': [{'id': conversation.id, 'seen_up_to': message.id}]}
+        response = self.client.post('/api/conversations/mark/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestConversationMessageSearchAPI(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.conversation = ConversationFactory()
+        self.conversation.join(self.user)
+        self.other_conversation = ConversationFactory()
+        self.other_conversation.join(self.other_user)
+        self.client.force_login(user=self.user)
+
+    def search(self, terms, **params):
+        params['q'] = terms
+        return self.client.get('/api/messages/search/', params, format='json')
+
+    def test_search_messages(self):
+        self.conversation.messages.create(author=self.user, content='who can pick up the apples?')
+        self.conversation.messages.create(author=self.user, content='bananas are left')
+        response = self.search('apple')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['content'] for m in response.data['results']], ['who can pick up the apples?'])
+
+    def test_search_ranks_best_match_first(self):
+        self.conversation.messages.create(author=self.user, content='apples apples apples')
+        self.conversation.messages.create(author=self.user, content='some apples and a lot of other fruits')
+        self.conversation.messages.create(author=self.user, content='apples')
+        response = self.search('apples')
+        self.assertEqual(response.data['results'][0]['content'], 'apples apples apples')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_search_uses_language_of_author(self):
+        self.user.language = 'de'
+        self.user.save()
+        self.conversation.messages.create(author=self.user, content='Wir haben die Bananen abgeholt')
+        self.assertEqual(len(self.search('Banane').data['results']), 1)
+
+    def test_search_paginates(self):
+        for _ in range(12):
+            self.conversation.messages.create(author=self.user, content='apples')
+        response = self.search('apples')
+        self.assertEqual(len(response.data['results']), 10)
+        response = self.client.get(response.data['next'], format='json')
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_search_ranks_only_newest_matches(self):
+        old_message = self.conversation.messages.create(author=self.user, content='apples apples apples')
+        for _ in range(2):
+            self.conversation.messages.create(author=self.user, content='apples')
+        with patch('foodsaving.conversations.api.MESSAGE_SEARCH_LIMIT', 2):
+            response = self.search('apples')
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertNotIn(old_message.id, [m['id'] for m in response.data['results']])
+
+    def test_search_only_in_own_conversations(self):
+        self.other_conversation.messages.create(author=self.other_user, content='apples')
+        self.assertEqual(len(self.search('apples').data['results']), 0)
+
+    def test_search_in_conversation(self):
+        conversation = ConversationFactory()
+        conversation.join(self.user)
+        conversation.messages.create(author=self.user, content='apples')
+        self.conversation.messages.create(author=self.user, content='apples')
+        response = self.search('apples', conversation=conversation.id)
+        self.assertEqual([m['conversation'] for m in response.data['results']], [conversation.id])
+
+    def test_search_requires_terms(self):
+        response = self.search(' ')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -2,7 +2,7 @@ from django.db import IntegrityError
 from django.test import TestCase
 
 from foodsaving.conversations.factories import ConversationFactory
-from foodsaving.conversations.models import Conversation, ConversationMessage
+from foodsaving.conversations.models import Conversation, ConversationMessage, ConversationParticipant
 from foodsaving.groups.factories import GroupFactory
 from foodsaving.users.factories import UserFactory
 
@@ -38,6 +38,15 @@ class ConversationModelTests(TestCase):
         self.assertIn(user3, conversation.participants.all())
         self.assertNotIn(user4, conversation.participants.all())
 
+    def test_sync_users_in_bulk(self):
+        users = [UserFactory() for _ in range(5)]
+        conversation = ConversationFactory()
+        conversation.join(users[0])
+        # no matter how many users get added, including the realtime updates
+        with self.assertNumQueries(9):
+            conversation.sync_users(users[1:])
+        self.assertEqual(set(conversation.participants.all()), set(users[1:]))
+
     def test_message_create(self):
         user = UserFactory()
         conversation = ConversationFactory()
@@ -61,3 +70,62 @@ class ConversationModelTests(TestCase):
         conversation = Conversation.objects.get_or_create_for_target(target)
         self.assertIsNotNone(conversation)
         self.assertEqual(target.conversation, conversation)
+
+    def test_mixin_remembers_conversation(self):
+        target = GroupFactory()
+        target = type(target).objects.get(id=target.id)
+        conversation = target.conversation
+        with self.assertNumQueries(0):
+            self.assertEqual(target.conversation, conversation)
+            self.assertEqual(target.conversation.target, target)
+
+    def test_prefetch_for_targets(self):
+        targets = [GroupFactory() for _ in range(3)]
+        targets = list(type(targets[0]).objects.filter(id__in=[target.id for target in targets]))
+        with self.assertNumQueries(1):
+            Conversation.objects.prefetch_for_targets(targets)
+        with self.assertNumQueries(0):
+            for target in targets:
+                self.assertEqual(target.conversation.target_id, target.id)
+
+
+class ConversationUnreadMessageCountTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.author = UserFactory()
+        self.conversation = ConversationFactory()
+        self.conversation.join(self.user)
+        self.conversation.join(self.author)
+
+    def get_unread_message_count(self, user):
+        return ConversationParticipant.objects.get(conversation=self.conversation, user=user).unread_message_count
+
+    def test_counts_new_messages(self):
+        for _ in range(3):
+            self.conversation.messages.create(author=self.author, content='yay')
+        self.assertEqual(self.get_unread_message_count(self.user), 3)
+        self.assertEqual(self.get_unread_message_count(self.author), 0)
+
+    def test_counts_existing_messages_on_join(self):
+        self.conversation.messages.create(author=self.author, content='yay')
+        user = UserFactory()
+        self.conversation.join(user)
+        self.assertEqual(self.get_unread_message_count(user), 1)
+
+    def test_counts_again_when_marking_as_seen(self):
+        messages = [self.conversation.messages.create(author=self.author, content='yay') for _ in range(3)]
+        participant = ConversationParticipant.objects.get(conversation=self.conversation, user=self.user)
+        participant.set_seen_up_to(messages[0])
+        self.assertEqual(self.get_unread_message_count(self.user), 2)
+
+    def test_save_keeps_count_of_new_messages(self):
+        participant = ConversationParticipant.objects.get(conversation=self.conversation, user=self.user)
+        self.conversation.messages.create(author=self.author, content='yay')
+        participant.save()
+        self.assertEqual(self.get_unread_message_count(self.user), 1)
+
+    def test_repair_unread_message_count(self):
+        self.conversation.messages.create(author=self.author, content='yay')
+        ConversationParticipant.objects.update(unread_message_count=0)
+        self.assertEqual(ConversationParticipant.objects.repair_unread_message_count(), 1)
+        self.assertEqual(self.get_unread_message_count(self.user), 1)
@@ -1,18 +1,18 @@
 from django.db.models.signals import post_save, pre_delete, post_init
 from django.dispatch import receiver
 
-from foodsaving.conversations.models import Conversation, ConversationParticipant
+from foodsaving.conversations.models import Conversation
 from foodsaving.groups import roles
 from foodsaving.groups.models import Group, GroupMembership
 
 
 @receiver(post_save, sender=Group)
-def group_created(**kwargs):
-    """Ensure every group has a conversation."""
-    group = kwargs.get('instance')
-    # TODO: limit this to only run on creation
-    conversation = Conversation.objects.get_or_create_for_target(group)
-    conversation.sync_users(group.members.all())
+def group_created(sender, instance, created, **kwargs):
+    """Ensure every group has a conversation with its members."""
+    if created:
+        group = instance
+        group.conversation = Conversation.objects.create(target=group)
+        group.conversation.sync_users(group.members.all())
 
 
 @receiver(pre_delete, sender=Group)
@@ -25,22 +25,18 @@ def group_deleted(**kwargs):
 
 
 @receiver(post_save, sender=GroupMembership)
-def group_member_added(sender, instance, **kwargs):
-    """When a user is removed from a conversation we will notify them."""
-    group = instance.group
-    user = instance.user
-    conversation = Conversation.objects.get_or_create_for_target(group)
-    conversation.join(user)
+def group_member_added(sender, instance, created, **kwargs):
+    """Add the new member to the group conversation."""
+    if created:
+        instance.group.conversation.add_users({instance.user_id})
 
 
 @receiver(pre_delete, sender=GroupMembership)
 def group_member_removed(sender, instance, **kwargs):
     """When a user is removed from a conversation we will notify them."""
-    group = instance.group
-    user = instance.user
-    conversation = Conversation.objects.get_for_target(group)
+    conversation = Conversation.objects.get_for_target(instance.group)
     if conversation:
-        ConversationParticipant.objects.filter(conversation=conversation, user=user).delete()
+        conversation.remove_users({instance.user_id})
 
 
 @receiver(post_init, sender=Group)
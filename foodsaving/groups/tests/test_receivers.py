@@ -1,8 +1,10 @@
+from unittest.mock import patch
+
 from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 from django.utils import timezone
 
-from foodsaving.conversations.models import Conversation
+from foodsaving.conversations.models import Conversation, participants_added, participants_removed
 from foodsaving.groups.factories import GroupFactory
 from foodsaving.groups.models import GroupMembership
 from foodsaving.users.factories import UserFactory
@@ -20,6 +22,12 @@ class TestConversationReceiver(TestCase):
         conversation = self.get_conversation_for_group(group)
         self.assertIsInstance(conversation, Conversation, 'Did not have a conversation')
 
+    def test_creates_conversation_only_once(self):
+        group = GroupFactory()
+        group.name = 'changed'
+        group.save()
+        self.assertEqual(Conversation.objects.filter(target_id=group.id).count(), 1)
+
     def test_conversation_deleted(self):
         group = GroupFactory()
         conversation_id = group.conversation.id
@@ -41,6 +49,51 @@ class TestConversationReceiver(TestCase):
         conversation = self.get_conversation_for_group(group)
         self.assertNotIn(user, conversation.participants.all(), 'Conversation still had user in')
 
+    def test_syncs_participants(self):
+        user = UserFactory()
+        group = GroupFactory()
+        added, removed = [], []
+
+        def receive(signal, user_ids, **kwargs):
+            (added if signal is participants_added else removed).append(user_ids)
+
+        participants_added.connect(receive)
+        participants_removed.connect(receive)
+        try:
+            GroupMembership.objects.create(group=group, user=user)
+            GroupMembership.objects.filter(group=group, user=user).delete()
+        finally:
+            participants_added.disconnect(receive)
+            participants_removed.disconnect(receive)
+        self.assertEqual(added, [{user.id}])
+        self.assertEqual(removed, [{user.id}])
+
+    def test_membership_change_does_not_sync_all_members(self):
+        group = GroupFactory(members=[UserFactory() for _ in range(3)])
+        user = UserFactory()
+        with patch('foodsaving.conversations.models.Conversation.sync_users') as sync_users:
+            GroupMembership.objects.create(group=group, user=user)
+            GroupMembership.objects.filter(group=group, user=user).delete()
+        sync_users.assert_not_called()
+
+    def test_editing_membership_keeps_participants(self):
+        user = UserFactory()
+        group = GroupFactory(members=[user])
+        added = []
+
+        def receive(user_ids, **kwargs):
+            added.append(user_ids)
+
+        participants_added.connect(receive)
+        try:
+            membership = GroupMembership.objects.get(group=group, user=user)
+            membership.add_roles(['editor'])
+            membership.save()
+        finally:
+            participants_added.disconnect(receive)
+        self.assertEqual(added, [])
+        self.assertIn(user, self.get_conversation_for_group(group).participants.all())
+
     def get_conversation_for_group(self, group):
         return Conversation.objects.filter(target_id=group.id,
                                            target_type=ContentType.objects.get_for_model(group)).first()
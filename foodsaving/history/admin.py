@@ -1,8 +1,13 @@
 from django.contrib import admin
 
-from foodsaving.history.models import History
+from foodsaving.history.models import History, HistoryArchive
 
 
 @admin.register(History)
 class HistoryAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(HistoryArchive)
+class HistoryArchiveAdmin(admin.ModelAdmin):
+    pass
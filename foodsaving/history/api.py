@@ -1,15 +1,17 @@
+from django.http import Http404
+from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets
+from rest_framework.decorators import list_route
 from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 
-from foodsaving.history.filters import HistoryFilter
-from foodsaving.history.models import History
+from foodsaving.history.filters import HistoryFilter, HistoryArchiveFilter
+from foodsaving.history.models import History, HistoryArchive
 from foodsaving.history.serializers import HistorySerializer
 
 
 class HistoryPagination(CursorPagination):
-    # TODO: create an index on 'date' for increased speed
     page_size = 10
     ordering = '-date'
 
@@ -26,4 +28,27 @@ class HistoryViewSet(viewsets.ReadOnlyModelViewSet):
     pagination_class = HistoryPagination
 
     def get_queryset(self):
+        if self.action == 'archive':
+            return self.get_archive_queryset()
         return self.queryset.filter(group__members=self.request.user)
+
+    def get_archive_queryset(self):
+        return HistoryArchive.objects.filter(group__members=self.request.user)
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            return get_object_or_404(self.get_archive_queryset(), pk=self.kwargs['pk'])
+
+    @list_route(
+        methods=['GET'],
+        filter_class=HistoryArchiveFilter
+    )
+    def archive(self, request):
+        """
+        Archived history entries, filtered and paginated like the list
+
+        They are older than all the other entries, clients continue here once the list has no next page.
+        """
+        return self.list(request)
@@ -4,7 +4,9 @@ from django.utils.encoding import force_str
 from django_filters.fields import RangeField
 from django_filters.rest_framework import filters, FilterSet, RangeFilter
 
-from foodsaving.history.models import HistoryTypus, History
+from django.contrib.auth import get_user_model
+
+from foodsaving.history.models import HistoryTypus, History, HistoryArchive
 
 
 class ISODateTimeField(forms.DateTimeField):
@@ -28,6 +30,12 @@ def filter_history_typus(qs, field, value):
     return qs.filter(**{field: getattr(HistoryTypus, value)})
 
 
+def filter_archived_users(qs, field, value):
+    if not value:
+        return qs
+    return qs.filter(**{field + '__overlap': [user.id for user in value]})
+
+
 class HistoryFilter(FilterSet):
     typus = filters.ChoiceFilter(choices=HistoryTypus.items(), method=filter_history_typus)
     date = DateTimeFromToRangeFilter(field_name='date')
@@ -36,3 +44,10 @@ class HistoryFilter(FilterSet):
         model = History
         fields = ('group', 'store', 'users', 'typus', 'date')
 
+
+class HistoryArchiveFilter(HistoryFilter):
+    # the archive keeps the ids of the users in an array
+    users = filters.ModelMultipleChoiceFilter(queryset=get_user_model().objects.all(), method=filter_archived_users)
+
+    class Meta(HistoryFilter.Meta):
+        model = HistoryArchive
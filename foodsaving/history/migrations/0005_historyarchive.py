@@ -0,0 +1,45 @@
+# Generated by Django 2.0.1 on 2026-10-18 21:18
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django_enumfield.db.fields
+import foodsaving.history.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0004_auto_20170701_1555'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateTimeField()),
+                ('typus', django_enumfield.db.fields.EnumField(default=0, enum=foodsaving.history.models.HistoryTypus)),
+                ('users', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                ('payload', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['group', 'date'], name='history_his_group_i_5c6b91_idx'),
+        ),
+        migrations.AddField(
+            model_name='historyarchive',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='groups.Group'),
+        ),
+        migrations.AddField(
+            model_name='historyarchive',
+            name='store',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stores.Store'),
+        ),
+    ]
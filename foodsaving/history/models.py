@@ -1,5 +1,8 @@
-from django.contrib.postgres.fields import JSONField
-from django.db import models
+from collections import defaultdict
+
+from django.contrib.postgres.fields import JSONField, ArrayField
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
 from django.dispatch import Signal
 from django.utils import timezone
 from django_enumfield import enum
@@ -30,7 +33,22 @@ class HistoryTypus(enum.Enum):
     PICKUP_MISSED = 16
 
 
-class HistoryManager(models.Manager):
+class HistoryQuerySet(models.QuerySet):
+    @transaction.atomic
+    def move_to_archive(self):
+        """Move the entries to HistoryArchive, returns how many got moved"""
+        entries = list(self.values('id', 'date', 'typus', 'group_id', 'store_id', 'payload'))
+        ids = [entry['id'] for entry in entries]
+        users = defaultdict(list)
+        for history_id, user_id in History.users.through.objects.filter(history__in=ids) \
+                .values_list('history_id', 'user_id'):
+            users[history_id].append(user_id)
+        HistoryArchive.objects.bulk_create(HistoryArchive(users=users[entry['id']], **entry) for entry in entries)
+        History.objects.filter(id__in=ids).delete()
+        return len(entries)
+
+
+class HistoryManager(models.Manager.from_queryset(HistoryQuerySet)):
     def create(self, typus, group, **kwargs):
         a = super().create(
             typus=typus,
@@ -42,12 +60,34 @@ class HistoryManager(models.Manager):
 
         history_created.send(sender=History.__class__, instance=a)
 
+    def create_many(self, entries):
+        """
+        like create, for many entries at once with a few queries
+
+        :param entries: list of (History, users) tuples, with the entries not saved yet
+        """
+        histories = self.bulk_create([history for history, _ in entries])
+        History.users.through.objects.bulk_create([
+            History.users.through(history_id=history.id, user_id=user.id)
+            for history, (_, users) in zip(histories, entries) for user in users
+        ])
+
+        # the receivers serialize the users
+        prefetch_related_objects(histories, 'users')
+        for history in histories:
+            history_created.send(sender=History.__class__, instance=history)
+        return histories
+
 
 class History(NicelyFormattedModel):
     objects = HistoryManager()
 
     class Meta:
         ordering = ['-date']
+        indexes = [
+            # for the latest entries of a group
+            models.Index(fields=['group', 'date']),
+        ]
 
     date = models.DateTimeField(default=timezone.now)
     typus = enum.EnumField(HistoryTypus)
@@ -59,3 +99,18 @@ class History(NicelyFormattedModel):
     def __str__(self):
         return 'History {} - {} ({})'.format(self.date, HistoryTypus.name(self.typus), self.group)
 
+
+class HistoryArchive(NicelyFormattedModel):
+    """Old entries, moved out of History to keep it small. See manage.py archive_old_rows"""
+
+    class Meta:
+        ordering = ['-date']
+
+    id = models.IntegerField(primary_key=True)
+    date = models.DateTimeField()
+    typus = enum.EnumField(HistoryTypus)
+    group = models.ForeignKey('groups.Group', related_name='+', on_delete=models.CASCADE)
+    store = models.ForeignKey('stores.Store', null=True, related_name='+', on_delete=models.CASCADE)
+    # ids of the users, saves keeping a many-to-many table for the archive
+    users = ArrayField(models.IntegerField())
+    payload = JSONField(null=True)
@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from rest_framework.fields import SerializerMethodField
 
-from foodsaving.history.models import History, HistoryTypus
+from foodsaving.history.models import History, HistoryTypus, HistoryArchive
 
 
 class HistorySerializer(serializers.ModelSerializer):
@@ -10,6 +10,12 @@ class HistorySerializer(serializers.ModelSerializer):
         fields = ['id', 'date', 'typus', 'group', 'store', 'users', 'payload']
 
     typus = SerializerMethodField()
+    users = SerializerMethodField()
 
     def get_typus(self, obj):
         return HistoryTypus.name(obj.typus)
+
+    def get_users(self, obj):
+        if isinstance(obj, HistoryArchive):
+            return obj.users
+        return [user.id for user in obj.users.all()]
@@ -0,0 +1,31 @@
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from foodsaving.conversations.models import ConversationMessage
+from foodsaving.history.models import History
+
+
+class Command(BaseCommand):
+    """
+    moves old conversation messages and history entries to their archive tables
+    keeps the tables which the API reads from small, call this regularly on the server, e.g. via cron-job
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help='archive rows older than this')
+        parser.add_argument('--batch-size', type=int, default=10000, help='rows to move per transaction')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - relativedelta(days=options['days'])
+        messages = ConversationMessage.objects.filter(created_at__lt=before)
+        history = History.objects.filter(date__lt=before)
+        for name, queryset in (('messages', messages), ('history entries', history)):
+            moved = 0
+            while True:
+                # one transaction per batch, to not block the tables for long
+                count = queryset.order_by('id')[:options['batch_size']].move_to_archive()
+                moved += count
+                if count < options['batch_size']:
+                    break
+            self.stdout.write('Archived {} {}'.format(moved, name))
@@ -1,13 +1,18 @@
 from django.core.management.base import BaseCommand
 
-from foodsaving.pickups.models import PickupDate
+from foodsaving.pickups.models import PickupDate, PROCESS_FINISHED_BATCH_SIZE
 
 
 class Command(BaseCommand):
     """
     triggers actions when pickup dates are finished
-    call this regularly on the server, e.g. via cron-job
+    call this regularly on the server, e.g. via cron-job, it's fine to run it on several servers at once
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PROCESS_FINISHED_BATCH_SIZE,
+                            help='pickup dates to process per transaction')
+
     def handle(self, *args, **options):
-        PickupDate.objects.process_finished_pickup_dates()
+        processed = PickupDate.objects.process_finished_pickup_dates(batch_size=options['batch_size'])
+        self.stdout.write('Processed {} pickup dates'.format(processed))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from foodsaving.pickups.models import PickupDate
+
+
+class Command(BaseCommand):
+    """
+    counts the collectors of all pickup dates from scratch and fixes the stored counts
+    e.g. after users got deleted, which removes them from the collectors without signals
+    """
+
+    def handle(self, *args, **options):
+        count = PickupDate.objects.repair_collector_count()
+        self.stdout.write('Repaired {} collector counts'.format(count))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from foodsaving.conversations.models import ConversationParticipant
+
+
+class Command(BaseCommand):
+    """
+    counts the unread messages of all conversation participants from scratch and fixes the stored counts
+    e.g. after deleting messages
+    """
+
+    def handle(self, *args, **options):
+        count = ConversationParticipant.objects.repair_unread_message_count()
+        self.stdout.write('Repaired {} unread message counts'.format(count))
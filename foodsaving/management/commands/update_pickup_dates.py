@@ -1,9 +1,62 @@
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from influxdb_metrics.loader import write_points
 
 from foodsaving.pickups.models import PickupDateSeries
 
 
+def update_pickup_dates_of(series_ids):
+    return PickupDateSeries.objects.update_pickup_dates_of(series_ids)
+
+
 class Command(BaseCommand):
+    """
+    creates the pickup dates which came into the period of their series since the last run
+    call this regularly on the server, e.g. via cron-job
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='number of processes to update the stores in')
 
     def handle(self, *args, **options):
-        PickupDateSeries.objects.create_all_pickup_dates()
+        start = time.perf_counter()
+
+        series_ids_by_store = defaultdict(list)
+        for series_id, store_id in PickupDateSeries.objects.due_for_update(timezone.now()).values_list('id', 'store'):
+            series_ids_by_store[store_id].append(series_id)
+        series_count = sum(len(series_ids) for series_ids in series_ids_by_store.values())
+
+        # one transaction per store, to not hold the locks of all pickup dates until the end
+        if options['processes'] > 1:
+            # the forked processes must open their own database connections
+            connections.close_all()
+            with Pool(options['processes']) as pool:
+                results = pool.map(update_pickup_dates_of, series_ids_by_store.values(), chunksize=1)
+        else:
+            results = [update_pickup_dates_of(series_ids) for series_ids in series_ids_by_store.values()]
+        created, updated, deleted = [sum(counts) for counts in zip((0, 0, 0), *results)]
+        seconds = time.perf_counter() - start
+
+        write_points([{
+            'measurement': 'pickup_dates_update',
+            'tags': {
+                'host': getattr(settings, 'INFLUXDB_TAGS_HOST', ''),
+            },
+            'fields': {
+                'stores': len(series_ids_by_store),
+                'series': series_count,
+                'created': created,
+                'updated': updated,
+                'deleted': deleted,
+                'ms': seconds * 1000,
+            },
+        }])
+        self.stdout.write('Updated {} series of {} stores in {:.2f}s: {} created, {} updated, {} deleted'.format(
+            series_count, len(series_ids_by_store), seconds, created, updated, deleted
+        ))
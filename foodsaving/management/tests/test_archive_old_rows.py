@@ -0,0 +1,136 @@
+from io import StringIO
+from unittest.mock import patch
+
+from dateutil.relativedelta import relativedelta
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from foodsaving.conversations.factories import ConversationFactory
+from foodsaving.conversations.models import ConversationMessage, ConversationMessageArchive, ConversationParticipant
+from foodsaving.groups.factories import GroupFactory
+from foodsaving.history.models import History, HistoryArchive, HistoryTypus
+from foodsaving.users.factories import UserFactory
+
+
+class TestArchiveOldRowsCommand(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.author = UserFactory()
+        self.conversation = ConversationFactory()
+        self.conversation.join(self.user)
+        self.conversation.join(self.author)
+        self.group = GroupFactory(members=[self.user])
+        self.old = timezone.now() - relativedelta(years=2)
+
+    def test_archives_old_messages(self):
+        old_messages = [self.conversation.messages.create(author=self.author, content='old') for _ in range(3)]
+        self.conversation.messages.create(author=self.author, content='new')
+        ConversationMessage.objects.filter(content='old').update(created_at=self.old)
+        participant = ConversationParticipant.objects.get(conversation=self.conversation, user=self.user)
+        participant.set_seen_up_to(old_messages[-1])
+
+        out = StringIO()
+        call_command('archive_old_rows', '--batch-size=2', stdout=out)
+
+        self.assertIn('Archived 3 messages', out.getvalue())
+        self.assertEqual([m.content for m in ConversationMessage.objects.all()], ['new'])
+        archived = ConversationMessageArchive.objects.order_by('id')
+        self.assertEqual([m.id for m in archived], [m.id for m in old_messages])
+        self.assertEqual(archived[0].created_at, self.old)
+        # all the messages the participant hasn't seen are still there
+        participant.refresh_from_db()
+        self.assertIsNone(participant.seen_up_to_id)
+        self.assertEqual(participant.unread_message_count, 1)
+
+    def test_archives_old_history(self):
+        History.objects.create(typus=HistoryTypus.GROUP_JOIN, group=self.group, users=[self.user, self.author])
+        History.objects.update(date=self.old)
+        History.objects.create(typus=HistoryTypus.GROUP_MODIFY, group=self.group, users=[self.user])
+
+        out = StringIO()
+        call_command('archive_old_rows', stdout=out)
+
+        self.assertIn('Archived 1 history entries', out.getvalue())
+        self.assertEqual(History.objects.get().typus, HistoryTypus.GROUP_MODIFY)
+        archived = HistoryArchive.objects.get()
+        self.assertEqual(archived.typus, HistoryTypus.GROUP_JOIN)
+        self.assertEqual(archived.date, self.old)
+        self.assertEqual(set(archived.users), {self.user.id, self.author.id})
+
+
+class TestReadArchivedRowsAPI(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.conversation = ConversationFactory()
+        self.conversation.join(self.user)
+        self.group = GroupFactory(members=[self.user])
+        self.client.force_login(user=self.user)
+        self.old = timezone.now() - relativedelta(years=2)
+
+    def create_messages(self):
+        old_messages = [self.conversation.messages.create(author=self.user, content='old apples') for _ in range(3)]
+        new_messages = [self.conversation.messages.create(author=self.user, content='new apples') for _ in range(2)]
+        ConversationMessage.objects.filter(content='old apples').update(created_at=self.old)
+        call_command('archive_old_rows', stdout=StringIO())
+        return old_messages, new_messages
+
+    def get_all(self, url, params):
+        ids = []
+        response = self.client.get(url, params)
+        ids += [row['id'] for row in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [row['id'] for row in response.data['results']]
+        return ids
+
+    def test_list_archived_messages(self):
+        old_messages, new_messages = self.create_messages()
+        with patch('foodsaving.conversations.api.MessagePagination.page_size', 2):
+            ids = self.get_all('/api/messages/', {'conversation': self.conversation.id})
+            self.assertEqual(ids, [m.id for m in reversed(new_messages)])
+            ids = self.get_all('/api/messages/archive/', {'conversation': self.conversation.id, 'before': ids[-1]})
+            self.assertEqual(ids, [m.id for m in reversed(old_messages)])
+
+    def test_list_archived_messages_after_message(self):
+        old_messages, new_messages = self.create_messages()
+        response = self.client.get('/api/messages/archive/', {
+            'conversation': self.conversation.id,
+            'after': old_messages[0].id,
+        })
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in old_messages[1:]])
+
+    def test_list_archived_messages_only_of_own_conversations(self):
+        self.create_messages()
+        self.client.force_login(user=UserFactory())
+        response = self.client.get('/api/messages/archive/')
+        self.assertEqual(response.data['results'], [])
+
+    def test_search_archived_messages(self):
+        old_messages, new_messages = self.create_messages()
+        response = self.client.get('/api/messages/search/', {'q': 'apples'})
+        self.assertEqual(sorted(m['id'] for m in response.data['results']), [m.id for m in new_messages])
+        response = self.client.get('/api/messages/archive/search/', {'q': 'apples'})
+        self.assertEqual(sorted(m['id'] for m in response.data['results']), [m.id for m in old_messages])
+
+    def test_list_archived_history(self):
+        other_user = UserFactory()
+        History.objects.create(typus=HistoryTypus.GROUP_JOIN, group=self.group, users=[self.user, other_user])
+        History.objects.update(date=self.old)
+        History.objects.create(typus=HistoryTypus.GROUP_MODIFY, group=self.group, users=[self.user])
+        call_command('archive_old_rows', stdout=StringIO())
+        archived = HistoryArchive.objects.get()
+
+        response = self.client.get('/api/history/')
+        self.assertEqual([h['typus'] for h in response.data['results']], ['GROUP_MODIFY'])
+        response = self.client.get('/api/history/archive/')
+        self.assertEqual([h['typus'] for h in response.data['results']], ['GROUP_JOIN'])
+        self.assertEqual(set(response.data['results'][0]['users']), {self.user.id, other_user.id})
+
+        response = self.client.get('/api/history/archive/', {'users': self.user.id})
+        self.assertEqual([h['id'] for h in response.data['results']], [archived.id])
+        response = self.client.get('/api/history/archive/', {'typus': 'GROUP_MODIFY'})
+        self.assertEqual(response.data['results'], [])
+
+        response = self.client.get('/api/history/{}/'.format(archived.id))
+        self.assertEqual(response.data['typus'], 'GROUP_JOIN')
@@ -1,11 +1,18 @@
+import threading
+from io import StringIO
+
 from dateutil.relativedelta import relativedelta
 from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
-from foodsaving.history.models import History
+from foodsaving.history.models import History, HistoryTypus
 from foodsaving.pickups.factories import PickupDateFactory
 from foodsaving.pickups.models import PickupDate
+from foodsaving.stores.factories import StoreFactory
+from foodsaving.users.factories import UserFactory
 
 
 class TestProcessFinishedPickupDatesCommand(APITestCase):
@@ -16,3 +23,56 @@ class TestProcessFinishedPickupDatesCommand(APITestCase):
         call_command('process_finished_pickup_dates')
         self.assertEqual(PickupDate.objects.count(), 1)
         self.assertEqual(History.objects.count(), 1)
+
+    def test_processes_in_batches(self):
+        store = StoreFactory()
+        users = [UserFactory() for _ in range(2)]
+        for _ in range(4):
+            PickupDateFactory(store=store, date=timezone.now() - relativedelta(days=1), collectors=users)
+
+        out = StringIO()
+        call_command('process_finished_pickup_dates', batch_size=2, stdout=out)
+        self.assertIn('Processed 5 pickup dates', out.getvalue())
+        self.assertFalse(PickupDate.objects.filter(done_and_processed=False).exists())
+        self.assertEqual(History.objects.filter(typus=HistoryTypus.PICKUP_MISSED).count(), 1)
+        done = History.objects.filter(typus=HistoryTypus.PICKUP_DONE)
+        self.assertEqual(done.count(), 4)
+        for history in done:
+            self.assertEqual(set(history.users.all()), set(users))
+
+    def test_query_count_does_not_depend_on_pickup_dates(self):
+        store = StoreFactory()
+        users = [UserFactory() for _ in range(2)]
+        for _ in range(10):
+            PickupDateFactory(store=store, date=timezone.now() - relativedelta(days=1), collectors=users)
+
+        with self.assertNumQueries(13):
+            PickupDate.objects.process_finished_pickup_dates()
+
+
+class TestProcessFinishedPickupDatesConcurrently(TransactionTestCase):
+    def test_skips_pickup_dates_which_are_locked(self):
+        locked, free = [PickupDateFactory(date=timezone.now() - relativedelta(days=1)) for _ in range(2)]
+        is_locked = threading.Event()
+        release = threading.Event()
+
+        def lock():
+            # another worker, in the middle of processing a batch
+            with transaction.atomic():
+                list(PickupDate.objects.filter(id=locked.id).select_for_update())
+                is_locked.set()
+                release.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=lock)
+        thread.start()
+        try:
+            is_locked.wait(10)
+            self.assertEqual(PickupDate.objects.process_finished_pickup_dates(), 1)
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(set(PickupDate.objects.filter(done_and_processed=True)), {free})
+        self.assertEqual(PickupDate.objects.process_finished_pickup_dates(), 1)
+        self.assertEqual(History.objects.count(), 2)
@@ -0,0 +1,27 @@
+from io import StringIO
+
+from django.core.management import call_command
+from rest_framework.test import APITestCase
+
+from foodsaving.pickups.factories import PickupDateFactory
+from foodsaving.pickups.models import PickupDate
+from foodsaving.users.factories import UserFactory
+
+
+class TestRepairCollectorCountsCommand(APITestCase):
+    def setUp(self):
+        self.pickup = PickupDateFactory(collectors=[UserFactory(), UserFactory()])
+        self.empty_pickup = PickupDateFactory()
+
+    def test_run_command(self):
+        PickupDate.objects.update(collector_count=7)
+        out = StringIO()
+        call_command('repair_collector_counts', stdout=out)
+        self.assertEqual(out.getvalue(), 'Repaired 2 collector counts\n')
+        self.assertEqual(PickupDate.objects.get(id=self.pickup.id).collector_count, 2)
+        self.assertEqual(PickupDate.objects.get(id=self.empty_pickup.id).collector_count, 0)
+
+    def test_leaves_correct_counts(self):
+        out = StringIO()
+        call_command('repair_collector_counts', stdout=out)
+        self.assertEqual(out.getvalue(), 'Repaired 0 collector counts\n')
@@ -0,0 +1,32 @@
+from io import StringIO
+
+from django.core.management import call_command
+from rest_framework.test import APITestCase
+
+from foodsaving.conversations.factories import ConversationFactory
+from foodsaving.conversations.models import ConversationParticipant
+from foodsaving.users.factories import UserFactory
+
+
+class TestRepairUnreadMessageCountsCommand(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.author = UserFactory()
+        self.conversation = ConversationFactory()
+        self.conversation.join(self.user)
+        self.conversation.join(self.author)
+        for _ in range(3):
+            self.conversation.messages.create(author=self.author, content='yay')
+
+    def test_run_command(self):
+        ConversationParticipant.objects.update(unread_message_count=7)
+        out = StringIO()
+        call_command('repair_unread_message_counts', stdout=out)
+        self.assertEqual(out.getvalue(), 'Repaired 2 unread message counts\n')
+        self.assertEqual(ConversationParticipant.objects.get(user=self.user).unread_message_count, 3)
+        self.assertEqual(ConversationParticipant.objects.get(user=self.author).unread_message_count, 0)
+
+    def test_leaves_correct_counts(self):
+        out = StringIO()
+        call_command('repair_unread_message_counts', stdout=out)
+        self.assertEqual(out.getvalue(), 'Repaired 0 unread message counts\n')
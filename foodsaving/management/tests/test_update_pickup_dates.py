@@ -1,8 +1,14 @@
+from io import StringIO
+
+from dateutil.relativedelta import relativedelta
 from django.core.management import call_command
+from django.test import TransactionTestCase
+from django.utils import timezone
 from rest_framework.test import APITestCase
 
 from foodsaving.pickups.factories import PickupDateSeriesFactory
-from foodsaving.pickups.models import PickupDate
+from foodsaving.pickups.models import PickupDate, PickupDateSeries
+from foodsaving.stores.factories import StoreFactory
 
 
 class TestUpdatePickupDatesCommand(APITestCase):
@@ -13,3 +19,63 @@ class TestUpdatePickupDatesCommand(APITestCase):
         # remember to also call this regularly on the server, e.g. via cron-job
         call_command('update_pickup_dates')
         self.assertGreater(PickupDate.objects.count(), 0)
+
+    def test_creates_missing_pickup_dates(self):
+        self.series.pickup_dates.all().delete()
+        PickupDateSeries.objects.filter(id=self.series.id).update(next_date_beyond_period=None)
+
+        out = StringIO()
+        call_command('update_pickup_dates', stdout=out)
+        self.assertEqual(self.series.pickup_dates.count(), 4)
+        self.assertIn('Updated 1 series of 1 stores', out.getvalue())
+        self.assertIn('4 created, 0 updated, 0 deleted', out.getvalue())
+
+    def test_remembers_next_date_of_series(self):
+        self.series.refresh_from_db()
+        tz = self.series.store.group.timezone
+        start_date = self.series.start_date.astimezone(tz).replace(tzinfo=None)
+        self.assertEqual(self.series.next_date_beyond_period, tz.localize(start_date + relativedelta(weeks=4)))
+
+    def test_skips_series_until_their_period_reaches_the_next_date(self):
+        now = timezone.now()
+        PickupDateSeries.objects.update(next_date_beyond_period=now + relativedelta(weeks=5))
+        self.assertFalse(PickupDateSeries.objects.due_for_update(now).exists())
+
+        PickupDateSeries.objects.update(next_date_beyond_period=now + relativedelta(weeks=3))
+        self.assertEqual(list(PickupDateSeries.objects.due_for_update(now)), [self.series])
+
+    def test_skips_series_without_more_dates(self):
+        now = timezone.now()
+        series = PickupDateSeriesFactory(rule='FREQ=WEEKLY;COUNT=2')
+        series.refresh_from_db()
+        self.assertTrue(series.rule_exhausted)
+        self.assertIsNone(series.next_date_beyond_period)
+        self.assertNotIn(series, PickupDateSeries.objects.due_for_update(now))
+
+        series.rule = 'FREQ=WEEKLY'
+        series.save()
+        series.refresh_from_db()
+        self.assertFalse(series.rule_exhausted)
+        self.assertIsNotNone(series.next_date_beyond_period)
+
+    def test_updates_series_of_several_stores(self):
+        other = PickupDateSeriesFactory(store=StoreFactory(group=self.series.store.group))
+        PickupDateSeries.objects.update(next_date_beyond_period=None)
+
+        out = StringIO()
+        call_command('update_pickup_dates', stdout=out)
+        self.assertIn('Updated 2 series of 2 stores', out.getvalue())
+        self.assertEqual(other.pickup_dates.count(), 4)
+
+
+class TestUpdatePickupDatesCommandProcesses(TransactionTestCase):
+    def test_updates_stores_in_processes(self):
+        series = [PickupDateSeriesFactory() for _ in range(3)]
+        PickupDate.objects.all().delete()
+        PickupDateSeries.objects.update(next_date_beyond_period=None)
+
+        out = StringIO()
+        call_command('update_pickup_dates', processes=2, stdout=out)
+        self.assertIn('12 created', out.getvalue())
+        for s in series:
+            self.assertEqual(s.pickup_dates.count(), 4)
@@ -35,10 +35,11 @@ class PickupDatesFilter(FilterSet):
     group = NumberFilter(field_name='store__group__id')
     date = DateTimeFromToRangeFilter(field_name='date')
     feedback_possible = BooleanFilter(method='filter_feedback_possible')
+    has_free_places = BooleanFilter(method='filter_has_free_places')
 
     class Meta:
         model = PickupDate
-        fields = ['store', 'group', 'date', 'series', 'feedback_possible']
+        fields = ['store', 'group', 'date', 'series', 'feedback_possible', 'has_free_places']
 
     def filter_feedback_possible(self, qs, name, value):
         q = self.Meta.model.objects.feedback_possible_q(self.request.user)
@@ -46,6 +47,12 @@ class PickupDatesFilter(FilterSet):
             return qs.filter(q)
         return qs.filter(~q)
 
+    def filter_has_free_places(self, qs, name, value):
+        q = self.Meta.model.objects.has_free_places_q()
+        if value is True:
+            return qs.filter(q)
+        return qs.filter(~q)
+
 
 class FeedbackFilter(FilterSet):
     group = NumberFilter(field_name='about__store__group__id')
@@ -0,0 +1,86 @@
+import time
+
+import dateutil.rrule
+import pytz
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from foodsaving.groups.models import Group
+from foodsaving.pickups.models import PickupDateSeries, parse_rule, PICKUP_DATES_START_DELAY
+from foodsaving.stores.models import Store
+
+RULES = [
+    'FREQ=WEEKLY',
+    'FREQ=WEEKLY;BYDAY=MO,WE,FR',
+    'FREQ=WEEKLY;BYDAY=SA',
+    'FREQ=WEEKLY;INTERVAL=2;BYDAY=TU',
+    'FREQ=WEEKLY;INTERVAL=3;BYDAY=MO,TH;WKST=SU',
+    'FREQ=WEEKLY;COUNT=100',
+    'FREQ=DAILY',
+    'FREQ=DAILY;INTERVAL=3',
+    'FREQ=MONTHLY;BYMONTHDAY=1,15',
+]
+
+TIMEZONES = ['Europe/Berlin', 'America/New_York', 'Asia/Kolkata']
+
+
+def expand_uncached(series, start_date):
+    """like update_pickup_dates did before: parse the rule for each expansion and start at the series start"""
+    tz = series.store.group.timezone
+    period_start = start_date.astimezone(tz).replace(tzinfo=None)
+    period_end = period_start + relativedelta(weeks=series.store.weeks_in_advance)
+    dtstart = series.start_date.astimezone(tz).replace(tzinfo=None)
+    dates = dateutil.rrule.rrulestr(series.rule).replace(dtstart=dtstart).between(period_start, period_end)
+    next_date = dateutil.rrule.rrulestr(series.rule).replace(dtstart=dtstart).after(period_end, inc=True)
+    return [tz.localize(d) for d in dates], next_date and tz.localize(next_date)
+
+
+def expand(series, start_date):
+    return series.get_period_dates(start_date)
+
+
+class Command(BaseCommand):
+    """
+    Measures how long it takes to expand the rules of many series into their dates, like the update_pickup_dates
+    command does, compared to parsing the rules every time and going through them from the start of the series.
+    The series only exist in memory, with start dates up to two years ago, the database is not involved.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--series', type=int, default=10000)
+        parser.add_argument('--rounds', type=int, default=3)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        groups = [Group(name=name, timezone=pytz.timezone(name)) for name in TIMEZONES]
+        stores = [Store(group=group, weeks_in_advance=4) for group in groups]
+        all_series = [
+            PickupDateSeries(
+                store=stores[i % len(stores)],
+                rule=RULES[i % len(RULES)],
+                start_date=now - relativedelta(days=i % 730, minutes=i % 1440),
+            ) for i in range(options['series'])
+        ]
+        start_date = now + PICKUP_DATES_START_DELAY
+        self.stdout.write('{} series, {} rules, {} time zones, {} rounds'.format(
+            len(all_series), len(RULES), len(TIMEZONES), options['rounds']
+        ))
+
+        def measure(name, f):
+            start = time.perf_counter()
+            for _ in range(options['rounds']):
+                for series in all_series:
+                    f(series, start_date)
+            per_round = (time.perf_counter() - start) / options['rounds'] * 1000
+            self.stdout.write('{:<30} {:10.1f} ms per round'.format(name, per_round))
+
+        # both ways need to give the same dates
+        for series in all_series:
+            if expand(series, start_date) != expand_uncached(series, start_date):
+                raise CommandError('{} gives different dates'.format(series))
+
+        parse_rule.cache_clear()
+        measure('parse every time', expand_uncached)
+        measure('parsed once, late start', expand)
+        self.stdout.write('parsed rules: {}'.format(parse_rule.cache_info()))
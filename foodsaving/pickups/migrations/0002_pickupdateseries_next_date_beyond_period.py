@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 21:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pickups', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pickupdateseries',
+            name='next_date_beyond_period',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.1 on 2026-10-18 21:59
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Count, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+
+
+def count_collectors(apps, schema_editor):
+    pickup_date_model = apps.get_model('pickups', 'PickupDate')
+    collectors = pickup_date_model.collectors.through.objects.filter(pickupdate=OuterRef('id')) \
+        .order_by().values('pickupdate').annotate(count=Count('id')).values('count')
+    pickup_date_model.objects.update(collector_count=Coalesce(Subquery(collectors, output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pickups', '0002_pickupdateseries_next_date_beyond_period'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pickupdate',
+            name='collector_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_collectors, migrations.RunPython.noop, elidable=True),
+    ]
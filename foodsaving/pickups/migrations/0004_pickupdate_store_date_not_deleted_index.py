@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    The pickup date list is filtered by store and ordered by date, without the deleted ones
+
+    Django 2.0 can't declare partial indexes in Meta.indexes yet, so it's created with SQL.
+    """
+
+    dependencies = [
+        ('pickups', '0003_pickupdate_collector_count'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX pickups_pickupdate_store_date_not_deleted '
+            'ON pickups_pickupdate (store_id, date) WHERE NOT deleted',
+            'DROP INDEX pickups_pickupdate_store_date_not_deleted',
+        ),
+    ]
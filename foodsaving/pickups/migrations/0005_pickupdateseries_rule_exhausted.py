@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 22:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pickups', '0004_pickupdate_store_date_not_deleted_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pickupdateseries',
+            name='rule_exhausted',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from datetime import timedelta
+from functools import lru_cache
 from itertools import zip_longest
 
 import dateutil.rrule
@@ -8,7 +10,9 @@ from django.contrib.postgres.fields import JSONField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
 from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import Count, Q, Case, When, Value, F, ExpressionWrapper, DateTimeField, DurationField, \
+    OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
 from django.dispatch import Signal
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -18,12 +22,108 @@ from foodsaving.history.models import History, HistoryTypus
 
 pickup_done = Signal()
 
+# sent by PickupDateSeries.update_pickup_dates, with the lists of created, updated and deleted pickup dates,
+# instead of signals for each PickupDate
+series_pickup_dates_updated = Signal()
+
+# pickup dates start a bit in the future, to avoid pickup dates which are only valid for a very short time
+PICKUP_DATES_START_DELAY = relativedelta(minutes=5)
+
+# how many finished pickup dates to process in one transaction
+PROCESS_FINISHED_BATCH_SIZE = 100
+
+
+@lru_cache(maxsize=1024)
+def parse_rule(rule):
+    """many series share the same rule, e.g. every monday"""
+    return dateutil.rrule.rrulestr(rule)
+
+
+# daily and weekly rules repeat after their interval, so they can start later by a multiple of it
+RULE_STEPS = {
+    'DAILY': timedelta(days=1),
+    'WEEKLY': timedelta(weeks=1),
+}
+
+
+@lru_cache(maxsize=1024)
+def get_rule_step(rule):
+    """
+    how much later the rule can start and still give the same dates, None if that's not known
+
+    read from the text of the rule, as rrule keeps its frequency, interval and count to itself
+    """
+    params = None
+    for line in rule.upper().split():
+        name, _, value = line.rpartition(':')
+        if name.startswith('DTSTART'):
+            continue
+        if name not in ('', 'RRULE') or params is not None:
+            # a set of rules and dates
+            return None
+        params = dict(part.partition('=')[::2] for part in value.split(';'))
+    if params is None or 'COUNT' in params or params.get('FREQ') not in RULE_STEPS:
+        return None
+    return RULE_STEPS[params['FREQ']] * int(params.get('INTERVAL', 1))
+
+
+def get_rule_start(rule, start_date, period_start):
+    """
+    the latest start on or before period_start which gives the same dates from there on as start_date
+
+    starting late avoids going through all the dates of the series before the period, which takes a while for
+    series which have been running for a long time
+    """
+    step = get_rule_step(rule)
+    if step is None or start_date >= period_start:
+        return start_date
+    return start_date + (period_start - start_date) // step * step
+
+
+def get_period_dates(rule, start_date, tz, period_start, weeks):
+    """the dates of a series within the period of the given number of weeks, and the first date after it"""
+    # using local time zone to avoid daylight saving time errors
+    start_date = start_date.astimezone(tz).replace(tzinfo=None)
+    period_start = period_start.astimezone(tz).replace(tzinfo=None)
+    period_end = period_start + relativedelta(weeks=weeks)
+    dates = []
+    for date in parse_rule(rule).replace(dtstart=get_rule_start(rule, start_date, period_start)):
+        if date >= period_end:
+            return [tz.localize(d) for d in dates], tz.localize(date)
+        if date > period_start:
+            dates.append(date)
+    return [tz.localize(d) for d in dates], None
+
 
 class PickupDateSeriesManager(models.Manager):
-    @transaction.atomic
-    def create_all_pickup_dates(self):
-        for series in self.all():
-            series.update_pickup_dates()
+    def due_for_update(self, now):
+        """
+        series which get new pickup dates, because their period reached the next date of their rule
+
+        series we don't know the next date of are always due, e.g. if they have not been updated yet.
+        series whose rule has no more dates are never due, until their rule changes
+        """
+        # one hour later, to not miss dates because of daylight saving time changes within the period
+        period_end = ExpressionWrapper(
+            Value(now + PICKUP_DATES_START_DELAY + relativedelta(hours=1), output_field=DateTimeField()) +
+            F('store__weeks_in_advance') * Value(timedelta(weeks=1), output_field=DurationField()),
+            output_field=DateTimeField()
+        )
+        return self.annotate(period_end=period_end).filter(
+            Q(next_date_beyond_period=None, rule_exhausted=False) | Q(next_date_beyond_period__lte=F('period_end'))
+        )
+
+    def update_pickup_dates_of(self, series_ids):
+        """
+        update the pickup dates of some series in one transaction
+
+        :return: tuple of the number of created, updated and deleted pickup dates
+        """
+        counts = [0, 0, 0]
+        with transaction.atomic():
+            for series in self.filter(id__in=series_ids).select_related('store__group'):
+                counts = [total + count for total, count in zip(counts, series.update_pickup_dates())]
+        return tuple(counts)
 
 
 class PickupDateSeries(BaseModel):
@@ -39,31 +139,34 @@ class PickupDateSeries(BaseModel):
     start_date = models.DateTimeField()
     description = models.TextField(blank=True)
 
+    # the first date of the rule which has no pickup date yet, because it was beyond the period
+    next_date_beyond_period = models.DateTimeField(null=True, editable=False)
+    # the rule has no dates beyond the period anymore, e.g. because of its COUNT or UNTIL
+    rule_exhausted = models.BooleanField(default=False, editable=False)
+
     @transaction.atomic
     def delete(self, *args, **kwargs):
         for pickup in self.pickup_dates.\
                 filter(date__gte=timezone.now()).\
-                annotate(Count('collectors')).\
-                filter(collectors__count=0):
+                filter(collector_count=0):
             pickup.deleted = True
             pickup.save()
         return super().delete(*args, **kwargs)
 
     def get_dates_for_rule(self, start_date):
-        # using local time zone to avoid daylight saving time errors
-        tz = self.store.group.timezone
-        period_start = start_date.astimezone(tz).replace(tzinfo=None)
-        start_date = self.start_date.astimezone(tz).replace(tzinfo=None)
-        dates = dateutil.rrule.rrulestr(
-            self.rule
-        ).replace(
-            dtstart=start_date
-        ).between(
-            period_start,
-            period_start + relativedelta(weeks=self.store.weeks_in_advance)
-        )
-        return [tz.localize(d) for d in dates]
+        dates, _ = self.get_period_dates(start_date)
+        return dates
+
+    def get_period_dates(self, start_date):
+        """
+        the dates of the rule within the period starting at start_date, and the first date after the period
 
+        the first date is None if the rule has no more dates
+        """
+        return get_period_dates(self.rule, self.start_date, self.store.group.timezone, start_date,
+                                self.store.weeks_in_advance)
+
+    @transaction.atomic
     def update_pickup_dates(self, start=timezone.now):
         """
         synchronizes the pickup dates with the series
@@ -71,37 +174,71 @@ class PickupDateSeries(BaseModel):
         changes to the series fields are also made to the pickup dates, except for
         - the field on the pickup date has been modified
         - users have joined the pickup date
+
+        the changes get written in bulk, receivers learn about them through series_pickup_dates_updated
+
+        :return: tuple of the number of created, updated and deleted pickup dates
         """
 
-        # shift start time slightly into future to avoid pickup dates which are only valid for very short time
-        start_date = start() + relativedelta(minutes=5)
+        start_date = start() + PICKUP_DATES_START_DELAY
 
-        for pickup, new_date in zip_longest(
-            self.pickup_dates.filter(date__gte=start_date),
-            self.get_dates_for_rule(start_date=start_date)
-        ):
+        new_dates, next_date = self.get_period_dates(start_date)
+        created, updated, deleted = [], [], []
+        for pickup, new_date in zip_longest(self.pickup_dates.filter(date__gte=start_date), new_dates):
             if not pickup:
                 # does not yet exist
-                PickupDate.objects.create(
+                created.append(PickupDate(
                     date=new_date,
                     max_collectors=self.max_collectors,
                     series=self,
                     store=self.store,
                     description=self.description
-                )
-            elif pickup.collectors.count() < 1:
+                ))
+            elif pickup.collector_count < 1:
                 # only modify pickups when nobody has joined
                 if not new_date:
                     # series changed and now this pickup should not exist anymore
-                    pickup.delete()
+                    deleted.append(pickup)
                 else:
+                    values = {}
                     if not pickup.is_date_changed:
-                        pickup.date = new_date
+                        values['date'] = new_date
                     if not pickup.is_max_collectors_changed:
-                        pickup.max_collectors = self.max_collectors
+                        values['max_collectors'] = self.max_collectors
                     if not pickup.is_description_changed:
-                        pickup.description = self.description
-                    pickup.save()
+                        values['description'] = self.description
+                    if any(getattr(pickup, name) != value for name, value in values.items()):
+                        for name, value in values.items():
+                            setattr(pickup, name, value)
+                        updated.append(pickup)
+
+        if len(created) > 0:
+            PickupDate.objects.bulk_create(created)
+        if len(updated) > 0:
+            PickupDate.objects.bulk_update(updated, ['date', 'max_collectors', 'description'])
+        if len(deleted) > 0:
+            PickupDate.objects.filter(id__in=[pickup.id for pickup in deleted]).delete()
+
+        if len(created) + len(updated) + len(deleted) > 0:
+            series_pickup_dates_updated.send(
+                sender=PickupDateSeries,
+                instance=self,
+                created=created,
+                updated=updated,
+                deleted=deleted,
+            )
+
+        # remember when the series needs to be updated next, see due_for_update
+        rule_exhausted = next_date is None
+        if next_date != self.next_date_beyond_period or rule_exhausted != self.rule_exhausted:
+            self.next_date_beyond_period = next_date
+            self.rule_exhausted = rule_exhausted
+            PickupDateSeries.objects.filter(id=self.id).update(
+                next_date_beyond_period=next_date,
+                rule_exhausted=rule_exhausted,
+            )
+
+        return len(created), len(updated), len(deleted)
 
     def __str__(self):
         return 'PickupDateSeries {} - {}'.format(self.rule, self.store)
@@ -111,45 +248,97 @@ class PickupDateSeries(BaseModel):
         self.update_pickup_dates()
 
 
-class PickupDateManager(models.Manager):
-    @transaction.atomic
-    def process_finished_pickup_dates(self):
-        """find all pickup dates that are in the past and didn't get processed yet and add them to history
+def count_collectors():
+    collectors = PickupDate.collectors.through.objects.filter(pickupdate=OuterRef('id')) \
+        .order_by().values('pickupdate').annotate(count=Count('id')).values('count')
+    return Coalesce(Subquery(collectors, output_field=IntegerField()), 0)
+
+
+class PickupDateQuerySet(models.QuerySet):
+    def annotate_actual_collector_count(self):
+        """Count the collectors from scratch, to check the stored collector_count"""
+        return self.annotate(actual_collector_count=count_collectors())
+
+    def update_collector_count(self):
+        self.update(collector_count=count_collectors())
+
+    def repair_collector_count(self):
+        """Fix collector_count where it went wrong, returns how many pickup dates got fixed"""
+        broken = list(self.annotate_actual_collector_count()
+                      .exclude(collector_count=F('actual_collector_count')).values_list('id', flat=True))
+        self.filter(id__in=broken).update_collector_count()
+        return len(broken)
+
+    def has_free_places_q(self):
+        return Q(max_collectors=None) | Q(max_collectors=0) | Q(collector_count__lt=F('max_collectors'))
+
+
+class PickupDateManager(models.Manager.from_queryset(PickupDateQuerySet)):
+    def bulk_update(self, pickups, fields):
+        """write the fields of many pickup dates with one query, like QuerySet.bulk_update of later django versions"""
+        def values(name):
+            field = self.model._meta.get_field(name)
+            whens = [When(id=pickup.id, then=Value(getattr(pickup, name), output_field=field)) for pickup in pickups]
+            return Case(*whens, default=F(name), output_field=field)
+
+        self.filter(id__in=[pickup.id for pickup in pickups]).update(**{name: values(name) for name in fields})
+
+    def process_finished_pickup_dates(self, batch_size=PROCESS_FINISHED_BATCH_SIZE):
+        """
+        find all pickup dates that are in the past and didn't get processed yet and add them to history
+
+        works through them in batches with a transaction each, to not block other writers for long.
+        several processes can run this at the same time, they skip the batches the others are working on.
+
+        :return: the number of processed pickup dates
         """
-        for pickup in self.filter(
-                done_and_processed=False,
-                date__lt=timezone.now(),
-                deleted=False,
-        ):
+        processed = 0
+        while True:
+            with transaction.atomic():
+                count = self._process_finished_batch(batch_size)
+            processed += count
+            if count < batch_size:
+                return processed
+
+    def _process_finished_batch(self, batch_size):
+        pickups = list(self.filter(
+            done_and_processed=False,
+            date__lt=timezone.now(),
+            deleted=False,
+        ).select_for_update(
+            # only lock the pickup dates, other processes might be working on pickups of the same store
+            skip_locked=True, of=('self',)
+        ).select_related('store').prefetch_related(
+            # each group only once, as initializing a group takes queries
+            'store__group', 'collectors'
+        ).order_by('date')[:batch_size])
+
+        entries = []
+        for pickup in pickups:
             if pickup.store.is_active():
                 payload = {}
                 payload['pickup_date'] = pickup.id
-                if pickup.series:
-                    payload['series'] = pickup.series.id
+                if pickup.series_id:
+                    payload['series'] = pickup.series_id
                 if pickup.max_collectors:
                     payload['max_collectors'] = pickup.max_collectors
-                if pickup.collectors.count() == 0:
-                    History.objects.create(
-                        typus=HistoryTypus.PICKUP_MISSED,
-                        group=pickup.store.group,
-                        store=pickup.store,
-                        date=pickup.date,
-                        payload=payload,
-                    )
-                else:
-                    History.objects.create(
-                        typus=HistoryTypus.PICKUP_DONE,
-                        group=pickup.store.group,
-                        store=pickup.store,
-                        users=pickup.collectors.all(),
-                        date=pickup.date,
-                        payload=payload,
-                    )
-
+                collectors = list(pickup.collectors.all())
+                history = History(
+                    typus=HistoryTypus.PICKUP_DONE if len(collectors) > 0 else HistoryTypus.PICKUP_MISSED,
+                    group=pickup.store.group,
+                    store=pickup.store,
+                    date=pickup.date,
+                    payload=payload,
+                )
+                entries.append((history, collectors))
             pickup.done_and_processed = True
-            pickup.save()
 
+        History.objects.create_many(entries)
+        self.filter(id__in=[pickup.id for pickup in pickups]).update(done_and_processed=True)
+
+        for pickup in pickups:
             pickup_done.send(sender=PickupDate.__class__, instance=pickup)
+        return len(pickups)
 
     def feedback_possible_q(self, user):
         return Q(date__lte=timezone.now()) \
@@ -183,6 +372,8 @@ class PickupDate(BaseModel):
     )
     description = models.TextField(blank=True)
     max_collectors = models.PositiveIntegerField(null=True)
+    # the number of collectors, kept up to date by the m2m_changed receiver
+    collector_count = models.PositiveIntegerField(default=0)
     deleted = models.BooleanField(default=False)
 
     # internal values for change detection
@@ -200,6 +391,15 @@ class PickupDate(BaseModel):
     def __str__(self):
         return 'PickupDate {} - {}'.format(self.date, self.store)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # collectors might have joined since this instance got loaded, don't overwrite their count
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'collector_count'
+            ]
+        super().save(*args, **kwargs)
+
     def notify_upcoming_via_slack(self):
         if 'upcoming' not in self.notifications_sent:
             store_page_url = '{hostname}/#/group/{groupid}/store/{storeid}'\
@@ -230,13 +430,42 @@ class PickupDate(BaseModel):
     def is_full(self):
         if not self.max_collectors:
             return False
-        return self.collectors.count() >= self.max_collectors
+        return self.collector_count >= self.max_collectors
+
+    def add_collector(self, user):
+        """
+        adds the user to the collectors, if there is a place left
+
+        concurrent calls wait for each other, so that they can't take more places than there are
+
+        :return: False if the pickup date is full
+        """
+        with transaction.atomic():
+            # lock the pickup date, the others might be about to take the last place
+            self.max_collectors, self.collector_count = PickupDate.objects.select_for_update() \
+                .values_list('max_collectors', 'collector_count').get(id=self.id)
+            if self.is_collector(user):
+                return True
+            if self.is_full():
+                return False
+            self.collectors.add(user)
+            self.collector_count += 1
+            return True
+
+    def remove_collector(self, user):
+        """removes the user from the collectors, waiting for concurrent joins like add_collector"""
+        with transaction.atomic():
+            self.collector_count = PickupDate.objects.select_for_update() \
+                .values_list('collector_count', flat=True).get(id=self.id)
+            if self.is_collector(user):
+                self.collectors.remove(user)
+                self.collector_count -= 1
 
     def is_collector(self, user):
         return self.collectors.filter(id=user.id).exists()
 
     def is_empty(self):
-        return self.collectors.count() == 0
+        return self.collector_count == 0
 
     def is_recent(self):
         return self.date >= timezone.now() - relativedelta(days=settings.FEEDBACK_POSSIBLE_DAYS)
@@ -35,13 +35,6 @@ class HasNotJoinedPickupDate(permissions.BasePermission):
         return not obj.is_collector(request.user)
 
 
-class IsNotFull(permissions.BasePermission):
-    message = _('Pickup date is already full.')
-
-    def has_object_permission(self, request, view, obj):
-        return not obj.is_full()
-
-
 class IsSameCollector(permissions.BasePermission):
     message = _('This feedback is given by another user.')
 
@@ -1,4 +1,4 @@
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -15,3 +15,22 @@ def leave_group_handler(sender, instance, **kwargs):
             filter(collectors__in=[user, ]). \
             filter(store__group=group):
         _.collectors.remove(user)
+
+
+@receiver(m2m_changed, sender=PickupDate.collectors.through)
+def update_collector_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Count the collectors again, instead of trusting pk_set to contain only the changed ones
+
+    Changes from the side of the user (user.pickup_dates) affect the pickup dates in pk_set, or all the pickup dates
+    of the user if they get cleared.
+    """
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            PickupDate.objects.filter(id=instance.id).update_collector_count()
+    elif action == 'pre_clear':
+        instance._cleared_pickup_date_ids = list(instance.pickup_dates.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        PickupDate.objects.filter(id__in=pk_set).update_collector_count()
+    elif action == 'post_clear':
+        PickupDate.objects.filter(id__in=instance._cleared_pickup_date_ids).update_collector_count()
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext as _
 from rest_framework import serializers
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.validators import UniqueTogetherValidator
 
 from foodsaving.history.models import History, HistoryTypus
@@ -93,7 +94,8 @@ class PickupDateJoinSerializer(serializers.ModelSerializer):
 
     def update(self, pickupdate, validated_data):
         user = self.context['request'].user
-        pickupdate.collectors.add(user)
+        if not pickupdate.add_collector(user):
+            raise PermissionDenied(_('Pickup date is already full.'))
 
         History.objects.create(
             typus=HistoryTypus.PICKUP_JOIN,
@@ -112,7 +114,7 @@ class PickupDateLeaveSerializer(serializers.ModelSerializer):
 
     def update(self, pickupdate, validated_data):
         user = self.context['request'].user
-        pickupdate.collectors.remove(user)
+        pickupdate.remove_collector(user)
 
         History.objects.create(
             typus=HistoryTypus.PICKUP_LEAVE,
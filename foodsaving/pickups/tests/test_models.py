@@ -1,17 +1,19 @@
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 
 from dateutil import rrule
 from dateutil.relativedelta import relativedelta
 from django.core.exceptions import ValidationError
 from django.db import DataError
 from django.db import IntegrityError
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 
 from foodsaving.stores.factories import StoreFactory
 from foodsaving.users.factories import UserFactory
 from foodsaving.pickups.factories import PickupDateFactory
-from foodsaving.pickups.models import Feedback, PickupDateSeries, PickupDate
+from foodsaving.pickups.models import Feedback, PickupDateSeries, PickupDate, get_rule_step
 
 
 class TestFeedbackModel(TestCase):
@@ -43,6 +45,83 @@ class TestFeedbackModel(TestCase):
         Feedback.objects.create(given_by=self.user, about=PickupDateFactory())
 
 
+class TestPickupDateModel(TestCase):
+    def test_add_collector(self):
+        pickup = PickupDateFactory(max_collectors=1)
+        user = UserFactory()
+        self.assertTrue(pickup.add_collector(user))
+        self.assertTrue(pickup.add_collector(user))
+        self.assertFalse(pickup.add_collector(UserFactory()))
+        self.assertEqual(list(pickup.collectors.all()), [user])
+
+    def test_collector_count(self):
+        pickup = PickupDateFactory()
+        users = [UserFactory() for _ in range(3)]
+
+        def collector_count():
+            return PickupDate.objects.get(id=pickup.id).collector_count
+
+        pickup.collectors.add(*users)
+        self.assertEqual(collector_count(), 3)
+        pickup.collectors.remove(users[0])
+        self.assertEqual(collector_count(), 2)
+        pickup.collectors.clear()
+        self.assertEqual(collector_count(), 0)
+
+    def test_collector_count_of_changes_by_user(self):
+        pickups = [PickupDateFactory() for _ in range(3)]
+        user = UserFactory()
+
+        def collector_counts():
+            return [PickupDate.objects.get(id=pickup.id).collector_count for pickup in pickups]
+
+        user.pickup_dates.add(*pickups)
+        self.assertEqual(collector_counts(), [1, 1, 1])
+        user.pickup_dates.remove(pickups[0])
+        self.assertEqual(collector_counts(), [0, 1, 1])
+        user.pickup_dates.clear()
+        self.assertEqual(collector_counts(), [0, 0, 0])
+
+    def test_save_keeps_collector_count(self):
+        pickup = PickupDateFactory()
+        PickupDate.objects.get(id=pickup.id).collectors.add(UserFactory())
+        pickup.description = 'changed'
+        pickup.save()
+        pickup.refresh_from_db()
+        self.assertEqual(pickup.collector_count, 1)
+        self.assertEqual(pickup.description, 'changed')
+
+    def test_add_collector_without_max_collectors(self):
+        pickup = PickupDateFactory(max_collectors=None)
+        for _ in range(3):
+            self.assertTrue(pickup.add_collector(UserFactory()))
+        self.assertEqual(pickup.collectors.count(), 3)
+
+
+class TestPickupDateConcurrentJoins(TransactionTestCase):
+    def test_concurrent_joins_do_not_overfill(self):
+        pickup = PickupDateFactory(max_collectors=3)
+        users = [UserFactory() for _ in range(10)]
+        start = threading.Barrier(len(users))
+        results = []
+
+        def join(user):
+            start.wait(10)
+            try:
+                results.append(PickupDate.objects.get(id=pickup.id).add_collector(user))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=join, args=(user, )) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [False] * 7 + [True] * 3)
+        self.assertEqual(pickup.collectors.count(), 3)
+
+
 class TestPickupDateSeriesModel(TestCase):
     def setUp(self):
 
@@ -107,3 +186,61 @@ class TestPickupDateSeriesModel(TestCase):
         series.delete()
         self.assertEqual(PickupDate.objects.filter(date__gte=now, deleted=False).count(), 0)
         self.assertEqual(PickupDate.objects.filter(date__lt=now).count(), past_date_count)
+
+    def test_update_pickup_dates_in_bulk(self):
+        series = PickupDateSeries.objects.create(
+            store=self.store,
+            rule=str(rrule.rrule(freq=rrule.DAILY)),
+            start_date=timezone.now(),
+            max_collectors=3,
+        )
+        pickups = series.pickup_dates.all()
+        self.assertEqual(pickups.count(), 28)
+        joined, changed = pickups[0], pickups[1]
+        joined.collectors.add(UserFactory())
+        changed.max_collectors = 9
+        changed.is_max_collectors_changed = True
+        changed.save()
+
+        series.max_collectors = 5
+        series.rule = str(rrule.rrule(freq=rrule.DAILY, interval=2))
+        with self.assertNumQueries(10):
+            series.update_pickup_dates()
+
+        pickups = series.pickup_dates.filter(deleted=False)
+        self.assertEqual(pickups.count(), 14)
+        self.assertEqual(pickups.get(id=joined.id).max_collectors, 3)
+        self.assertEqual(pickups.get(id=changed.id).max_collectors, 9)
+        self.assertEqual(pickups.filter(max_collectors=5).count(), 12)
+
+    def test_update_pickup_dates_without_changes(self):
+        series = PickupDateSeries.objects.create(
+            store=self.store,
+            rule=str(rrule.rrule(freq=rrule.DAILY)),
+            start_date=timezone.now(),
+        )
+        with self.assertNumQueries(3):
+            series.update_pickup_dates()
+        self.assertEqual(series.pickup_dates.count(), 28)
+
+    def test_rule_step(self):
+        self.assertEqual(get_rule_step('FREQ=DAILY;INTERVAL=3'), timedelta(days=3))
+        self.assertEqual(get_rule_step('FREQ=WEEKLY;BYDAY=MO,TH'), timedelta(weeks=1))
+        self.assertEqual(get_rule_step(str(rrule.rrule(freq=rrule.WEEKLY, interval=2))), timedelta(weeks=2))
+        self.assertIsNone(get_rule_step('FREQ=WEEKLY;COUNT=10'))
+        self.assertIsNone(get_rule_step('FREQ=MONTHLY;BYMONTHDAY=1'))
+        self.assertIsNone(get_rule_step('RRULE:FREQ=DAILY\nEXRULE:FREQ=WEEKLY;BYDAY=SU'))
+
+    def test_dates_of_long_running_series(self):
+        tz = self.store.group.timezone
+        now = timezone.now()
+        for rule in ('FREQ=DAILY;INTERVAL=3', 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH', 'FREQ=MONTHLY;BYMONTHDAY=1'):
+            series = PickupDateSeries(store=self.store, rule=rule, start_date=now - relativedelta(years=2, hours=5))
+            start_date = series.start_date.astimezone(tz).replace(tzinfo=None)
+            period_start = now.astimezone(tz).replace(tzinfo=None)
+            period_end = period_start + relativedelta(weeks=self.store.weeks_in_advance)
+            expected = rrule.rrulestr(rule, dtstart=start_date)
+            self.assertEqual(series.get_period_dates(now), (
+                [tz.localize(d) for d in expected.between(period_start, period_end)],
+                tz.localize(expected.after(period_end, inc=True)),
+            ))
@@ -77,6 +77,17 @@ class TestPickupDatesAPI(APITestCase, ExtractPaginationMixin):
         self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
         self.assertEqual(len(response.data), 2)
 
+    def test_list_pickups_with_few_queries(self):
+        for _ in range(5):
+            PickupDateFactory(store=self.store, collectors=[self.member, UserFactory()])
+        self.client.force_login(user=self.member)
+        # user, pickup dates, collectors
+        with self.assertNumQueries(3):
+            response = self.get_results(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(len(response.data), 7)
+        self.assertEqual(len(response.data[-1]['collector_ids']), 2)
+
     def test_retrieve_pickups(self):
         response = self.client.get(self.pickup_url)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN, response.data)
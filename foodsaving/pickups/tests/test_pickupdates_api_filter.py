@@ -48,6 +48,25 @@ class TestPickupdatesAPIFilter(APITestCase, ExtractPaginationMixin):
             self.assertEqual(_['store'], self.store.id)
         self.assertEqual(len(response.data), self.store.pickup_dates.count())
 
+    def test_filter_has_free_places(self):
+        self.pickup.max_collectors = 1
+        self.pickup.save()
+        self.pickup.collectors.add(self.member)
+        self.pickup2.max_collectors = None
+        self.pickup2.save()
+        self.pickup2.collectors.add(self.member)
+
+        self.client.force_login(user=self.member)
+        response = self.get_results(self.url, {'has_free_places': True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        ids = [_['id'] for _ in response.data]
+        self.assertNotIn(self.pickup.id, ids)
+        self.assertIn(self.pickup2.id, ids)
+        self.assertEqual(len(ids), PickupDateModel.objects.count() - 1)
+
+        response = self.get_results(self.url, {'has_free_places': False})
+        self.assertEqual([_['id'] for _ in response.data], [self.pickup.id])
+
     def test_filter_by_group(self):
         self.client.force_login(user=self.member)
         response = self.get_results(self.url, {'group': self.group.id})
@@ -0,0 +1,51 @@
+from channels import Group
+
+GROUP_PREFIX = 'group-'
+
+# topics which sockets only receive if they subscribe to them
+SUBSCRIBABLE_TOPICS = ('groups:group_preview',)
+
+# the channel layer forgets group members after its group_expiry (a day by default),
+# so sockets join their channel groups again when we hear from them after this many seconds
+CHANNEL_GROUPS_REFRESH_SECONDS = 60 * 60
+
+
+def user_channel_group(user_id):
+    return 'user-{}'.format(user_id)
+
+
+def group_channel_group(group_id, delta=False):
+    name = '{}{}'.format(GROUP_PREFIX, group_id)
+    return delta_channel_group(name) if delta else name
+
+
+def delta_channel_group(name):
+    """Sockets in delta mode receive the events of the group channel from here, see delta.py"""
+    return '{}.delta'.format(name)
+
+
+def has_delta_channel_group(name):
+    return name.startswith(GROUP_PREFIX) and not name.endswith('.delta')
+
+
+def topic_channel_group(topic, group_id=None):
+    """Sockets which subscribed to the topic, either for all groups or for a single group"""
+    name = 'topic-{}'.format(topic.replace(':', '.'))
+    return name if group_id is None else '{}-{}'.format(name, group_channel_group(group_id))
+
+
+def get_channel_groups_for_user(user, delta=False):
+    """All channel groups a socket of this user should be part of."""
+    names = [user_channel_group(user.id)]
+    names += [group_channel_group(group_id, delta) for group_id in user.groups.values_list('id', flat=True)]
+    return names
+
+
+def add_reply_channel(user, reply_channel, delta=False):
+    for name in get_channel_groups_for_user(user, delta):
+        Group(name).add(reply_channel)
+
+
+def discard_reply_channel(user, reply_channel, delta=False):
+    for name in get_channel_groups_for_user(user, delta):
+        Group(name).discard(reply_channel)
@@ -1,11 +1,15 @@
+import time
 from base64 import b64decode
 from urllib.parse import unquote
 
+from channels import Group
 from channels.generic.websockets import JsonWebsocketConsumer
-from django.utils import timezone
 from rest_framework.authentication import TokenAuthentication
 
-from foodsaving.subscriptions.models import ChannelSubscription
+from foodsaving.subscriptions.channel_groups import add_reply_channel, discard_reply_channel, \
+    get_channel_groups_for_user, group_channel_group, topic_channel_group, SUBSCRIBABLE_TOPICS, \
+    CHANNEL_GROUPS_REFRESH_SECONDS
+from foodsaving.subscriptions import delta, presence, replay
 
 token_auth = TokenAuthentication()
 
@@ -38,12 +42,14 @@ class Consumer(JsonWebsocketConsumer):
     http_user = True
 
     def connect(self, message, **kwargs):
-        """The user has connected! Register their channel subscription."""
+        """The user has connected! Register their presence and join the channel groups."""
         check_for_auth_token_header(message)
         check_for_token_user(message)
         user = message.user
         if not user.is_anonymous:
-            ChannelSubscription.objects.create(user=user, reply_channel=message.reply_channel)
+            presence.touch(user.id, message.reply_channel.name)
+            add_reply_channel(user, message.reply_channel)
+            message.channel_session['channel_groups_joined_at'] = time.time()
         message.reply_channel.send({"accept": True})
 
     def receive(self, content, **kwargs):
@@ -51,18 +57,120 @@ class Consumer(JsonWebsocketConsumer):
         check_for_token_user(self.message)
         user = self.message.user
         if not user.is_anonymous:
-            reply_channel = self.message.reply_channel.name
-            subscriptions = ChannelSubscription.objects.filter(user=user, reply_channel=reply_channel)
-            update_attrs = {'lastseen_at': timezone.now()}
             message_type = content.get('type', None)
-            if message_type == 'away':
-                update_attrs['away_at'] = timezone.now()
-            elif message_type == 'back':
-                update_attrs['away_at'] = None
-            subscriptions.update(**update_attrs)
+            away = {'away': True, 'back': False}.get(message_type)
+            presence.touch(user.id, self.message.reply_channel.name, away=away)
+            self.refresh_channel_groups(user)
+            if message_type == 'resume':
+                self.resume(user, content.get('seq'))
+            elif message_type == 'delta':
+                self.enable_delta_mode(user)
+            elif message_type == 'snapshot':
+                self.snapshot(user, content.get('topic'), content.get('id'))
+            elif message_type == 'subscribe':
+                self.subscribe(content.get('topic'), content.get('groups'))
+            elif message_type == 'unsubscribe':
+                self.unsubscribe(content.get('topic'), content.get('groups'))
+
+    def refresh_channel_groups(self, user):
+        """Join the channel groups again, before the channel layer lets our membership expire"""
+        session = self.message.channel_session
+        now = time.time()
+        if now - session.get('channel_groups_joined_at', 0) < CHANNEL_GROUPS_REFRESH_SECONDS:
+            return
+        reply_channel = self.message.reply_channel
+        add_reply_channel(user, reply_channel, delta=self.is_delta_mode())
+        for name in self.get_subscriptions():
+            Group(name).add(reply_channel)
+        session['channel_groups_joined_at'] = now
+
+    def get_subscriptions(self):
+        return self.message.channel_session.get('subscriptions', [])
+
+    def get_topic_channel_groups(self, topic, group_ids):
+        if topic not in SUBSCRIBABLE_TOPICS:
+            return []
+        if group_ids is None:
+            return [topic_channel_group(topic)]
+        return [topic_channel_group(topic, group_id) for group_id in group_ids if isinstance(group_id, int)]
+
+    def subscribe(self, topic, group_ids=None):
+        """
+        Receive a topic, e.g. {"type": "subscribe", "topic": "groups:group_preview"}
+
+        With "groups": [1, 2], only the events of these groups are sent.
+        """
+        names = self.get_topic_channel_groups(topic, group_ids)
+        for name in names:
+            Group(name).add(self.message.reply_channel)
+        self.message.channel_session['subscriptions'] = sorted(set(self.get_subscriptions() + names))
+
+    def unsubscribe(self, topic, group_ids=None):
+        names = self.get_topic_channel_groups(topic, group_ids)
+        for name in names:
+            Group(name).discard(self.message.reply_channel)
+        self.message.channel_session['subscriptions'] = [n for n in self.get_subscriptions() if n not in names]
+
+    def is_delta_mode(self):
+        return self.message.channel_session.get('delta', False)
+
+    def enable_delta_mode(self, user):
+        """From now on, the socket receives only the changed fields of objects, see delta.py"""
+        if self.is_delta_mode():
+            return
+        reply_channel = self.message.reply_channel
+        discard_reply_channel(user, reply_channel)
+        add_reply_channel(user, reply_channel, delta=True)
+        presence.set_delta_mode(user.id, reply_channel.name)
+        self.message.channel_session['delta'] = True
+
+    def snapshot(self, user, topic, object_id):
+        """Send the latest version of an object to a socket in delta mode, if it got out of sync"""
+        group_names = [group_channel_group(group_id) for group_id in user.groups.values_list('id', flat=True)]
+        text = delta.get_snapshot(group_names, topic, object_id)
+        if text is not None:
+            self.message.reply_channel.send({'text': text})
+        else:
+            # we don't know about the object anymore, the client needs to fetch it
+            self.send({
+                'topic': 'status:snapshot_missing',
+                'payload': {
+                    'topic': topic,
+                    'id': object_id,
+                }
+            })
+
+    def resume(self, user, seen):
+        """
+        Replay the events which the socket missed, as far as we still have them
+
+        The client sends the last sequence number it has seen per stream, e.g.
+        {"type": "resume", "seq": {"user-1": 20, "group-5": 312}}, and afterwards receives a status:resumed
+        message with the current sequence numbers. If a stream has been truncated, it needs to reload its data.
+        """
+        streams = get_channel_groups_for_user(user, self.is_delta_mode()) + self.get_subscriptions()
+        if not isinstance(seen, dict):
+            seen = {}
+        # only the streams of channel groups the user is part of
+        seen = {stream: seq for stream, seq in seen.items() if stream in streams and isinstance(seq, int)}
+
+        missed, truncated, current = replay.get_missed(seen)
+        current.update(replay.get_current([stream for stream in streams if stream not in seen]))
+        for text in missed:
+            self.message.reply_channel.send({'text': text})
+        self.send({
+            'topic': 'status:resumed',
+            'payload': {
+                'seq': current,
+                'truncated': truncated,
+            }
+        })
 
     def disconnect(self, message, **kwargs):
-        """The user has disconnected so we remove all their ChannelSubscriptions"""
+        """The user has disconnected so we remove their presence and leave the channel groups"""
         user = message.user
         if not user.is_anonymous:
-            ChannelSubscription.objects.filter(user=user, reply_channel=message.reply_channel).delete()
+            presence.remove(user.id, message.reply_channel.name)
+            discard_reply_channel(user, message.reply_channel, delta=self.is_delta_mode())
+            for name in self.get_subscriptions():
+                Group(name).discard(message.reply_channel)
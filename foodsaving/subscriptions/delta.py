@@ -0,0 +1,94 @@
+"""
+Delta mode: sockets which opt in only receive the fields of an object which changed
+
+For events sent with `delta=True`, the dispatch worker numbers the payloads of each object and keeps them for a
+while under their version, in redis. Sockets in delta mode are in the delta channel group instead of the group
+channel and receive
+  {"topic": "pickups:pickupdate", "payload": {"id": 5, "max_collectors": 3}, "version": 8, "delta": true}
+which they apply if they have version 7 of the object. Otherwise they ask for a snapshot, which is the full
+payload with its version. The first event about an object we don't know about yet is a snapshot as well.
+
+The versions come from INCR, so concurrent workers never hand out the same one. A delta is always computed
+against the payload stored under the previous version; if that one isn't there (yet), the event is a snapshot.
+"""
+import json
+
+from django.db import connection
+from django_redis import get_redis_connection
+
+# how long we keep the versions of an object, in seconds
+DELTA_STATE_TIMEOUT = 60 * 60 * 24
+
+
+def delta_key(*parts):
+    # several databases can share one redis, e.g. the parallel test runs
+    return ':'.join(['delta', connection.settings_dict['NAME']] + [str(part) for part in parts])
+
+
+def version_key(group_name, topic, object_id):
+    return delta_key('version', group_name, topic, object_id)
+
+
+def payload_key(group_name, topic, object_id, version):
+    return delta_key('payload', group_name, topic, object_id, version)
+
+
+def render_snapshot(topic, payload, version):
+    return json.dumps({
+        'topic': topic,
+        'payload': payload,
+        'version': version,
+    })
+
+
+def load(payload_text):
+    return json.loads(payload_text.decode()) if payload_text is not None else None
+
+
+def render_delta(group_name, text):
+    """
+    Store the payload as the next version of the object and render the changes for sockets in delta mode
+
+    :return: the message text, or None if nothing changed
+    """
+    message = json.loads(text)
+    topic, payload = message['topic'], message['payload']
+    object_id = payload['id']
+    redis = get_redis_connection('default')
+
+    latest = redis.get(version_key(group_name, topic, object_id))
+    if latest is not None and load(redis.get(payload_key(group_name, topic, object_id, int(latest)))) == payload:
+        return None
+
+    version = redis.incr(version_key(group_name, topic, object_id))
+    pipe = redis.pipeline()
+    pipe.set(payload_key(group_name, topic, object_id, version), json.dumps(payload), ex=DELTA_STATE_TIMEOUT)
+    pipe.expire(version_key(group_name, topic, object_id), DELTA_STATE_TIMEOUT)
+    pipe.get(payload_key(group_name, topic, object_id, version - 1))
+    base = load(pipe.execute()[-1])
+
+    if base is None:
+        return render_snapshot(topic, payload, version)
+
+    changed = {name: value for name, value in payload.items() if base.get(name, object()) != value}
+    changed['id'] = object_id
+    return json.dumps({
+        'topic': topic,
+        'payload': changed,
+        'version': version,
+        'delta': True,
+    })
+
+
+def get_snapshot(group_names, topic, object_id):
+    """Find the latest version of the object in one of the channel groups, returns the message text or None"""
+    if not group_names:
+        return None
+    redis = get_redis_connection('default')
+    versions = redis.mget([version_key(group_name, topic, object_id) for group_name in group_names])
+    for group_name, version in zip(group_names, versions):
+        if version is None:
+            continue
+        payload = load(redis.get(payload_key(group_name, topic, object_id, int(version))))
+        if payload is not None:
+            return render_snapshot(topic, payload, int(version))
@@ -0,0 +1,240 @@
+import json
+import threading
+import weakref
+
+from channels import Channel, Group, DEFAULT_CHANNEL_LAYER, channel_layers
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from foodsaving.subscriptions.channel_groups import user_channel_group, has_delta_channel_group, delta_channel_group
+from foodsaving.subscriptions.delta import render_delta
+from foodsaving.subscriptions.replay import stamp_and_buffer
+
+# consumed by the channels workers (manage.py runworker), see routing.py
+DISPATCH_CHANNEL = 'subscriptions.dispatch'
+
+# consumed by the channels delay server (manage.py rundelay)
+DELAY_CHANNEL = 'asgi.delay'
+
+# consumed by the push worker (manage.py runworker --only-channels=subscriptions.push), see fcm.py
+PUSH_CHANNEL = 'subscriptions.push'
+
+# how long we keep the latest state of a coalesced event around, in seconds
+COALESCE_CACHE_TIMEOUT = 60
+
+
+class DispatchBatch(object):
+    """
+    Realtime events of a transaction, handed over to the dispatch worker when the transaction commits
+
+    Every event registers its own on_commit callback, so Django discards it together with a rolled back savepoint
+    or transaction. The batch only holds weak references to these callbacks: the events whose callback is still
+    alive are the ones that commit, and the first callback that runs sends all of them in a single message.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+        self.sent = False
+
+    def is_open(self):
+        return not self.sent and any(callback() is not None for callback, _ in self.callbacks)
+
+    def add(self, event):
+        callback = DispatchCallback(self)
+        self.callbacks.append((weakref.ref(callback), event))
+        transaction.on_commit(callback)
+
+    def send(self):
+        if self.sent:
+            return
+        self.sent = True
+        events = []
+        for callback, event in self.callbacks:
+            if callback() is None:
+                continue
+            key = event.get('coalesce')
+            if key is not None:
+                # the new state makes previous events about the same object obsolete
+                events = [e for e in events if e.get('coalesce') != key]
+            events.append(event)
+        Channel(DISPATCH_CHANNEL).send({'events': events})
+
+
+class DispatchCallback(object):
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __call__(self):
+        self.batch.send()
+
+
+# the batch of the transaction that is currently running in this thread
+_local = threading.local()
+
+
+def queue_event(event):
+    """
+    Queue an event for the dispatch worker
+
+    Events are only sent if the surrounding transaction commits, so rolled back changes never reach the clients.
+    All events of a transaction end up in a single message to the worker. Outside of a transaction, the event is
+    sent right away.
+    """
+    batch = getattr(_local, 'dispatch_batch', None)
+    if batch is None or not batch.is_open():
+        # the previous transaction was committed or rolled back
+        batch = _local.dispatch_batch = DispatchBatch()
+    batch.add(event)
+
+
+def send_in_group(group_name, topic, payload, coalesce=None, delta=False, exclude_user=None):
+    """
+    Send a message to all sockets in the channel group
+
+    Messages with the same `coalesce` key (e.g. 'pickupdate:<id>') replace each other if they are sent within
+    REALTIME_COALESCE_MILLISECONDS, so that only the latest state of an object is sent out.
+
+    With `delta`, sockets in delta mode only receive the changed fields of the payload, see delta.py
+
+    With `exclude_user`, the sockets of that user don't get the message, e.g. about their own changes
+    """
+    event = {
+        'type': 'websocket',
+        'group': group_name,
+        'text': json.dumps({
+            'topic': topic,
+            'payload': payload
+        }),
+    }
+    if coalesce is not None:
+        event['coalesce'] = '{}:{}'.format(group_name, coalesce)
+    if delta:
+        event['delta'] = True
+    if exclude_user is not None:
+        event['exclude'] = user_channel_group(exclude_user)
+    queue_event(event)
+
+
+def send_to_users(topic, payload, user_fields):
+    """
+    Send a message to each user, with the payload extended by their own fields
+
+    The shared payload is rendered only once, the dispatch worker splices in the small per-user fields.
+
+    :param user_fields: dict of user id -> dict of user specific payload fields
+    """
+    queue_event({
+        'type': 'websocket_users',
+        'text': json.dumps({
+            'topic': topic,
+            'payload': payload
+        }),
+        'users': [[user_id, json.dumps(fields)] for user_id, fields in user_fields.items()],
+    })
+
+
+def splice_fields(text, fields_text):
+    """Add the fields of a JSON object to the payload of a rendered message, which is always its last member"""
+    fields = fields_text[1:-1]
+    if not fields:
+        return text
+    head = text[:-2]
+    separator = '' if head.endswith('{') else ', '
+    return head + separator + fields + '}}'
+
+
+def render_user_texts(event):
+    """Yields (user id, message text) for a 'websocket_users' event, users with the same fields share one text"""
+    texts = {}
+    for user_id, fields_text in event['users']:
+        if fields_text not in texts:
+            texts[fields_text] = splice_fields(event['text'], fields_text)
+        yield user_id, texts[fields_text]
+
+
+def send_conversation_push_notification(conversation_id, user_tokens, **kwargs):
+    """
+    Queue a push notification about a new message
+
+    Further notifications to a user about the same conversation get merged for a while, see fcm.py
+
+    :param user_tokens: dict of user id -> list of their FCM tokens
+    :param kwargs: the arguments of fcm.notify_multiple_devices, except registration_ids
+    """
+    queue_event({
+        'type': 'push',
+        'push': {
+            'kwargs': kwargs,
+            'conversation': conversation_id,
+            'user_tokens': [[user_id, tokens] for user_id, tokens in user_tokens.items()],
+        },
+    })
+
+
+def send_to_group(group_name, text, exclude=None):
+    """Send the text to the sockets in the channel group, except the ones which are also in the `exclude` group"""
+    if exclude is None:
+        Group(group_name).send({'text': text})
+        return
+    channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+    excluded = set(channel_layer.group_channels(exclude))
+    for reply_channel in channel_layer.group_channels(group_name):
+        if reply_channel not in excluded:
+            Channel(reply_channel).send({'text': text})
+
+
+def send_event(event):
+    if event['type'] == 'websocket':
+        texts = [(event['group'], event['text'])]
+        if has_delta_channel_group(event['group']):
+            delta_text = render_delta(event['group'], event['text']) if event.get('delta') else event['text']
+            if delta_text is not None:
+                texts.append((delta_channel_group(event['group']), delta_text))
+        for group_name, text in stamp_and_buffer(texts):
+            send_to_group(group_name, text, exclude=event.get('exclude'))
+    elif event['type'] == 'websocket_users':
+        texts = [(user_channel_group(user_id), text) for user_id, text in render_user_texts(event)]
+        for group_name, text in stamp_and_buffer(texts):
+            Group(group_name).send({'text': text})
+    elif event['type'] == 'push':
+        # sending takes a while, the push worker does it
+        Channel(PUSH_CHANNEL).send(event['push'])
+
+
+def coalesce_cache_key(kind, key):
+    # several databases can share one redis, e.g. the parallel test runs
+    return 'realtime:coalesce:{}:{}:{}'.format(transaction.get_connection().settings_dict['NAME'], kind, key)
+
+
+def coalesce_event(event):
+    """Remember the event as latest state and schedule sending it, unless that is already scheduled"""
+    key = event['coalesce']
+    cache.set(coalesce_cache_key('latest', key), event, COALESCE_CACHE_TIMEOUT)
+    if cache.add(coalesce_cache_key('pending', key), True, COALESCE_CACHE_TIMEOUT):
+        Channel(DELAY_CHANNEL).send({
+            'channel': DISPATCH_CHANNEL,
+            'content': {'flush': key},
+            'delay': settings.REALTIME_COALESCE_MILLISECONDS,
+        })
+
+
+def flush_coalesced_event(key):
+    # new events of this key will schedule another flush from now on
+    cache.delete(coalesce_cache_key('pending', key))
+    event = cache.get(coalesce_cache_key('latest', key))
+    if event is not None:
+        send_event(event)
+
+
+def dispatch(message):
+    """Worker side: fan out the events of one transaction in the order they happened"""
+    if 'flush' in message.content:
+        flush_coalesced_event(message.content['flush'])
+        return
+
+    for event in message.content['events']:
+        if 'coalesce' in event and settings.REALTIME_COALESCE_MILLISECONDS > 0:
+            coalesce_event(event)
+        else:
+            send_event(event)
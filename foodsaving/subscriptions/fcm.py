@@ -1,12 +1,35 @@
+import json
 import logging
+import time
+from collections import defaultdict
 
+import requests
+from channels import Channel
 from django.conf import settings
+from django.db import connection
+from django.utils.translation import ngettext
+from django_redis import get_redis_connection
+from influxdb_metrics.loader import write_points
 from pyfcm import FCMNotification
+from pyfcm.baseapi import BaseAPI
 
+from foodsaving.subscriptions import presence
+from foodsaving.subscriptions.dispatch import DELAY_CHANNEL, PUSH_CHANNEL
 from foodsaving.subscriptions.models import PushSubscription
 
 logger = logging.getLogger(__name__)
 
+# retry failed requests and tokens with an exponential backoff, starting at FCM_BACKOFF_SECONDS
+FCM_RETRIES = 3
+FCM_BACKOFF_SECONDS = 1
+FCM_TIMEOUT_SECONDS = 10
+
+# errors which might go away when we try again later
+RETRY_ERRORS = ('Unavailable', 'InternalServerError')
+
+# errors which mean that the token will never work again
+INVALID_TOKEN_ERRORS = ('InvalidRegistration', 'NotRegistered')
+
 fcm = None
 
 if hasattr(settings, 'FCM_SERVER_KEY'):
@@ -14,24 +37,213 @@ if hasattr(settings, 'FCM_SERVER_KEY'):
 else:
     logger.warning('Please configure FCM_SERVER_KEY in your settings to use push messaging')
 
+# keeps the connections to FCM open between requests
+session = requests.Session()
+
+
+def post_to_fcm(payload):
+    """Returns the response, or None if FCM could not be reached"""
+    try:
+        return session.post(
+            getattr(settings, 'FCM_END_POINT', BaseAPI.FCM_END_POINT),
+            headers=fcm.request_headers(),
+            data=payload,
+            timeout=FCM_TIMEOUT_SECONDS,
+        )
+    except requests.RequestException:
+        logger.warning('Could not reach FCM', exc_info=True)
+        return None
+
+
+def get_retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return int(retry_after)
+    return FCM_BACKOFF_SECONDS * 2 ** attempt
 
-def notify_multiple_devices(**kwargs):
+
+def send_chunk(registration_ids, **kwargs):
+    """
+    Send to at most FCM_MAX_RECIPIENTS devices, retrying temporary failures
+
+    :return: list of the results for each registration id, None if we gave up on it
+    """
+    results = [None] * len(registration_ids)
+    pending = list(range(len(registration_ids)))
+    response = None
+    for attempt in range(FCM_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(get_retry_delay(response, attempt - 1))
+
+        response = post_to_fcm(fcm.parse_payload(registration_ids=[registration_ids[i] for i in pending], **kwargs))
+        if response is not None and response.status_code == 200:
+            retry = []
+            for index, result in zip(pending, response.json().get('results', [])):
+                results[index] = result
+                if result.get('error') in RETRY_ERRORS:
+                    retry.append(index)
+            pending = retry
+        elif response is not None and response.status_code < 500:
+            # our fault, trying again won't help
+            logger.error('FCM rejected the request: %s %s', response.status_code, response.text)
+            break
+
+        if len(pending) == 0:
+            break
+    return results
+
+
+def notify_multiple_devices(registration_ids, **kwargs):
     """
     Send a message to multiple devices.
 
-    A simple wrapper of pyfcm's notify_multiple_devices.
-    See https://github.com/olucurious/PyFCM/blob/master/pyfcm/fcm.py for more details on options, etc.
+    Takes the same options as pyfcm's notify_multiple_devices, see
+    https://github.com/olucurious/PyFCM/blob/master/pyfcm/fcm.py for more details on options, etc.
+    Invalid tokens get their push subscriptions removed.
     """
 
     if fcm is None:
         return None
 
-    response = fcm.notify_multiple_devices(**kwargs)
-    tokens = kwargs.get('registration_ids', [])
+    start = time.perf_counter()
+    results = []
+    for index in range(0, len(registration_ids), BaseAPI.FCM_MAX_RECIPIENTS):
+        results += send_chunk(registration_ids[index:index + BaseAPI.FCM_MAX_RECIPIENTS], **kwargs)
+
+    invalid_tokens = [
+        token for token, result in zip(registration_ids, results)
+        if result is not None and result.get('error') in INVALID_TOKEN_ERRORS
+    ]
+    if len(invalid_tokens) > 0:
+        PushSubscription.objects.filter(token__in=invalid_tokens).delete()
+
+    success = sum(1 for result in results if result is not None and 'error' not in result)
+    write_points([{
+        'measurement': 'push_notifications',
+        'tags': {
+            'host': getattr(settings, 'INFLUXDB_TAGS_HOST', ''),
+        },
+        'fields': {
+            'tokens': len(registration_ids),
+            'success': success,
+            'failure': len(registration_ids) - success,
+            'invalid_tokens': len(invalid_tokens),
+            'ms': (time.perf_counter() - start) * 1000,
+        },
+    }])
+
+    return {
+        'success': success,
+        'failure': len(registration_ids) - success,
+        'results': results,
+    }
+
+
+def push_key(*parts):
+    # several databases can share one redis, e.g. the parallel test runs
+    return ':'.join(['push', connection.settings_dict['NAME']] + [str(part) for part in parts])
+
+
+def with_message_count(kwargs, count):
+    """The notification about the latest message, or about the number of messages if there were several"""
+    kwargs = dict(kwargs)
+    if count > 1:
+        kwargs['message_body'] = ngettext(
+            '%(count)s new message', '%(count)s new messages', count
+        ) % {'count': count}
+    return kwargs
+
+
+def coalesce_conversation_push(conversation_id, user_tokens, kwargs):
+    """
+    Send the notification to users who haven't had one about the conversation for a while, hold it for the others
+
+    The first notification opens a window of PUSH_COALESCE_SECONDS for the user. Notifications within that window
+    are counted, and when it's over, the user gets one notification about all of them. If a new notification
+    comes before the flush of the conversation got to them, it includes the ones which were held.
+    """
+    window = settings.PUSH_COALESCE_SECONDS
+    redis = get_redis_connection('default')
+    pending_key = push_key('pending', conversation_id)
+
+    pipe = redis.pipeline()
+    for user_id, _ in user_tokens:
+        pipe.set(push_key('window', conversation_id, user_id), 1, nx=True, ex=window)
+    opened = pipe.execute()
+
+    pipe = redis.pipeline()
+    for (user_id, _), window_opened in zip(user_tokens, opened):
+        if window_opened:
+            # held in the previous window, they go out now and not with the flush
+            pipe.hget(pending_key, user_id)
+            pipe.hdel(pending_key, user_id)
+        else:
+            pipe.hincrby(pending_key, user_id, 1)
+    results = iter(pipe.execute())
+
+    tokens_by_count = defaultdict(list)
+    held = False
+    for (user_id, tokens), window_opened in zip(user_tokens, opened):
+        if window_opened:
+            held_count, _ = next(results), next(results)
+            tokens_by_count[1 + int(held_count or 0)] += tokens
+        else:
+            next(results)
+            held = True
+
+    if held:
+        pipe = redis.pipeline()
+        pipe.expire(pending_key, window * 2)
+        pipe.set(push_key('latest', conversation_id), json.dumps(kwargs), ex=window * 2)
+        pipe.set(push_key('flush', conversation_id), 1, nx=True, ex=window * 2)
+        if pipe.execute()[-1]:
+            Channel(DELAY_CHANNEL).send({
+                'channel': PUSH_CHANNEL,
+                'content': {'flush': conversation_id},
+                'delay': window * 1000,
+            })
+
+    for count, tokens in tokens_by_count.items():
+        if len(tokens) > 0:
+            notify_multiple_devices(registration_ids=tokens, **with_message_count(kwargs, count))
+
+
+def flush_conversation_push(conversation_id):
+    """Send one notification about the held ones to each user, with the latest message if it's only one"""
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.delete(push_key('flush', conversation_id))
+    pipe.hgetall(push_key('pending', conversation_id))
+    pipe.delete(push_key('pending', conversation_id))
+    pipe.get(push_key('latest', conversation_id))
+    _, pending, _, latest = pipe.execute()
+    if not pending or latest is None:
+        return
+    latest = json.loads(latest.decode())
+
+    # users who came back in the meantime have seen the messages already
+    pending = {int(user_id): int(count) for user_id, count in pending.items()}
+    online = presence.filter_online(pending.keys())
+
+    users_by_count = defaultdict(list)
+    for user_id, count in pending.items():
+        if user_id not in online:
+            users_by_count[count].append(user_id)
+
+    for count, user_ids in users_by_count.items():
+        tokens = list(PushSubscription.objects.filter(user__in=user_ids).values_list('token', flat=True))
+        if len(tokens) == 0:
+            continue
+        notify_multiple_devices(registration_ids=tokens, **with_message_count(latest, count))
 
-    # check for invalid tokens and remove any corresponding push subscriptions
-    for index, result in enumerate(response['results']):
-        if 'error' in result and result['error'] == 'InvalidRegistration':
-            PushSubscription.objects.filter(token=tokens[index]).delete()
 
-    return response
+def push(message):
+    """Worker side: send a push notification queued by dispatch.send_conversation_push_notification"""
+    content = message.content
+    if 'flush' in content:
+        flush_conversation_push(content['flush'])
+    elif settings.PUSH_COALESCE_SECONDS > 0:
+        coalesce_conversation_push(content['conversation'], content['user_tokens'], content['kwargs'])
+    else:
+        registration_ids = [token for _, tokens in content['user_tokens'] for token in tokens]
+        notify_multiple_devices(registration_ids=registration_ids, **content['kwargs'])
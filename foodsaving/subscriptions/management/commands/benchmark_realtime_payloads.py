@@ -0,0 +1,100 @@
+import json
+import time
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from foodsaving.conversations.models import ConversationMessage, ConversationParticipant
+from foodsaving.conversations.serializers import ConversationSerializer
+from foodsaving.groups.factories import GroupFactory
+from foodsaving.groups.models import GroupMembership
+from foodsaving.pickups.factories import FeedbackFactory, PickupDateFactory
+from foodsaving.pickups.serializers import FeedbackSerializer
+from foodsaving.stores.factories import StoreFactory
+from foodsaving.subscriptions import dispatch
+from foodsaving.subscriptions.dispatch import render_user_texts, send_to_users
+from foodsaving.subscriptions.receivers import (
+    MockRequest, CONVERSATION_USER_FIELDS, get_conversation_user_fields, send_feedback_updates, serialize_shared
+)
+from foodsaving.users.models import User
+
+
+class Command(BaseCommand):
+    """
+    Measures the CPU time to render one realtime event for all members of a large group,
+    once per member (as we used to) and with the shared payload rendered once.
+    All data gets created in a transaction that is rolled back afterwards.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=10)
+
+    def handle(self, *args, **options):
+        # keep the events of the receivers here instead of sending them to the dispatch worker
+        self.events = []
+        with transaction.atomic(), patch.object(dispatch, 'queue_event', self.events.append):
+            self.run(options['members'], options['rounds'])
+            transaction.set_rollback(True)
+
+    def run(self, n_members, rounds):
+        users = User.objects.bulk_create(
+            User(email='benchmark{}@example.com'.format(i), display_name='Benchmark {}'.format(i))
+            for i in range(n_members)
+        )
+        group = GroupFactory()
+        GroupMembership.objects.bulk_create(GroupMembership(group=group, user=user) for user in users)
+        conversation = group.conversation
+        ConversationParticipant.objects.bulk_create(
+            ConversationParticipant(conversation=conversation, user=user) for user in users
+        )
+        pickup = PickupDateFactory(store=StoreFactory(group=group), collectors=users[:1])
+        feedback = FeedbackFactory(about=pickup, given_by=users[0])
+        message = ConversationMessage.objects.create(conversation=conversation, author=users[0], content='hello')
+
+        def render_per_user(topic, serializer_class, instance, recipients):
+            for user in recipients:
+                payload = serializer_class(instance, context={'request': MockRequest(user=user)}).data
+                json.dumps({'topic': topic, 'payload': payload})
+
+        def render_latest_events():
+            # render the queued events like the dispatch worker would
+            for event in self.events:
+                if event['type'] == 'websocket_users':
+                    for _ in render_user_texts(event):
+                        pass
+            self.events.clear()
+
+        def feedback_before():
+            render_per_user('feedback:feedback', FeedbackSerializer, feedback, group.members.all())
+
+        def feedback_after():
+            send_feedback_updates(sender=None, instance=feedback)
+            render_latest_events()
+
+        def conversation_before():
+            recipients = conversation.participants.exclude(id=message.author_id)
+            render_per_user('conversations:conversation', ConversationSerializer, conversation, recipients)
+
+        def conversation_after():
+            participants = conversation.conversationparticipant_set.exclude(user=message.author)
+            send_to_users(
+                'conversations:conversation',
+                serialize_shared(ConversationSerializer(conversation), CONVERSATION_USER_FIELDS),
+                get_conversation_user_fields(conversation, participants)
+            )
+            render_latest_events()
+
+        def measure(name, f):
+            start = time.process_time()
+            for _ in range(rounds):
+                f()
+            per_event = (time.process_time() - start) / rounds * 1000
+            self.stdout.write('{:<45} {:8.1f} ms CPU per event'.format(name, per_event))
+
+        self.stdout.write('{} group members, {} rounds'.format(n_members, rounds))
+        measure('feedback:feedback, per user', feedback_before)
+        measure('feedback:feedback, shared', feedback_after)
+        measure('conversations:conversation, per user', conversation_before)
+        measure('conversations:conversation, shared', conversation_after)
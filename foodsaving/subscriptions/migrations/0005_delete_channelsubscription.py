@@ -0,0 +1,20 @@
+# Generated by Django 2.0.1 on 2026-10-18 20:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0004_channelsubscription_away_at'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='channelsubscription',
+            name='user',
+        ),
+        migrations.DeleteModel(
+            name='ChannelSubscription',
+        ),
+    ]
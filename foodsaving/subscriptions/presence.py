@@ -0,0 +1,105 @@
+"""
+Which users have sockets open, kept in redis
+
+Each user has a sorted set of their reply channels, scored by the time we last heard from the socket,
+a set of the reply channels which are away and a set of the reply channels in delta mode. The `online`
+sorted set contains every user with at least one socket which is not away, scored by when we last heard
+from it.
+
+Sockets we have not heard from for PRESENCE_TIMEOUT count as gone, and the keys expire on their own.
+"""
+import time
+
+from django.db import connection
+from django_redis import get_redis_connection
+
+# the frontend sends a message at least every few minutes while it is open
+PRESENCE_TIMEOUT = 5 * 60
+
+
+def presence_key(*parts):
+    # several databases can share one redis, e.g. the parallel test runs
+    return ':'.join(['presence', connection.settings_dict['NAME']] + [str(part) for part in parts])
+
+
+def _update_online(redis, user_id, now):
+    """Put the user in or out of the online set, depending on the sockets they have left"""
+    recent = redis.zrangebyscore(presence_key('user', user_id), now - PRESENCE_TIMEOUT, '+inf')
+    away = redis.smembers(presence_key('away', user_id))
+    online_key = presence_key('online')
+    pipe = redis.pipeline()
+    if set(recent) - away:
+        pipe.zadd(online_key, now, user_id)
+    else:
+        pipe.zrem(online_key, user_id)
+    pipe.zremrangebyscore(online_key, '-inf', now - PRESENCE_TIMEOUT)
+    pipe.expire(online_key, PRESENCE_TIMEOUT)
+    pipe.execute()
+
+
+def touch(user_id, reply_channel, away=None):
+    """
+    We heard from the socket
+
+    :param away: True or False if the socket told us whether the user is looking at it, None to keep it as it is
+    """
+    now = time.time()
+    redis = get_redis_connection('default')
+    user_key = presence_key('user', user_id)
+    away_key = presence_key('away', user_id)
+    pipe = redis.pipeline()
+    pipe.zadd(user_key, now, reply_channel)
+    pipe.zremrangebyscore(user_key, '-inf', now - PRESENCE_TIMEOUT)
+    pipe.expire(user_key, PRESENCE_TIMEOUT)
+    if away is True:
+        pipe.sadd(away_key, reply_channel)
+    elif away is False:
+        pipe.srem(away_key, reply_channel)
+    pipe.expire(away_key, PRESENCE_TIMEOUT)
+    pipe.expire(presence_key('delta', user_id), PRESENCE_TIMEOUT)
+    pipe.execute()
+    _update_online(redis, user_id, now)
+
+
+def set_delta_mode(user_id, reply_channel):
+    delta_key = presence_key('delta', user_id)
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.sadd(delta_key, reply_channel)
+    pipe.expire(delta_key, PRESENCE_TIMEOUT)
+    pipe.execute()
+
+
+def remove(user_id, reply_channel):
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    pipe.zrem(presence_key('user', user_id), reply_channel)
+    pipe.srem(presence_key('away', user_id), reply_channel)
+    pipe.srem(presence_key('delta', user_id), reply_channel)
+    pipe.execute()
+    _update_online(redis, user_id, time.time())
+
+
+def get_reply_channels(user_id):
+    """All sockets of the user which have not timed out yet"""
+    redis = get_redis_connection('default')
+    reply_channels = redis.zrangebyscore(presence_key('user', user_id), time.time() - PRESENCE_TIMEOUT, '+inf')
+    return [reply_channel.decode() for reply_channel in reply_channels]
+
+
+def get_delta_reply_channels(user_id):
+    redis = get_redis_connection('default')
+    return {reply_channel.decode() for reply_channel in redis.smembers(presence_key('delta', user_id))}
+
+
+def filter_online(user_ids):
+    """The subset of users which have a socket open and are not away"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    for user_id in user_ids:
+        pipe.zscore(presence_key('online'), user_id)
+    since = time.time() - PRESENCE_TIMEOUT
+    return {user_id for user_id, score in zip(user_ids, pipe.execute()) if score is not None and score > since}
@@ -1,26 +1,30 @@
-import json
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 
-from channels import Channel
+from channels import Group
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Q, prefetch_related_objects
 from django.db.models.signals import post_save, pre_delete, m2m_changed
 from django.dispatch import receiver
+from rest_framework.fields import DateTimeField
 
-from foodsaving.conversations.models import ConversationParticipant, ConversationMessage
+from foodsaving.conversations.models import Conversation, ConversationParticipant, ConversationMessage, \
+    participants_added, participants_marked
 from foodsaving.conversations.serializers import ConversationMessageSerializer, ConversationSerializer
-from foodsaving.groups.models import Group
+from foodsaving.groups.models import Group as GroupModel, GroupMembership
 from foodsaving.groups.serializers import GroupDetailSerializer, GroupPreviewSerializer
 from foodsaving.history.models import history_created
 from foodsaving.history.serializers import HistorySerializer
 from foodsaving.invitations.models import Invitation
 from foodsaving.invitations.serializers import InvitationSerializer
-from foodsaving.pickups.models import PickupDate, PickupDateSeries, Feedback, pickup_done
+from foodsaving.pickups.models import PickupDate, PickupDateSeries, Feedback, pickup_done, \
+    series_pickup_dates_updated
 from foodsaving.pickups.serializers import PickupDateSerializer, PickupDateSeriesSerializer, FeedbackSerializer
 from foodsaving.stores.models import Store
 from foodsaving.stores.serializers import StoreSerializer
-from foodsaving.subscriptions.fcm import notify_multiple_devices
-from foodsaving.subscriptions.models import ChannelSubscription, PushSubscription
+from foodsaving.subscriptions.channel_groups import group_channel_group, user_channel_group, topic_channel_group
+from foodsaving.subscriptions.dispatch import send_in_group, send_conversation_push_notification, send_to_users
+from foodsaving.subscriptions import presence
+from foodsaving.subscriptions.models import PushSubscription
 from foodsaving.userauth.serializers import AuthUserSerializer
 from foodsaving.users.serializers import UserSerializer
 
@@ -33,13 +37,33 @@ class AbsoluteURIBuildingRequest:
         return settings.HOSTNAME + path
 
 
-def send_in_channel(channel, topic, payload):
-    Channel(channel).send({
-        'text': json.dumps({
-            'topic': topic,
-            'payload': payload
-        })
-    })
+def serialize_shared(serializer, user_field_names):
+    """Serialize only the fields which are the same for every user"""
+    for name in user_field_names:
+        serializer.fields.pop(name)
+    return serializer.data
+
+
+CONVERSATION_USER_FIELDS = ('seen_up_to', 'unread_message_count', 'updated_at')
+
+
+def get_conversation_user_fields(conversation, participants):
+    """The fields of ConversationSerializer which depend on the participant, for many participants at once"""
+    return {
+        participant.user_id: {
+            'seen_up_to': participant.seen_up_to_id,
+            'unread_message_count': participant.unread_message_count,
+            'updated_at': DateTimeField().to_representation(max(participant.updated_at, conversation.updated_at)),
+        }
+        for participant in participants
+    }
+
+
+def get_conversation_channel_groups(conversation):
+    """Group conversations are reachable via the group channel, other conversations via each participant"""
+    if isinstance(conversation.target, GroupModel):
+        return [group_channel_group(conversation.target.id)]
+    return [user_channel_group(user_id) for user_id in conversation.participants.values_list('id', flat=True)]
 
 
 @receiver(post_save, sender=ConversationMessage)
@@ -52,31 +76,30 @@ def send_messages(sender, instance, **kwargs):
     topic = 'conversations:message'
     payload = ConversationMessageSerializer(message).data
 
-    push_exclude_users = []
-
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=conversation.participants.all()):
-        if not subscription.away_at:
-            push_exclude_users.append(subscription.user)
+    for group_name in get_conversation_channel_groups(conversation):
+        send_in_group(group_name, topic, payload)
 
-        send_in_channel(subscription.reply_channel, topic, payload)
+    participant_ids = conversation.participants.values_list('id', flat=True)
+    push_exclude_users = presence.filter_online(participant_ids)
 
-    tokens = [item.token for item in
-              PushSubscription.objects.filter(
-                  Q(user__in=conversation.participants.all()) & ~Q(user__in=push_exclude_users) & ~Q(
-                      user=message.author))]
+    user_tokens = defaultdict(list)
+    for user_id, token in PushSubscription.objects.filter(
+            Q(user__in=participant_ids) & ~Q(user__in=push_exclude_users) & ~Q(user=message.author)
+    ).values_list('user_id', 'token'):
+        user_tokens[user_id].append(token)
 
-    if len(tokens) > 0:
+    if len(user_tokens) > 0:
 
         message_title = message.author.display_name
-        if isinstance(conversation.target, Group):
+        if isinstance(conversation.target, GroupModel):
             message_title = '{} / {}'.format(conversation.target.name, message_title)
 
-        notify_multiple_devices(
-            registration_ids=tokens,
+        send_conversation_push_notification(
+            conversation.id,
+            user_tokens,
             message_title=message_title,
             message_body=message.content,
             # this causes each notification for a given conversation to replace previous notifications
-            # fancier would be to make the new notifications show a summary not just the latest message
             tag='conversation:{}'.format(conversation.id)
         )
 
@@ -84,13 +107,12 @@ def send_messages(sender, instance, **kwargs):
     # (important for unread_message_count)
     # Exclude the author because their seen_up_to status gets updated,
     # so they will receive the `send_conversation_update` message
-    topic = 'conversations:conversation'
-
-    for subscription in ChannelSubscription.objects.recent()\
-            .filter(user__in=conversation.participants.all())\
-            .exclude(user=message.author):
-        payload = ConversationSerializer(conversation, context={'request': MockRequest(user=subscription.user)}).data
-        send_in_channel(subscription.reply_channel, topic, payload)
+    participants = conversation.conversationparticipant_set.exclude(user=message.author)
+    send_to_users(
+        'conversations:conversation',
+        serialize_shared(ConversationSerializer(conversation), CONVERSATION_USER_FIELDS),
+        get_conversation_user_fields(conversation, participants)
+    )
 
 
 @receiver(post_save, sender=ConversationParticipant)
@@ -102,37 +124,72 @@ def send_conversation_update(sender, instance, **kwargs):
     topic = 'conversations:conversation'
     payload = ConversationSerializer(conversation, context={'request': MockRequest(user=instance.user)}).data
 
-    for subscription in ChannelSubscription.objects.recent().filter(user=instance.user):
-        send_in_channel(subscription.reply_channel, topic, payload)
+    send_in_group(user_channel_group(instance.user_id), topic, payload)
 
 
 @receiver(pre_delete, sender=ConversationParticipant)
 def remove_participant(sender, instance, **kwargs):
     """When a user is removed from a conversation we will notify them."""
 
-    user = instance.user
     conversation = instance.conversation
-    for subscription in ChannelSubscription.objects.filter(user=user):
-        send_in_channel(
-            subscription.reply_channel,
-            topic='conversations:leave',
-            payload={
-                'id': conversation.id
-            }
-        )
+    send_in_group(
+        user_channel_group(instance.user_id),
+        topic='conversations:leave',
+        payload={
+            'id': conversation.id
+        }
+    )
+
+
+@receiver(participants_added)
+def send_conversation_to_added_participants(sender, instance, user_ids, **kwargs):
+    conversation = instance
+    participants = conversation.conversationparticipant_set.filter(user__in=user_ids)
+    send_to_users(
+        'conversations:conversation',
+        serialize_shared(ConversationSerializer(conversation), CONVERSATION_USER_FIELDS),
+        get_conversation_user_fields(conversation, participants)
+    )
+
+
+@receiver(participants_marked)
+def send_marked_conversations(sender, user, conversation_ids, **kwargs):
+    """All conversations which the user marked at once, in one message"""
+    conversations = Conversation.objects.for_participant(user).filter(id__in=conversation_ids) \
+        .prefetch_related('participants')
+    payload = ConversationSerializer(conversations, many=True, context={'request': MockRequest(user=user)}).data
+    send_in_group(user_channel_group(user.id), 'conversations:conversations', payload)
 
 
 # Group
-@receiver(post_save, sender=Group)
+@receiver(post_save, sender=GroupModel)
 def send_group_updates(sender, instance, **kwargs):
     group = instance
     detail_payload = GroupDetailSerializer(group).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='groups:group_detail', payload=detail_payload)
+    send_in_group(group_channel_group(group.id), topic='groups:group_detail', payload=detail_payload, delta=True)
 
+    topic = 'groups:group_preview'
     preview_payload = GroupPreviewSerializer(group).data
-    for subscription in ChannelSubscription.objects.recent():
-        send_in_channel(subscription.reply_channel, topic='groups:group_preview', payload=preview_payload)
+    for group_name in (topic_channel_group(topic), topic_channel_group(topic, group.id)):
+        send_in_group(group_name, topic=topic, payload=preview_payload)
+
+
+@receiver(post_save, sender=GroupMembership)
+def join_group_channel(sender, instance, created, **kwargs):
+    """Add the already connected sockets of a new member to the group channel"""
+    if created:
+        delta_reply_channels = presence.get_delta_reply_channels(instance.user_id)
+        for reply_channel in presence.get_reply_channels(instance.user_id):
+            delta = reply_channel in delta_reply_channels
+            Group(group_channel_group(instance.group_id, delta)).add(reply_channel)
+
+
+@receiver(pre_delete, sender=GroupMembership)
+def leave_group_channel(sender, instance, **kwargs):
+    delta_reply_channels = presence.get_delta_reply_channels(instance.user_id)
+    for reply_channel in presence.get_reply_channels(instance.user_id):
+        delta = reply_channel in delta_reply_channels
+        Group(group_channel_group(instance.group_id, delta)).discard(reply_channel)
 
 
 # Invitations
@@ -140,16 +197,14 @@ def send_group_updates(sender, instance, **kwargs):
 def send_invitation_updates(sender, instance, **kwargs):
     invitation = instance
     payload = InvitationSerializer(invitation).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=invitation.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='invitations:invitation', payload=payload)
+    send_in_group(group_channel_group(invitation.group_id), topic='invitations:invitation', payload=payload)
 
 
 @receiver(pre_delete, sender=Invitation)
 def send_invitation_accept(sender, instance, **kwargs):
     invitation = instance
     payload = InvitationSerializer(invitation).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=invitation.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='invitations:invitation_accept', payload=payload)
+    send_in_group(group_channel_group(invitation.group_id), topic='invitations:invitation_accept', payload=payload)
 
 
 # Store
@@ -157,8 +212,7 @@ def send_invitation_accept(sender, instance, **kwargs):
 def send_store_updates(sender, instance, **kwargs):
     store = instance
     payload = StoreSerializer(store).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=store.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='stores:store', payload=payload)
+    send_in_group(group_channel_group(store.group_id), topic='stores:store', payload=payload, delta=True)
 
 
 # Pickup Dates
@@ -170,21 +224,45 @@ def send_pickup_updates(sender, instance, **kwargs):
         return
 
     payload = PickupDateSerializer(pickup).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=pickup.store.group.members.all()):
-        if not pickup.deleted:
-            send_in_channel(subscription.reply_channel, topic='pickups:pickupdate', payload=payload)
-        else:
-            send_in_channel(subscription.reply_channel, topic='pickups:pickupdate_deleted', payload=payload)
+    group_name = group_channel_group(pickup.store.group_id)
+    coalesce = 'pickupdate:{}'.format(pickup.id)
+    if not pickup.deleted:
+        send_in_group(group_name, topic='pickups:pickupdate', payload=payload, coalesce=coalesce, delta=True)
+    else:
+        send_in_group(group_name, topic='pickups:pickupdate_deleted', payload=payload, coalesce=coalesce)
 
 
 @receiver(m2m_changed, sender=PickupDate.collectors.through)
 def send_pickup_collector_updates(sender, instance, **kwargs):
     action = kwargs.get('action')
     if action and (action == 'post_add' or action == 'post_remove'):
-        pickup = instance
+        # changed from the side of the user, e.g. user.pickup_dates.add(pickup)
+        pickups = PickupDate.objects.filter(id__in=kwargs['pk_set']) if kwargs['reverse'] else [instance]
+        for pickup in pickups:
+            payload = PickupDateSerializer(pickup).data
+            send_in_group(
+                group_channel_group(pickup.store.group_id),
+                topic='pickups:pickupdate',
+                payload=payload,
+                coalesce='pickupdate:{}'.format(pickup.id),
+                delta=True
+            )
+
+
+@receiver(series_pickup_dates_updated)
+def send_series_pickup_date_updates(sender, instance, created, updated, deleted, **kwargs):
+    """All pickup dates which a series changed at once, serialized without a query for each of them"""
+    series = instance
+    group_name = group_channel_group(series.store.group_id)
+    prefetch_related_objects(created + updated + deleted, 'collectors')
+    for pickup in created + updated:
+        payload = PickupDateSerializer(pickup).data
+        coalesce = 'pickupdate:{}'.format(pickup.id)
+        send_in_group(group_name, topic='pickups:pickupdate', payload=payload, coalesce=coalesce, delta=True)
+    for pickup in deleted:
         payload = PickupDateSerializer(pickup).data
-        for subscription in ChannelSubscription.objects.recent().filter(user__in=pickup.store.group.members.all()):
-            send_in_channel(subscription.reply_channel, topic='pickups:pickupdate', payload=payload)
+        coalesce = 'pickupdate:{}'.format(pickup.id)
+        send_in_group(group_name, topic='pickups:pickupdate_deleted', payload=payload, coalesce=coalesce)
 
 
 # Pickup Date Series
@@ -192,33 +270,52 @@ def send_pickup_collector_updates(sender, instance, **kwargs):
 def send_pickup_series_updates(sender, instance, **kwargs):
     series = instance
     payload = PickupDateSeriesSerializer(series).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=series.store.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='pickups:series', payload=payload)
+    send_in_group(
+        group_channel_group(series.store.group_id),
+        topic='pickups:series',
+        payload=payload,
+        coalesce='series:{}'.format(series.id)
+    )
 
 
 @receiver(pre_delete, sender=PickupDateSeries)
 def send_pickup_series_delete(sender, instance, **kwargs):
     series = instance
     payload = PickupDateSeriesSerializer(series).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=series.store.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='pickups:series_deleted', payload=payload)
+    send_in_group(
+        group_channel_group(series.store.group_id),
+        topic='pickups:series_deleted',
+        payload=payload,
+        coalesce='series:{}'.format(series.id)
+    )
 
 
 # Feedback
 @receiver(post_save, sender=Feedback)
 def send_feedback_updates(sender, instance, **kwargs):
+    """The group gets the payload once, only the author might be allowed to edit the feedback"""
     feedback = instance
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=feedback.about.store.group.members.all()):
-        payload = FeedbackSerializer(feedback, context={'request': MockRequest(user=subscription.user)}).data
-        send_in_channel(subscription.reply_channel, topic='feedback:feedback', payload=payload)
+    payload = serialize_shared(FeedbackSerializer(feedback), ['is_editable'])
+    send_in_group(
+        group_channel_group(feedback.about.store.group_id),
+        topic='feedback:feedback',
+        payload=dict(payload, is_editable=False)
+    )
+    if feedback.about.is_recent():
+        # sent after the group payload, so that the author ends up with this one
+        send_in_group(
+            user_channel_group(feedback.given_by_id),
+            topic='feedback:feedback',
+            payload=dict(payload, is_editable=True)
+        )
 
 
 @receiver(pickup_done)
 def send_feedback_possible_updates(sender, instance, **kwargs):
     pickup = instance
     payload = PickupDateSerializer(pickup).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=pickup.collectors.all()):
-        send_in_channel(subscription.reply_channel, topic='pickups:feedback_possible', payload=payload)
+    for user in pickup.collectors.all():
+        send_in_group(user_channel_group(user.id), topic='pickups:feedback_possible', payload=payload)
 
 
 # Users
@@ -227,18 +324,16 @@ def send_auth_user_updates(sender, instance, **kwargs):
     """Send full details to the user"""
     user = instance
     payload = AuthUserSerializer(user, context={'request': AbsoluteURIBuildingRequest()}).data
-    for subscription in ChannelSubscription.objects.recent().filter(user=user):
-        send_in_channel(subscription.reply_channel, topic='auth:user', payload=payload)
+    send_in_group(user_channel_group(user.id), topic='auth:user', payload=payload)
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def send_user_updates(sender, instance, **kwargs):
-    """Send profile updates to everyone except the user"""
+    """Send profile updates to the groups of the user, except the user, who gets auth:user"""
     user = instance
     payload = UserSerializer(user, context={'request': AbsoluteURIBuildingRequest()}).data
-    users_groups = user.groups.values('id')
-    for subscription in ChannelSubscription.objects.recent().filter(user__groups__in=users_groups).exclude(user=user):
-        send_in_channel(subscription.reply_channel, topic='users:user', payload=payload)
+    for group_id in user.groups.values_list('id', flat=True):
+        send_in_group(group_channel_group(group_id), topic='users:user', payload=payload, exclude_user=user.id)
 
 
 # History
@@ -246,6 +341,4 @@ def send_user_updates(sender, instance, **kwargs):
 def send_history_updates(sender, instance, **kwargs):
     history = instance
     payload = HistorySerializer(history).data
-    for subscription in ChannelSubscription.objects.recent().filter(user__in=history.group.members.all()):
-        send_in_channel(subscription.reply_channel, topic='history:history', payload=payload)
-
+    send_in_group(group_channel_group(history.group_id), topic='history:history', payload=payload)
@@ -0,0 +1,88 @@
+"""
+Numbered event streams, so that reconnecting sockets can catch up on what they missed
+
+Every channel group is a stream: each message sent to it gets the next sequence number of the group, and
+the latest messages are kept in a sorted set scored by that number. A client remembers the last
+sequence number it has seen per stream and presents them when it reconnects.
+"""
+from django.db import connection
+from django_redis import get_redis_connection
+
+# how many messages we keep per stream
+REPLAY_BUFFER_SIZE = 200
+
+# how long we keep the messages of a stream after the last one, in seconds
+REPLAY_BUFFER_TIMEOUT = 60 * 60
+
+
+def replay_key(*parts):
+    # several databases can share one redis, e.g. the parallel test runs
+    return ':'.join(['replay', connection.settings_dict['NAME']] + [str(part) for part in parts])
+
+
+def stamp(text, stream, seq):
+    """Add the stream and sequence number to a rendered message, which is always a JSON object"""
+    return '{}, "stream": "{}", "seq": {}}}'.format(text[:-1], stream, seq)
+
+
+def stamp_and_buffer(streams_and_texts):
+    """
+    Number the messages and keep them for replay
+
+    :param streams_and_texts: list of (channel group name, message text)
+    :return: list of (channel group name, stamped message text)
+    """
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    for stream, _ in streams_and_texts:
+        pipe.incr(replay_key('seq', stream))
+    seqs = pipe.execute()
+
+    stamped = []
+    for (stream, text), seq in zip(streams_and_texts, seqs):
+        text = stamp(text, stream, seq)
+        stamped.append((stream, text))
+        buffer_key = replay_key('buffer', stream)
+        # workers might add concurrent messages out of order, the score keeps the buffer sorted anyway
+        pipe.zadd(buffer_key, seq, text)
+        pipe.zremrangebyrank(buffer_key, 0, -REPLAY_BUFFER_SIZE - 1)
+        pipe.expire(buffer_key, REPLAY_BUFFER_TIMEOUT)
+    pipe.execute()
+    return stamped
+
+
+def get_missed(seen):
+    """
+    Look up the messages which the client has not seen yet
+
+    :param seen: dict of stream -> last sequence number seen by the client
+    :return: tuple of (list of missed message texts, list of streams which have been truncated, dict of stream
+             -> current sequence number)
+    """
+    streams = list(seen.keys())
+    redis = get_redis_connection('default')
+    pipe = redis.pipeline()
+    for stream in streams:
+        pipe.get(replay_key('seq', stream))
+        pipe.zrangebyscore(replay_key('buffer', stream), seen[stream] + 1, '+inf', withscores=True)
+    results = pipe.execute()
+
+    missed = []
+    truncated = []
+    current = {}
+    for stream, seq, buffered in zip(streams, results[0::2], results[1::2]):
+        current[stream] = int(seq or 0)
+        if current[stream] < seen[stream] or (buffered and buffered[0][1] > seen[stream] + 1) or \
+                (not buffered and current[stream] > seen[stream]):
+            # the counter has been reset or the buffer does not reach back far enough
+            truncated.append(stream)
+        else:
+            missed += [text.decode() for text, _ in buffered]
+    return missed, truncated, current
+
+
+def get_current(streams):
+    """The current sequence number of the streams"""
+    redis = get_redis_connection('default')
+    seqs = redis.mget([replay_key('seq', stream) for stream in streams]) if streams else []
+    return {stream: int(seq or 0) for stream, seq in zip(streams, seqs)}
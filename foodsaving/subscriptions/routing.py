@@ -1,7 +1,11 @@
-from channels.routing import route_class
+from channels.routing import route_class, route
 
 from .consumers import Consumer
+from .dispatch import DISPATCH_CHANNEL, PUSH_CHANNEL, dispatch
+from .fcm import push
 
 channel_routing = [
-    route_class(Consumer)
+    route_class(Consumer),
+    route(DISPATCH_CHANNEL, dispatch),
+    route(PUSH_CHANNEL, push),
 ]
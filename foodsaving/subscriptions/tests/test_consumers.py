@@ -1,58 +1,140 @@
-from channels import Channel
-from channels.test import ChannelTestCase, WSClient
-from dateutil.relativedelta import relativedelta
+import time
+from unittest.mock import patch
+
+from channels import Channel, Group
+from channels.test import ChannelTestCase
 from django.test import TestCase
-from django.utils import timezone
+from django_redis import get_redis_connection
 from rest_framework.authtoken.models import Token
 
+from foodsaving.groups.factories import GroupFactory
+from foodsaving.pickups.factories import PickupDateFactory
+from foodsaving.stores.factories import StoreFactory
+from foodsaving.subscriptions.channel_groups import group_channel_group, user_channel_group, topic_channel_group
 from foodsaving.subscriptions.consumers import check_for_auth_token_header, check_for_token_user
-from foodsaving.subscriptions.models import ChannelSubscription
+from foodsaving.subscriptions.dispatch import send_in_group
+from foodsaving.subscriptions import presence
+from foodsaving.subscriptions.presence import presence_key
+from foodsaving.tests.utils import ReceiveAllWSClient, WSClient, clear_realtime_state
 from foodsaving.users.factories import UserFactory
+from foodsaving.utils.tests.fake import faker
 
 
 class ConsumerTests(ChannelTestCase):
-    def test_adds_subscription(self):
+    def setUp(self):
+        clear_realtime_state()
+
+    def test_adds_presence(self):
         client = WSClient()
         user = UserFactory()
         client.force_login(user)
-        self.assertEqual(ChannelSubscription.objects.filter(user=user).count(), 0)
+        self.assertEqual(presence.get_reply_channels(user.id), [])
         client.send_and_consume('websocket.connect', path='/')
-        self.assertEqual(ChannelSubscription.objects.filter(user=user).count(), 1, 'Did not add subscription')
+        self.assertEqual(len(presence.get_reply_channels(user.id)), 1, 'Did not add presence')
+        self.assertEqual(presence.filter_online([user.id]), {user.id})
 
     def test_accepts_anonymous_connections(self):
         client = WSClient()
-        qs = ChannelSubscription.objects
-        original_count = qs.count()
         client.send_and_consume('websocket.connect', path='/')
-        self.assertEqual(qs.count(), original_count)
+        self.assertEqual(list(get_redis_connection('default').scan_iter(presence_key('*'))), [])
 
     def test_saves_reply_channel(self):
         client = WSClient()
         user = UserFactory()
         client.force_login(user)
         client.send_and_consume('websocket.connect', path='/')
-        subscription = ChannelSubscription.objects.filter(user=user).first()
-        self.assertIsNotNone(subscription.reply_channel)
+        reply_channel = presence.get_reply_channels(user.id)[0]
 
         # send a message on it
-        Channel(subscription.reply_channel).send({'message': 'hey! whaatsup?'})
+        Channel(reply_channel).send({'message': 'hey! whaatsup?'})
         self.assertEqual(client.receive(json=True), {'message': 'hey! whaatsup?'})
 
+    def test_joins_channel_groups(self):
+        client = WSClient()
+        user = UserFactory()
+        group = GroupFactory(members=[user])
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+
+        Group(user_channel_group(user.id)).send({'text': 'user'})
+        self.assertEqual(client.receive(json=False), 'user')
+        Group(group_channel_group(group.id)).send({'text': 'group'})
+        self.assertEqual(client.receive(json=False), 'group')
+
+    def test_follows_group_membership(self):
+        client = ReceiveAllWSClient()
+        user = UserFactory()
+        group = GroupFactory()
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+
+        group.add_member(user)
+        list(client.receive_all(json=False))
+        Group(group_channel_group(group.id)).send({'text': 'group'})
+        self.assertEqual(client.receive(json=False), 'group')
+
+        group.remove_member(user)
+        list(client.receive_all(json=False))
+        Group(group_channel_group(group.id)).send({'text': 'group'})
+        self.assertIsNone(client.receive(json=False))
+
+    def test_leaves_channel_groups(self):
+        client = WSClient()
+        user = UserFactory()
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+        client.send_and_consume('websocket.disconnect', path='/')
+
+        Group(user_channel_group(user.id)).send({'text': 'user'})
+        self.assertIsNone(client.receive(json=False))
+
+    def test_joins_channel_groups_again_before_they_expire(self):
+        client = WSClient()
+        user = UserFactory()
+        group = GroupFactory(members=[user])
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+        client.send_and_consume('websocket.receive', text={'type': 'subscribe', 'topic': 'groups:group_preview'},
+                                path='/')
+        group_expiry = Channel('websocket.receive').channel_layer.group_expiry
+        names = [user_channel_group(user.id), group_channel_group(group.id)]
+        names.append(topic_channel_group('groups:group_preview'))
+
+        # the socket is still open a day later, but has been sending messages all along
+        now = time.time()
+        with patch('time.time', return_value=now + group_expiry - 60):
+            client.send_and_consume('websocket.receive', text={'message': 'hey'}, path='/')
+        with patch('time.time', return_value=now + group_expiry + 60):
+            for name in names:
+                Group(name).send({'text': name})
+                self.assertEqual(client.receive(json=False), name)
+
+    def test_channel_group_membership_expires(self):
+        client = WSClient()
+        user = UserFactory()
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+        group_expiry = Channel('websocket.receive').channel_layer.group_expiry
+
+        with patch('time.time', return_value=time.time() + group_expiry + 60):
+            Group(user_channel_group(user.id)).send({'text': 'user'})
+            self.assertIsNone(client.receive(json=False))
+
     def test_updates_lastseen(self):
         client = WSClient()
         user = UserFactory()
         client.force_login(user)
         client.send_and_consume('websocket.connect', path='/')
 
-        # update the lastseen timestamp to ages ago
-        the_past = timezone.now() - relativedelta(hours=6)
-        ChannelSubscription.objects.filter(user=user).update(lastseen_at=the_past)
+        # the socket has been quiet for ages
+        with patch('time.time', return_value=time.time() + presence.PRESENCE_TIMEOUT + 1):
+            self.assertEqual(presence.get_reply_channels(user.id), [])
+            self.assertEqual(presence.filter_online([user.id]), set())
 
-        # send a message, and it should update
-        client.send_and_consume('websocket.receive', text={'message': 'hey'}, path='/')
-        subscription = ChannelSubscription.objects.filter(user=user).first()
-        difference = subscription.lastseen_at - the_past
-        self.assertGreater(difference.seconds, 1000)
+            # send a message, and it should be back
+            client.send_and_consume('websocket.receive', text={'message': 'hey'}, path='/')
+            self.assertEqual(len(presence.get_reply_channels(user.id)), 1)
+            self.assertEqual(presence.filter_online([user.id]), {user.id})
 
     def test_updates_away(self):
         client = WSClient()
@@ -61,22 +143,243 @@ class ConsumerTests(ChannelTestCase):
         client.send_and_consume('websocket.connect', path='/')
 
         client.send_and_consume('websocket.receive', text={'type': 'away'}, path='/')
-        subscription = ChannelSubscription.objects.get(user=user)
-        self.assertIsNotNone(subscription.away_at)
+        self.assertEqual(presence.filter_online([user.id]), set())
+
+        client.send_and_consume('websocket.receive', text={'message': 'hey'}, path='/')
+        self.assertEqual(presence.filter_online([user.id]), set())
 
         client.send_and_consume('websocket.receive', text={'type': 'back'}, path='/')
-        subscription.refresh_from_db()
-        self.assertIsNone(subscription.away_at)
+        self.assertEqual(presence.filter_online([user.id]), {user.id})
 
-    def test_removes_subscription(self):
+    def test_is_online_if_any_socket_is_back(self):
         client = WSClient()
+        other_client = WSClient()
         user = UserFactory()
         client.force_login(user)
+        other_client.force_login(user)
         client.send_and_consume('websocket.connect', path='/')
-        self.assertEqual(ChannelSubscription.objects.filter(user=user).count(), 1, 'Did not add subscription')
+        other_client.send_and_consume('websocket.connect', path='/')
+
+        client.send_and_consume('websocket.receive', text={'type': 'away'}, path='/')
+        self.assertEqual(presence.filter_online([user.id]), {user.id})
+
+        other_client.send_and_consume('websocket.disconnect', path='/')
+        self.assertEqual(presence.filter_online([user.id]), set())
+
+    def test_removes_presence(self):
+        client = WSClient()
+        user = UserFactory()
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+        self.assertEqual(len(presence.get_reply_channels(user.id)), 1, 'Did not add presence')
 
         client.send_and_consume('websocket.disconnect', path='/')
-        self.assertEqual(ChannelSubscription.objects.filter(user=user).count(), 0, 'Did not remove subscription')
+        self.assertEqual(presence.get_reply_channels(user.id), [], 'Did not remove presence')
+        self.assertEqual(presence.filter_online([user.id]), set())
+
+
+class ResumeTests(ChannelTestCase):
+    def setUp(self):
+        clear_realtime_state()
+        self.user = UserFactory()
+        self.stream = user_channel_group(self.user.id)
+        self.client = self.connect()
+
+    def connect(self):
+        client = ReceiveAllWSClient()
+        client.force_login(self.user)
+        client.send_and_consume('websocket.connect', path='/')
+        return client
+
+    def resume(self, seq):
+        self.client.send_and_consume('websocket.receive', text={'type': 'resume', 'seq': seq}, path='/')
+        *missed, status = self.client.receive_all(json=True)
+        self.assertEqual(status['topic'], 'status:resumed')
+        return missed, status['payload']
+
+    def send_while_disconnected(self, *payloads):
+        self.client.send_and_consume('websocket.disconnect', path='/')
+        for payload in payloads:
+            send_in_group(self.stream, 'test:topic', payload)
+        self.client = self.connect()
+
+    def test_stamps_events(self):
+        send_in_group(self.stream, 'test:topic', {'id': 1})
+        send_in_group(self.stream, 'test:topic', {'id': 2})
+        first, second = self.client.receive_all(json=True)
+        self.assertEqual(first['stream'], self.stream)
+        self.assertEqual(second['seq'], first['seq'] + 1)
+
+    def test_replays_missed_events(self):
+        send_in_group(self.stream, 'test:topic', {'id': 1})
+        seen = self.client.receive(json=True)['seq']
+        self.send_while_disconnected({'id': 2}, {'id': 3})
+
+        missed, status = self.resume({self.stream: seen})
+        self.assertEqual([m['payload'] for m in missed if m['topic'] == 'test:topic'], [{'id': 2}, {'id': 3}])
+        self.assertEqual([m['seq'] for m in missed], list(range(seen + 1, status['seq'][self.stream] + 1)))
+        self.assertEqual(status['truncated'], [])
+
+    def test_reports_truncated_stream(self):
+        send_in_group(self.stream, 'test:topic', {'id': 1})
+        seen = self.client.receive(json=True)['seq']
+        with patch('foodsaving.subscriptions.replay.REPLAY_BUFFER_SIZE', 1):
+            self.send_while_disconnected({'id': 2}, {'id': 3})
+
+        missed, status = self.resume({self.stream: seen})
+        self.assertEqual(missed, [])
+        self.assertEqual(status['truncated'], [self.stream])
+
+    def test_reports_current_sequence_numbers(self):
+        send_in_group(self.stream, 'test:topic', {'id': 1})
+        seen = self.client.receive(json=True)['seq']
+
+        missed, status = self.resume({})
+        self.assertEqual(missed, [])
+        self.assertEqual(status['seq'][self.stream], seen)
+
+    def test_ignores_streams_of_other_users(self):
+        other_stream = user_channel_group(UserFactory().id)
+        send_in_group(other_stream, 'test:topic', {'id': 1})
+
+        missed, status = self.resume({other_stream: 0})
+        self.assertEqual(missed, [])
+        self.assertNotIn(other_stream, status['seq'])
+
+
+class DeltaModeTests(ChannelTestCase):
+    def setUp(self):
+        clear_realtime_state()
+        self.user = UserFactory()
+        self.group = GroupFactory(members=[self.user])
+        self.store = StoreFactory(group=self.group)
+
+        self.client = ReceiveAllWSClient()
+        self.client.force_login(self.user)
+        self.client.send_and_consume('websocket.connect', path='/')
+        self.client.send_and_consume('websocket.receive', text={'type': 'delta'}, path='/')
+        list(self.client.receive_all())
+
+        self.pickup = PickupDateFactory(store=self.store, max_collectors=5)
+
+    def update_pickup(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self.pickup, name, value)
+        self.pickup.save()
+
+    def receive_pickups(self):
+        return [m for m in self.client.receive_all(json=True) if m['topic'] == 'pickups:pickupdate']
+
+    def test_sends_snapshot_and_then_changes(self):
+        snapshot, = self.receive_pickups()
+        self.assertEqual(snapshot['payload']['max_collectors'], 5)
+        self.assertIn('date', snapshot['payload'])
+        self.assertNotIn('delta', snapshot)
+
+        self.update_pickup(max_collectors=6)
+        change, = self.receive_pickups()
+        self.assertEqual(change['payload'], {'id': self.pickup.id, 'max_collectors': 6})
+        self.assertEqual(change['version'], snapshot['version'] + 1)
+        self.assertTrue(change['delta'])
+
+    def test_skips_unchanged_objects(self):
+        self.receive_pickups()
+
+        self.update_pickup()
+        self.assertEqual(self.receive_pickups(), [])
+
+    def test_other_sockets_receive_full_payload(self):
+        client = WSClient()
+        client.force_login(self.user)
+        client.send_and_consume('websocket.connect', path='/')
+
+        self.update_pickup(max_collectors=6)
+        response = client.receive(json=True)
+        self.assertEqual(response['payload']['max_collectors'], 6)
+        self.assertIn('date', response['payload'])
+        self.assertNotIn('version', response)
+
+    def test_sends_snapshot_on_request(self):
+        self.update_pickup(max_collectors=6)
+        *_, latest = self.receive_pickups()
+
+        self.client.send_and_consume('websocket.receive', path='/', text={
+            'type': 'snapshot',
+            'topic': 'pickups:pickupdate',
+            'id': self.pickup.id,
+        })
+        snapshot = self.client.receive(json=True)
+        self.assertEqual(snapshot['version'], latest['version'])
+        self.assertEqual(snapshot['payload']['max_collectors'], 6)
+        self.assertIn('date', snapshot['payload'])
+
+    def test_reports_missing_snapshot(self):
+        self.receive_pickups()
+        self.client.send_and_consume('websocket.receive', path='/', text={
+            'type': 'snapshot',
+            'topic': 'pickups:pickupdate',
+            'id': 0,
+        })
+        self.assertEqual(self.client.receive(json=True)['topic'], 'status:snapshot_missing')
+
+    def test_follows_group_membership(self):
+        group = GroupFactory()
+        group.add_member(self.user)
+        list(self.client.receive_all())
+
+        Group(group_channel_group(group.id, delta=True)).send({'text': 'group'})
+        self.assertEqual(self.client.receive(json=False), 'group')
+        Group(group_channel_group(group.id)).send({'text': 'group'})
+        self.assertIsNone(self.client.receive(json=False))
+
+
+class SubscriptionTests(ChannelTestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.group = GroupFactory()
+        self.other_group = GroupFactory()
+        self.client = WSClient()
+        self.client.force_login(self.user)
+        self.client.send_and_consume('websocket.connect', path='/')
+
+    def send(self, **content):
+        self.client.send_and_consume('websocket.receive', text=content, path='/')
+
+    def rename_groups(self):
+        for group in (self.group, self.other_group):
+            group.name = faker.name()
+            group.save()
+
+    def receive_previews(self):
+        previews = []
+        while True:
+            response = self.client.receive(json=True)
+            if response is None:
+                return previews
+            previews.append(response['payload']['id'])
+
+    def test_subscribes_to_single_groups(self):
+        self.send(type='subscribe', topic='groups:group_preview', groups=[self.group.id])
+        self.rename_groups()
+        self.assertEqual(self.receive_previews(), [self.group.id])
+
+    def test_unsubscribes(self):
+        self.send(type='subscribe', topic='groups:group_preview')
+        self.send(type='unsubscribe', topic='groups:group_preview')
+        self.rename_groups()
+        self.assertEqual(self.receive_previews(), [])
+
+    def test_ignores_unknown_topics(self):
+        self.send(type='subscribe', topic='users:user')
+        Group(topic_channel_group('users:user')).send({'text': 'user'})
+        self.assertIsNone(self.client.receive(json=False))
+
+    def test_leaves_topic_channel_groups(self):
+        self.send(type='subscribe', topic='groups:group_preview')
+        self.client.send_and_consume('websocket.disconnect', path='/')
+
+        Group(topic_channel_group('groups:group_preview')).send({'text': 'preview'})
+        self.assertIsNone(self.client.receive(json=False))
 
 
 class MockMessage(dict):
@@ -0,0 +1,169 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY
+
+from channels.test import ChannelTestCase
+from django.db import transaction
+from django.test import TestCase
+from django_redis import get_redis_connection
+
+from foodsaving.subscriptions.channel_groups import user_channel_group
+from foodsaving.subscriptions.delta import render_delta, version_key
+from foodsaving.subscriptions.dispatch import DISPATCH_CHANNEL, send_in_group, send_to_users, splice_fields
+from foodsaving.tests.utils import WSClient, run_dispatch_worker, clear_realtime_state
+from foodsaving.utils.tests.fake import faker
+
+
+class DispatchTests(ChannelTestCase):
+    def setUp(self):
+        self.client = WSClient()
+        self.client.join_group('test')
+
+    def run_on_commit_callbacks(self):
+        """Execute on_commit callbacks, without consuming the dispatch channel"""
+        connection = transaction.get_connection()
+        for _, callback in connection.run_on_commit:
+            callback()
+        connection.run_on_commit = []
+
+    def test_sends_after_commit(self):
+        with transaction.atomic():
+            send_in_group('test', 'test:topic', {'id': 1})
+            self.assertIsNone(self.get_next_message(DISPATCH_CHANNEL))
+
+        response = self.client.receive(json=True)
+        self.assertEqual(response, {'topic': 'test:topic', 'payload': {'id': 1}, 'stream': 'test', 'seq': ANY})
+
+    def test_batches_events_of_transaction(self):
+        with transaction.atomic():
+            send_in_group('test', 'test:topic', {'id': 1})
+            send_in_group('test', 'test:topic', {'id': 2})
+
+        self.run_on_commit_callbacks()
+
+        message = self.get_next_message(DISPATCH_CHANNEL, require=True)
+        self.assertEqual(len(message.content['events']), 2)
+        self.assertIsNone(self.get_next_message(DISPATCH_CHANNEL))
+
+    def test_discards_events_of_rolled_back_transaction(self):
+        send_in_group('test', 'test:topic', {'id': 1})
+        try:
+            with transaction.atomic():
+                send_in_group('test', 'test:topic', {'id': 2})
+                raise Exception()
+        except Exception:
+            pass
+
+        run_dispatch_worker()
+        self.assertEqual(self.client.receive(json=True)['payload'], {'id': 1})
+        self.assertIsNone(self.client.receive(json=True))
+
+    def test_sends_batch_if_last_savepoint_is_rolled_back(self):
+        with transaction.atomic():
+            send_in_group('test', 'test:topic', {'id': 1})
+            try:
+                with transaction.atomic():
+                    send_in_group('test', 'test:topic', {'id': 2})
+                    raise Exception()
+            except Exception:
+                pass
+
+        self.run_on_commit_callbacks()
+        message = self.get_next_message(DISPATCH_CHANNEL, require=True)
+        payloads = [json.loads(e['text'])['payload'] for e in message.content['events']]
+        self.assertEqual(payloads, [{'id': 1}])
+        self.assertIsNone(self.get_next_message(DISPATCH_CHANNEL))
+
+    def test_coalesces_events_of_transaction(self):
+        key = faker.uuid4()
+        with transaction.atomic():
+            send_in_group('test', 'test:topic', {'id': 1, 'name': 'old'}, coalesce=key)
+            send_in_group('test', 'test:other', {'id': 2}, coalesce=faker.uuid4())
+            send_in_group('test', 'test:topic', {'id': 1, 'name': 'new'}, coalesce=key)
+
+        self.run_on_commit_callbacks()
+        message = self.get_next_message(DISPATCH_CHANNEL, require=True)
+        self.assertEqual(len(message.content['events']), 2)
+
+    def test_coalesces_events_within_window(self):
+        key = faker.uuid4()
+        send_in_group('test', 'test:topic', {'id': 1, 'name': 'old'}, coalesce=key)
+        self.run_on_commit_callbacks()
+        self.client.consume(DISPATCH_CHANNEL)
+        send_in_group('test', 'test:topic', {'id': 1, 'name': 'new'}, coalesce=key)
+        self.run_on_commit_callbacks()
+        self.client.consume(DISPATCH_CHANNEL)
+
+        # nothing is sent before the window is over
+        self.assertIsNone(self.get_next_message(self.client.reply_channel))
+
+        response = self.client.receive(json=True)
+        self.assertEqual(response['payload'], {'id': 1, 'name': 'new'})
+        self.assertIsNone(self.client.receive(json=True))
+
+    def test_sends_user_fields(self):
+        other = WSClient()
+        self.client.join_group(user_channel_group(1))
+        other.join_group(user_channel_group(2))
+        send_to_users('test:topic', {'id': 1}, {1: {'is_editable': True}, 2: {'is_editable': False}})
+
+        self.assertEqual(self.client.receive(json=True)['payload'], {'id': 1, 'is_editable': True})
+        self.assertEqual(other.receive(json=True)['payload'], {'id': 1, 'is_editable': False})
+
+
+class SpliceFieldsTests(TestCase):
+    def splice(self, payload, fields):
+        text = json.dumps({'topic': 'test:topic', 'payload': payload})
+        return json.loads(splice_fields(text, json.dumps(fields)))
+
+    def test_adds_fields_to_payload(self):
+        message = self.splice({'id': 1, 'nested': {'a': '}}'}}, {'is_editable': True})
+        self.assertEqual(message, {
+            'topic': 'test:topic',
+            'payload': {'id': 1, 'nested': {'a': '}}'}, 'is_editable': True}
+        })
+
+    def test_adds_fields_to_empty_payload(self):
+        message = self.splice({}, {'is_editable': True})
+        self.assertEqual(message['payload'], {'is_editable': True})
+
+    def test_keeps_payload_without_fields(self):
+        message = self.splice({'id': 1}, {})
+        self.assertEqual(message['payload'], {'id': 1})
+
+
+class RenderDeltaTests(TestCase):
+    def setUp(self):
+        clear_realtime_state()
+
+    def render(self, **payload):
+        text = render_delta('test', json.dumps({'topic': 'test:topic', 'payload': dict(id=1, **payload)}))
+        return json.loads(text) if text is not None else None
+
+    def test_renders_changes_against_previous_version(self):
+        snapshot = self.render(a=1, b=1)
+        self.assertEqual(snapshot, {'topic': 'test:topic', 'payload': {'id': 1, 'a': 1, 'b': 1}, 'version': 1})
+        change = self.render(a=1, b=2)
+        self.assertEqual(change, {'topic': 'test:topic', 'payload': {'id': 1, 'b': 2}, 'version': 2, 'delta': True})
+
+    def test_skips_unchanged_payload(self):
+        self.render(a=1)
+        self.assertIsNone(self.render(a=1))
+        self.assertEqual(self.render(a=2)['version'], 2)
+
+    def test_sends_snapshot_if_previous_version_is_missing(self):
+        self.render(a=1)
+        # another worker took version 2, but did not store its payload yet
+        get_redis_connection('default').incr(version_key('test', 'test:topic', 1))
+
+        snapshot = self.render(a=3)
+        self.assertEqual(snapshot, {'topic': 'test:topic', 'payload': {'id': 1, 'a': 3}, 'version': 3})
+        change = self.render(a=4)
+        self.assertEqual(change['version'], 4)
+        self.assertEqual(change['payload'], {'id': 1, 'a': 4})
+
+    def test_concurrent_workers_get_distinct_versions(self):
+        self.render(a=0)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            versions = list(executor.map(lambda a: self.render(a=a)['version'], range(1, 11)))
+        self.assertEqual(sorted(versions), list(range(2, 12)))
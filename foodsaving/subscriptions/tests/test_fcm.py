@@ -4,6 +4,7 @@ from unittest.mock import patch
 
 import requests_mock
 from django.test import TestCase
+from pyfcm.baseapi import BaseAPI as FCMApi
 
 import foodsaving.subscriptions.fcm
 from foodsaving.subscriptions.fcm import notify_multiple_devices
@@ -74,6 +75,55 @@ class FCMTests(TestCase):
             self.assertEqual(PushSubscription.objects.filter(token=valid_token).count(), 1)
             self.assertEqual(PushSubscription.objects.filter(token=invalid_token).count(), 0)
 
+    def test_removes_unregistered_subscriptions(self, m):
+        with override_fcm_key('something'):
+            m.post('https://fcm.googleapis.com/fcm/send', json={
+                'results': [{'error': 'NotRegistered'}, {'error': 'InvalidRegistration'}]
+            })
+            user = UserFactory()
+            tokens = [faker.uuid4(), faker.uuid4()]
+            for token in tokens:
+                PushSubscription.objects.create(user=user, token=token)
+            notify_multiple_devices(registration_ids=tokens)
+            self.assertEqual(PushSubscription.objects.filter(token__in=tokens).count(), 0)
+
+    def test_sends_in_chunks(self, m):
+        with override_fcm_key('something'), patch.object(FCMApi, 'FCM_MAX_RECIPIENTS', 2):
+            m.post('https://fcm.googleapis.com/fcm/send', [
+                {'json': {'results': [{}, {}]}},
+                {'json': {'results': [{}]}},
+            ])
+            result = notify_multiple_devices(registration_ids=['a', 'b', 'c'])
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(m.request_history[1].json()['to'], 'c')
+            self.assertEqual(result['success'], 3)
+
+    def test_retries_with_backoff(self, m):
+        with override_fcm_key('something'), patch('time.sleep') as sleep:
+            m.post('https://fcm.googleapis.com/fcm/send', [
+                {'status_code': 503},
+                {'json': {'results': [{}, {'error': 'Unavailable'}]}},
+                {'json': {'results': [{}]}},
+            ])
+            result = notify_multiple_devices(registration_ids=['a', 'b'])
+            self.assertEqual(m.call_count, 3)
+            self.assertEqual(m.request_history[2].json()['to'], 'b')
+            self.assertEqual([call[0][0] for call in sleep.call_args_list], [1, 2])
+            self.assertEqual(result['success'], 2)
+
+    def test_gives_up_after_retries(self, m):
+        with override_fcm_key('something'), patch('time.sleep'):
+            m.post('https://fcm.googleapis.com/fcm/send', status_code=500)
+            result = notify_multiple_devices(registration_ids=['a'])
+            self.assertEqual(m.call_count, 4)
+            self.assertEqual(result['failure'], 1)
+
+    def test_sends_to_configured_end_point(self, m):
+        with override_fcm_key('something'), self.settings(FCM_END_POINT='http://localhost:8090/fcm/send'):
+            m.post('http://localhost:8090/fcm/send', json={'results': [{}]})
+            notify_multiple_devices(registration_ids=['a'])
+            self.assertTrue(m.called)
+
     def test_continues_if_config_not_present(self, m):
         with logger_warning_mock() as warning_mock:
             with override_fcm_key():
@@ -2,24 +2,29 @@ import json
 import os
 import pathlib
 from shutil import copyfile
+from unittest.mock import ANY, patch
 
 import requests_mock
-from channels.test import ChannelTestCase, WSClient
+from channels.test import ChannelTestCase
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.management import call_command
 from django.utils import timezone
+from django_redis import get_redis_connection
 from pyfcm.baseapi import BaseAPI as FCMApi
 
 from foodsaving.conversations.factories import ConversationFactory
-from foodsaving.conversations.models import ConversationMessage
+from foodsaving.conversations.models import ConversationMessage, ConversationParticipant
 from foodsaving.groups.factories import GroupFactory
 from foodsaving.invitations.models import Invitation
 from foodsaving.pickups.factories import PickupDateFactory, PickupDateSeriesFactory, FeedbackFactory
 from foodsaving.stores.factories import StoreFactory
-from foodsaving.subscriptions.models import PushSubscriptionPlatform, PushSubscription, ChannelSubscription
-from foodsaving.tests.utils import ReceiveAllWSClient
+from foodsaving.subscriptions import presence
+from foodsaving.subscriptions.channel_groups import user_channel_group
+from foodsaving.subscriptions.fcm import flush_conversation_push, push_key
+from foodsaving.subscriptions.models import PushSubscriptionPlatform, PushSubscription
+from foodsaving.tests.utils import ReceiveAllWSClient, WSClient, run_dispatch_worker, clear_realtime_state
 from foodsaving.users.factories import UserFactory
 from foodsaving.utils.tests.fake import faker
 
@@ -56,7 +61,9 @@ class ConversationReceiverTests(ChannelTestCase):
                 'author': message.author.id,
                 'conversation': conversation.id,
                 'created_at': message.created_at
-            }
+            },
+            'stream': user_channel_group(user.id),
+            'seq': ANY,
         })
 
         # and they should get an updated conversation object
@@ -72,7 +79,9 @@ class ConversationReceiverTests(ChannelTestCase):
                 'updated_at': conversation.updated_at,
                 'seen_up_to': None,
                 'unread_message_count': 1,
-            }
+            },
+            'stream': user_channel_group(user.id),
+            'seq': ANY,
         })
 
         # author should get message & updated conversations object too
@@ -86,7 +95,9 @@ class ConversationReceiverTests(ChannelTestCase):
                 'author': message.author.id,
                 'conversation': conversation.id,
                 'created_at': message.created_at
-            }
+            },
+            'stream': user_channel_group(author.id),
+            'seq': ANY,
         })
 
         # Author receives more recent `update_at` time,
@@ -104,7 +115,9 @@ class ConversationReceiverTests(ChannelTestCase):
                 'updated_at': author_participant.updated_at,
                 'seen_up_to': message.id,
                 'unread_message_count': 0,
-            }
+            },
+            'stream': user_channel_group(author.id),
+            'seq': ANY,
         })
 
     def tests_receive_message_on_leave(self):
@@ -125,9 +138,54 @@ class ConversationReceiverTests(ChannelTestCase):
             'topic': 'conversations:leave',
             'payload': {
                 'id': conversation.id
-            }
+            },
+            'stream': user_channel_group(user.id),
+            'seq': ANY,
         })
 
+    def test_receives_changes_of_sync_users(self):
+        client = WSClient()
+        user = UserFactory()
+        leaving_user = UserFactory()
+        leaving_client = WSClient()
+
+        conversation = ConversationFactory()
+        conversation.join(leaving_user)
+
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+        leaving_client.force_login(leaving_user)
+        leaving_client.send_and_consume('websocket.connect', path='/')
+
+        conversation.sync_users([user])
+
+        response = client.receive(json=True)
+        self.assertEqual(response['topic'], 'conversations:conversation')
+        self.assertEqual(response['payload']['id'], conversation.id)
+        self.assertEqual(response['payload']['unread_message_count'], 0)
+        self.assertEqual(leaving_client.receive(json=True)['topic'], 'conversations:leave')
+
+    def test_receives_marked_conversations_at_once(self):
+        client = WSClient()
+        user = UserFactory()
+        author = UserFactory()
+        conversations = [ConversationFactory() for _ in range(2)]
+        seen_up_to = {}
+        for conversation in conversations:
+            conversation.sync_users([user, author])
+            seen_up_to[conversation.id] = conversation.messages.create(author=author, content='hello').id
+
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/')
+
+        ConversationParticipant.objects.mark_seen_up_to(user, seen_up_to)
+
+        response = client.receive(json=True)
+        self.assertEqual(response['topic'], 'conversations:conversations')
+        self.assertEqual({c['id']: c['seen_up_to'] for c in response['payload']}, seen_up_to)
+        self.assertEqual([c['unread_message_count'] for c in response['payload']], [0, 0])
+        self.assertIsNone(client.receive(json=True))
+
 
 class GroupReceiverTests(ChannelTestCase):
     def setUp(self):
@@ -149,16 +207,15 @@ class GroupReceiverTests(ChannelTestCase):
         self.assertEqual(response['payload']['name'], name)
         self.assertTrue('description' in response['payload'])
 
-        response = self.client.receive(json=True)
-        self.assertEqual(response['topic'], 'groups:group_preview')
-        self.assertEqual(response['payload']['name'], name)
-        self.assertTrue('description' not in response['payload'])
-
         self.assertIsNone(self.client.receive(json=True))
 
     def test_receive_group_changes_as_nonmember(self):
         self.client.force_login(self.user)
         self.client.send_and_consume('websocket.connect', path='/')
+        self.client.send_and_consume('websocket.receive', text={
+            'type': 'subscribe',
+            'topic': 'groups:group_preview',
+        }, path='/')
 
         name = faker.name()
         self.group.name = name
@@ -171,6 +228,15 @@ class GroupReceiverTests(ChannelTestCase):
 
         self.assertIsNone(self.client.receive(json=True))
 
+    def test_no_group_preview_without_subscription(self):
+        self.client.force_login(self.user)
+        self.client.send_and_consume('websocket.connect', path='/')
+
+        self.group.name = faker.name()
+        self.group.save()
+
+        self.assertIsNone(self.client.receive(json=True))
+
 
 class InvitationReceiverTests(ChannelTestCase):
     def setUp(self):
@@ -323,6 +389,26 @@ class PickupDateSeriesReceiverTests(ChannelTestCase):
 
         self.assertIsNone(self.client.receive(json=True))
 
+    def test_receive_pickup_dates_of_series(self):
+        self.client.force_login(self.member)
+        self.client.send_and_consume('websocket.connect', path='/')
+
+        self.series.start_date = timezone.now()
+        self.series.save()
+
+        response = self.client.receive(json=True)
+        self.assertEqual(response['topic'], 'pickups:series')
+
+        pickups = self.series.pickup_dates.all()
+        self.assertGreater(len(pickups), 0)
+        for pickup in pickups:
+            response = self.client.receive(json=True)
+            self.assertEqual(response['topic'], 'pickups:pickupdate')
+            self.assertEqual(response['payload']['id'], pickup.id)
+            self.assertEqual(response['payload']['collector_ids'], [])
+
+        self.assertIsNone(self.client.receive(json=True))
+
 
 class FeedbackReceiverTests(ChannelTestCase):
     def setUp(self):
@@ -341,6 +427,26 @@ class FeedbackReceiverTests(ChannelTestCase):
         response = self.client.receive(json=True)
         self.assertEqual(response['topic'], 'feedback:feedback')
         self.assertEqual(response['payload']['weight'], feedback.weight)
+        self.assertFalse(response['payload']['is_editable'])
+
+        # the author gets the variant which they can edit afterwards
+        response = self.client.receive(json=True)
+        self.assertEqual(response['topic'], 'feedback:feedback')
+        self.assertTrue(response['payload']['is_editable'])
+
+        self.assertIsNone(self.client.receive(json=True))
+
+    def test_other_members_receive_feedback_once(self):
+        other_member = UserFactory()
+        self.group.add_member(other_member)
+        self.client.force_login(other_member)
+        self.client.send_and_consume('websocket.connect', path='/')
+
+        FeedbackFactory(given_by=self.member, about=self.pickup)
+
+        response = self.client.receive(json=True)
+        self.assertEqual(response['topic'], 'feedback:feedback')
+        self.assertFalse(response['payload']['is_editable'])
 
         self.assertIsNone(self.client.receive(json=True))
 
@@ -432,6 +538,7 @@ class UserReceiverTest(ChannelTestCase):
 @requests_mock.Mocker()
 class ReceiverPushTests(ChannelTestCase):
     def setUp(self):
+        clear_realtime_state()
         self.user = UserFactory()
         self.author = UserFactory()
 
@@ -458,12 +565,65 @@ class ReceiverPushTests(ChannelTestCase):
 
         # add a message to the conversation
         ConversationMessage.objects.create(conversation=self.conversation, content=self.content, author=self.author)
+        run_dispatch_worker()
+        self.assertTrue(m.called)
+
+    def test_merges_push_notifications_of_conversation(self, m):
+        m.post(FCMApi.FCM_END_POINT, json={})
+
+        for _ in range(3):
+            ConversationMessage.objects.create(
+                conversation=self.conversation, content=self.content, author=self.author
+            )
+        # the worker might receive the delayed flush before the last message otherwise
+        with patch('foodsaving.subscriptions.fcm.flush_conversation_push'):
+            run_dispatch_worker()
+        flush_conversation_push(self.conversation.id)
+
+        bodies = [request.json()['notification']['body'] for request in m.request_history]
+        self.assertEqual(bodies, [self.content, '2 new messages'])
+
+    def test_does_not_send_merged_push_notification_if_user_came_back(self, m):
+        m.post(FCMApi.FCM_END_POINT, json={})
+
+        for _ in range(2):
+            ConversationMessage.objects.create(
+                conversation=self.conversation, content=self.content, author=self.author
+            )
+        # hold back the merged notification until the user came back
+        with patch('foodsaving.subscriptions.fcm.flush_conversation_push'):
+            run_dispatch_worker()
+        presence.touch(self.user.id, 'foo')
+        flush_conversation_push(self.conversation.id)
+
+        self.assertEqual(m.call_count, 1)
+
+    def test_includes_held_push_notifications_when_window_is_over(self, m):
+        m.post(FCMApi.FCM_END_POINT, json={})
+
+        def send_message():
+            ConversationMessage.objects.create(
+                conversation=self.conversation, content=self.content, author=self.author
+            )
+            with patch('foodsaving.subscriptions.fcm.flush_conversation_push'):
+                run_dispatch_worker()
+
+        send_message()
+        send_message()
+        # the window of the user is over before the flush of the conversation
+        get_redis_connection('default').delete(push_key('window', self.conversation.id, self.user.id))
+        send_message()
+        flush_conversation_push(self.conversation.id)
+
+        bodies = [request.json()['notification']['body'] for request in m.request_history]
+        self.assertEqual(bodies, [self.content, '2 new messages'])
 
     def test_does_not_send_push_notification_if_active_channel_subscription(self, m):
-        # add a channel subscription to prevent the push being sent
-        ChannelSubscription.objects.create(user=self.user, reply_channel='foo')
+        # an open socket prevents the push being sent
+        presence.touch(self.user.id, 'foo')
         # add a message to the conversation
         ConversationMessage.objects.create(conversation=self.conversation, content=self.content, author=self.author)
+        run_dispatch_worker()
         # if it sent a push message, the requests mock would complain there is no matching request...
 
     def test_send_push_notification_if_channel_subscription_is_away(self, m):
@@ -476,16 +636,19 @@ class ReceiverPushTests(ChannelTestCase):
 
         m.post(FCMApi.FCM_END_POINT, json={}, additional_matcher=check_json_data)
 
-        # add a channel subscription to prevent the push being sent
-        ChannelSubscription.objects.create(user=self.user, reply_channel='foo', away_at=timezone.now())
+        # the socket is open, but the user is not looking at it
+        presence.touch(self.user.id, 'foo', away=True)
 
         # add a message to the conversation
         ConversationMessage.objects.create(conversation=self.conversation, content=self.content, author=self.author)
+        run_dispatch_worker()
+        self.assertTrue(m.called)
 
 
 @requests_mock.Mocker()
 class GroupConversationReceiverPushTests(ChannelTestCase):
     def setUp(self):
+        clear_realtime_state()
         self.group = GroupFactory()
         self.user = UserFactory()
         self.author = UserFactory()
@@ -512,3 +675,5 @@ class GroupConversationReceiverPushTests(ChannelTestCase):
 
         # add a message to the conversation
         ConversationMessage.objects.create(conversation=self.conversation, content=self.content, author=self.author)
+        run_dispatch_worker()
+        self.assertTrue(m.called)
@@ -1,8 +1,17 @@
-from channels.test import WSClient
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.message import Message
+from channels.test import WSClient as BaseWSClient
 from django.apps import apps
 from django.db import connection
 from django.db.migrations.executor import MigrationExecutor
 from django.test import TestCase
+from django_redis import get_redis_connection
+
+from foodsaving.subscriptions.delta import delta_key
+from foodsaving.subscriptions.dispatch import DISPATCH_CHANNEL, DELAY_CHANNEL, PUSH_CHANNEL, dispatch
+from foodsaving.subscriptions.fcm import push, push_key
+from foodsaving.subscriptions.presence import presence_key
+from foodsaving.subscriptions.replay import replay_key
 
 
 # Mostly based on this nice persons article:
@@ -47,6 +56,50 @@ class ExtractPaginationMixin(object):
         return response
 
 
+def run_dispatch_worker():
+    """
+    Send out all queued realtime events
+
+    TestCase wraps every test in a transaction that never commits, so we run the on_commit callbacks ourselves
+    and then process the messages the dispatch and push workers would receive.
+    """
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+    channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+    while True:
+        channel, content = channel_layer.receive_many([DISPATCH_CHANNEL, DELAY_CHANNEL, PUSH_CHANNEL])
+        if channel is None:
+            break
+        if channel == DELAY_CHANNEL:
+            # don't wait for delayed messages
+            channel_layer.send(content['channel'], content['content'])
+        elif channel == PUSH_CHANNEL:
+            push(Message(content, channel, channel_layer))
+        else:
+            dispatch(Message(content, channel, channel_layer))
+
+
+def clear_realtime_state():
+    """Forget about sockets and streams of earlier test runs, ids start from the beginning in a new test database"""
+    redis = get_redis_connection('default')
+    for pattern in (presence_key('*'), replay_key('*'), push_key('*'), delta_key('*')):
+        for key in redis.scan_iter(pattern):
+            redis.delete(key)
+
+
+class WSClient(BaseWSClient):
+    def send(self, *args, **kwargs):
+        # changes made before the client is talking to us would have been sent already
+        run_dispatch_worker()
+        return super().send(*args, **kwargs)
+
+    def receive(self, *args, **kwargs):
+        run_dispatch_worker()
+        return super().receive(*args, **kwargs)
+
+
 class ReceiveAllWSClient(WSClient):
     def receive_all(self, *args, **kwargs):
         while True:
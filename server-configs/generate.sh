@@ -54,4 +54,16 @@ for name in $names; do
         "$name.json" --format json \
         > "$dest/$name/systemd/$name-worker@.service"
 
+    # delay service
+
+    jinja2 templates/delay.service.j2 \
+        "$name.json" --format json \
+        > "$dest/$name/systemd/$name-delay.service"
+
+    # push worker service
+
+    jinja2 templates/push-worker.service.j2 \
+        "$name.json" --format json \
+        > "$dest/$name/systemd/$name-push-worker.service"
+
 done